@@ -1,28 +1,26 @@
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
+import threading
+import click
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
-from elasticsearch import Elasticsearch
 # lazy_gettext wraps strings for translation, similar to _. This lazy version
 # delays evaluation of string until used. This covers cases where the string is
 # defined when application is starting.
 from flask_babel import Babel, lazy_gettext as _l
 from config import Config
-from redis import Redis
-import rq
+from app.replicas import RoutingSQLAlchemy
+from werkzeug.local import LocalProxy
 '''
 Declare extensions here.
 '''
 # Create the database instance that will represent the db to the app.
-db = SQLAlchemy()
-# The migration engine needs a copy of db too.
-migrate = Migrate()
+# This is Flask-SQLAlchemy with reads routed to replicas, see replicas.py.
+db = RoutingSQLAlchemy()
 # Create the login state manager
 login = LoginManager()
 # Change the default message given by the Flask-Login extension when a user
@@ -42,6 +40,59 @@ moment = Moment()
 babel = Babel()
 
 
+def lazy(factory):
+    '''
+    A stand-in for the object factory() makes, which only gets made the
+    first time something uses it. Gunicorn workers, the flask command and
+    rq workers then don't pay for imports and clients they never touch.
+    '''
+    instance = []
+    lock = threading.Lock()
+
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    return LocalProxy(get)
+
+
+def reset_connections(app):
+    '''
+    Empty the database and Redis connection pools. For processes forked
+    from one that already had the app, so they never share a socket with
+    their parent or each other.
+    '''
+    for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or {}):
+        db.get_engine(app, bind=bind).dispose()
+    app.redis.connection_pool.reset()
+    app.passwords.reset()
+
+
+def _in_flask_command():
+    '''True when create_app() is called by the flask command line tool.'''
+    from flask.cli import ScriptInfo
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.find_object(ScriptInfo) is not None
+
+
+def _elasticsearch(app):
+    from elasticsearch import Elasticsearch
+    return Elasticsearch([app.config['ELASTICSEARCH_URL']])
+
+
+def _redis(app):
+    from redis import Redis
+    return Redis.from_url(app.config['REDIS_URL'])
+
+
+def _task_queues(app):
+    from app.queues import create_queues
+    return create_queues(app)
+
+
 # A factory pattern to create the application instance, which takes
 # a Config option to make.
 def create_app(config_class=Config):
@@ -57,7 +108,15 @@ def create_app(config_class=Config):
 
     # Init the exensions here now that app is created
     db.init_app(app)
-    migrate.init_app(app, db)
+    # The migration engine needs a copy of db too. Flask-Migrate imports
+    # all of Alembic and only 'flask db' uses it, so skip it everywhere else.
+    if _in_flask_command():
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    if app.config['SQLITE_PROFILE']:
+        # Before anything opens a connection, so they all get the pragmas.
+        from app import sqlite
+        sqlite.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
@@ -77,12 +136,45 @@ def create_app(config_class=Config):
 
     # Elasticsearch isn't a Flask extension, so we can't create an
     # instance of it. Instead, create a new attribute (a little hacky)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
+    # The clients are lazy, see lazy() above.
+    app.elasticsearch = lazy(lambda: _elasticsearch(app)) \
         if app.config['ELASTICSEARCH_URL'] else None
 
     # Background tasks manager initialization. This is better than threads.
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    app.redis = lazy(lambda: _redis(app))
+    # One rq queue per urgency, see app/queues.py. task_queue is the
+    # interactive one, for code that doesn't care.
+    app.task_queues = lazy(lambda: _task_queues(app))
+    app.task_queue = lazy(lambda: app.task_queues['interactive'])
+
+    # Trending topics, counted as posts come in. See app/trending.py.
+    from app.trending import Trending
+    app.trending = Trending(app)
+
+    # Usernames in memory, for autocomplete and availability checks. See
+    # app/usernames.py.
+    from app.usernames import UsernameIndex
+    app.usernames = UsernameIndex(app)
+
+    # Password hashing with admission control, see app/passwords.py. Made
+    # here so gunicorn workers inherit the counters from the master.
+    from app.passwords import Hasher
+    app.passwords = Hasher(app)
+
+    # What Flask-Login's user loader reads instead of the user table. See
+    # app/usercache.py.
+    from app.usercache import UserCache
+    app.user_cache = UserCache(app)
+
+    # Prometheus metrics, served on /metrics. Like Elasticsearch above this
+    # hangs off the app so search, translate and tasks can reach it.
+    from app.metrics import Metrics
+    app.metrics = Metrics(app, db.get_engine(app))
+
+    # Rate and concurrency limits for the expensive routes. After metrics,
+    # so shed requests still get timed. See app/limits.py.
+    from app.limits import Limits
+    app.limits = Limits(app)
 
     # Register the API blueprint
     from app.api import bp as api_bp
@@ -129,7 +221,7 @@ def create_app(config_class=Config):
             file_handler.setLevel(logging.INFO)
             app.logger.addHandler(file_handler)
 
-        app.logger.addHandler(logging.INFO)
+        app.logger.setLevel(logging.INFO)
         # app.logger.info('Microblog-Py startup')
 
     return app
@@ -145,4 +237,4 @@ def get_local():
 
 # Import here to avoid circular imports between the app module.
 # models: representations of the app database
-from app import models
\ No newline at end of file
+from app import models
@@ -5,4 +5,4 @@ a REST API.
 '''
 bp = Blueprint('api', __name__)
 
-from app.api import users, errors, tokens
\ No newline at end of file
+from app.api import users, posts, errors, tokens
\ No newline at end of file
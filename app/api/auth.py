@@ -9,7 +9,7 @@ To integrate this extension, app needs to provide 2 functions:
     1. Define logic to check UN/PW provided by user
     2. Return error if auth fails.
 '''
-from flask import g
+from flask import g, request
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from app.models import User
 from app.api.errors import error_response
@@ -38,7 +38,13 @@ def basic_auth_error():
 # Verify a token is valid. To be used by endpoints.
 @token_auth.verify_token
 def verify_token(token):
-    g.current_user = User.check_token(token) if token else None
+    # The rate limits (app/limits.py) may have checked it already during
+    # this request. Kept in the environ, which never outlives a request.
+    checked = request.environ.get('microblog.token')
+    if checked is None or checked[0] != token:
+        checked = (token, User.check_token(token) if token else None)
+        request.environ['microblog.token'] = checked
+    g.current_user = checked[1]
     return g.current_user is not None
 
 
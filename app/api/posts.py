@@ -0,0 +1,159 @@
+'''
+Posts and timelines for API clients, so they don't have to scrape the HTML
+pages. The timelines use the same queries as the index and explore pages,
+with cursor pagination instead of page numbers (see app/cursors.py).
+'''
+from app.api import bp
+from flask import current_app, g, request, url_for
+from app.models import User, Post, avatar_url
+from app import cursors, db, terms
+from app.api.errors import bad_request
+from app.api.auth import token_auth
+from app.api.serializers import json_response, ndjson_export, post_dicts
+
+# Most posts one bulk request can create.
+MAX_BATCH = 100
+
+
+@bp.route('/posts/bulk', methods=['POST'])
+@token_auth.login_required
+def create_posts():
+    '''
+    Create many posts for the current user in one transaction.
+    Ex: {"posts": [{"body": "first"}, {"body": "second"}]}
+    Invalid posts are skipped and reported, the rest are still created.
+    Search indexing for all of them happens in one bulk request on commit.
+    '''
+    data = request.get_json() or {}
+    items = data.get('posts')
+    if not isinstance(items, list):
+        return bad_request('must include a list of posts')
+    if len(items) > MAX_BATCH:
+        return bad_request(f'at most {MAX_BATCH} posts per request')
+    results, created = [], []
+    for item in items:
+        body = item.get('body') if isinstance(item, dict) else None
+        if not isinstance(body, str) or not body.strip():
+            results.append({'status': 400, 'message': 'body is required'})
+            continue
+        if len(body) > 140:
+            results.append({'status': 400,
+                            'message': 'body is longer than 140 characters'})
+            continue
+        post = Post(body=body,
+                    author=g.current_user,
+                    language=Post.detect_language(body))
+        db.session.add(post)
+        created.append(post)
+        results.append({'status': 201})
+    # Read the new ids after the flush. After the commit, every post would
+    # be expired and reloaded one query at a time.
+    db.session.flush()
+    terms.index_posts(created)
+    ids = iter([post.id for post in created])
+    for result in results:
+        if result['status'] == 201:
+            result['id'] = next(ids)
+    # Only the posts that were made count as trending, and like the ids
+    # their bodies are read before the commit expires them.
+    bodies = [post.body for post in created]
+    db.session.commit()
+    current_app.trending.add(bodies)
+    return json_response({'items': results})
+
+
+@bp.route('/users/<int:id>/posts/export', methods=['GET'])
+@token_auth.login_required
+def export_posts(id):
+    '''All of a user's posts as NDJSON, oldest first.'''
+    user = User.query.get_or_404(id)
+    return ndjson_export(user.posts, Post.id, post_dicts)
+
+
+def _authors(posts):
+    '''
+    The authors of a page of posts, each once, from one query of just the
+    columns we send. Posts only carry the author's id.
+    '''
+    ids = {post.user_id for post in posts}
+    if not ids:
+        return []
+    return [{
+        'id': row.id,
+        'username': row.username,
+        'avatar': avatar_url(row.avatar_hash, 36)
+    } for row in db.session.query(User.id, User.username,
+                                  User.avatar_hash).filter(
+        User.id.in_(ids)).order_by(User.id)]
+
+
+def post_page(source, endpoint, **kwargs):
+    '''
+    One page of posts from a query (or shards.Timeline), newest first,
+    starting after ?cursor= if given. ?limit= sets the page size.
+    '''
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    cursor = request.args.get('cursor')
+    try:
+        posts, next_cursor = cursors.page(source, cursor, limit)
+    except ValueError as e:
+        return bad_request(str(e))
+    return json_response({
+        'items': post_dicts(posts),
+        'authors': _authors(posts),
+        '_links': {
+            'self': url_for(endpoint, limit=limit, cursor=cursor, **kwargs),
+            'next': url_for(endpoint, limit=limit, cursor=next_cursor,
+                            **kwargs) if next_cursor else None
+        }
+    })
+
+
+@bp.route('/posts/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_post(id):
+    post = Post.query.get_or_404(id)
+    return json_response(post_dicts([post])[0])
+
+
+@bp.route('/posts', methods=['GET'])
+@token_auth.login_required
+def get_posts():
+    '''Everyone's posts, like the explore page.'''
+    return post_page(Post.recent(), 'api.get_posts')
+
+
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+def get_user_posts(id):
+    user = User.query.get_or_404(id)
+    return post_page(user.posts, 'api.get_user_posts', id=id)
+
+
+@bp.route('/timeline', methods=['GET'])
+@token_auth.login_required
+def get_timeline():
+    '''The current user's home timeline, like the index page.'''
+    return post_page(g.current_user.followed_posts(), 'api.get_timeline')
+
+
+@bp.route('/tags/<name>/posts', methods=['GET'])
+@token_auth.login_required
+def get_tagged_posts(name):
+    '''Posts with a hashtag, from the post_tag index.'''
+    return post_page(terms.tagged(name), 'api.get_tagged_posts', name=name)
+
+
+@bp.route('/users/<int:id>/mentions', methods=['GET'])
+@token_auth.login_required
+def get_mentions(id):
+    '''Posts that mention a user, from the mention index.'''
+    user = User.query.get_or_404(id)
+    return post_page(terms.mentioning(user), 'api.get_mentions', id=id)
+
+
+@bp.route('/trending', methods=['GET'])
+@token_auth.login_required
+def get_trending():
+    '''The latest trending hashtags and words, see app/trending.py.'''
+    return json_response(current_app.trending.current())
@@ -0,0 +1,263 @@
+'''
+Fast path for the user collections in the API. to_collection_dict() loads
+full User objects and calls to_dict() on each, which runs three COUNT
+queries and four url_for() calls per user before jsonify encodes it all.
+Here the page is one SELECT of just the columns we send, with the follower
+counts as subqueries in it. Post counts come from one grouped query, links
+are filled into URL templates built once per response, and orjson does the
+encoding. The JSON that comes out is the same as to_dict() gives.
+
+Clients can trim and extend that JSON:
+    - fields=id,username only selects and returns those keys.
+    - expand=posts,followers,followed adds the newest few of each under
+      _embedded, one query per collection for the whole page.
+
+For whole collections there are the NDJSON exports, see ndjson_export().
+'''
+from itertools import islice
+import orjson
+from flask import abort, current_app, request, stream_with_context, url_for
+from flask_sqlalchemy import Pagination
+from app import db
+from app.models import User, Post, followers, avatar_url
+from app.api.errors import bad_request
+
+# Stands in for the user id while building a URL template.
+_PLACEHOLDER = 2147483647
+
+# Keys of a user, in the order to_dict() has them.
+USER_FIELDS = ('id', 'username', 'last_seen', 'about_me', 'post_count',
+               'follower_count', 'followed_count', '_links')
+# Collections expand= can embed, and how many of each per user.
+EXPANSIONS = ('posts', 'followers', 'followed')
+EXPAND_LIMIT = 5
+
+
+def _requested(name, allowed, default):
+    '''Parse a comma separated query arg, or 400 on unknown names.'''
+    value = request.args.get(name)
+    if not value:
+        return default
+    names = [n.strip() for n in value.split(',') if n.strip()]
+    unknown = [n for n in names if n not in allowed]
+    if unknown:
+        abort(bad_request(f'unknown {name}: {", ".join(unknown)}'))
+    return [n for n in allowed if n in names]
+
+
+def options():
+    '''The fields and expand query args of the current request.'''
+    return _requested('fields', USER_FIELDS, USER_FIELDS), \
+        _requested('expand', EXPANSIONS, [])
+
+
+def _follow_count(column):
+    '''Correlated COUNT of followers rows where column is the user's id.'''
+    other = followers.alias()
+    return db.select([db.func.count()]).where(
+        other.c[column] == User.id).correlate(User).as_scalar()
+
+
+def _columns(fields):
+    '''Only what the fields need. The id is always there for the links.'''
+    columns = {
+        'username': User.username,
+        'last_seen': User.last_seen,
+        'about_me': User.about_me,
+        'follower_count':
+        _follow_count('followed_id').label('follower_count'),
+        'followed_count':
+        _follow_count('follower_id').label('followed_count'),
+        # The avatar link is made from the email's digest.
+        '_links': User.avatar_hash
+    }
+    return [User.id] + [columns[f] for f in fields if f in columns]
+
+
+def _post_counts(ids):
+    '''Post count per user id. One query, and it works with shards.'''
+    if not ids:
+        return {}
+    return dict(
+        db.session.query(Post.user_id, db.func.count(Post.id)).filter(
+            Post.user_id.in_(ids)).group_by(Post.user_id))
+
+
+def _template(endpoint):
+    return url_for(endpoint, id=_PLACEHOLDER).replace(str(_PLACEHOLDER),
+                                                      '{}')
+
+
+def _embedded_posts(ids):
+    '''Newest EXPAND_LIMIT posts of each user, in one query.'''
+    ranked = db.select([
+        Post.id, Post.body, Post.timestamp, Post.language, Post.user_id,
+        db.func.row_number().over(
+            partition_by=Post.user_id,
+            order_by=Post.timestamp.desc()).label('rank')
+    ]).where(Post.user_id.in_(ids)).alias()
+    posts = {}
+    for row in db.session.query(*ranked.c).filter(
+            ranked.c.rank <= EXPAND_LIMIT).order_by(ranked.c.user_id,
+                                                    ranked.c.rank):
+        posts.setdefault(row.user_id, []).append({
+            'id': row.id,
+            'body': row.body,
+            'timestamp': row.timestamp.isoformat() + 'Z',
+            'language': row.language
+        })
+    return posts
+
+
+def _embedded_users(ids, owner, other):
+    '''
+    First EXPAND_LIMIT users on the other end of the followers rows
+    where the owner column is in ids, in one query.
+    '''
+    ranked = db.select([
+        followers.c[owner].label('owner'), User.id, User.username,
+        db.func.row_number().over(partition_by=followers.c[owner],
+                                  order_by=User.id).label('rank')
+    ]).where(followers.c[other] == User.id).where(
+        followers.c[owner].in_(ids)).alias()
+    users = {}
+    for row in db.session.query(*ranked.c).filter(
+            ranked.c.rank <= EXPAND_LIMIT).order_by(ranked.c.owner,
+                                                    ranked.c.rank):
+        users.setdefault(row.owner, []).append({
+            'id': row.id,
+            'username': row.username
+        })
+    return users
+
+
+def _embedded(ids, expand):
+    loaders = {
+        'posts': lambda: _embedded_posts(ids),
+        'followers': lambda: _embedded_users(ids, 'followed_id',
+                                             'follower_id'),
+        'followed': lambda: _embedded_users(ids, 'follower_id',
+                                            'followed_id')
+    }
+    return {name: loaders[name]() for name in expand}
+
+
+def user_dicts(rows, fields=USER_FIELDS, expand=()):
+    '''Turn rows from _columns() into the dicts to_dict() would give.'''
+    ids = [row.id for row in rows]
+    post_counts = _post_counts(ids) if 'post_count' in fields else {}
+    embedded = _embedded(ids, expand) if ids else {}
+    if '_links' in fields:
+        self_url = _template('api.get_user')
+        followers_url = _template('api.get_followers')
+        followed_url = _template('api.get_followed')
+    items = []
+    for row in rows:
+        data = {}
+        for field in fields:
+            if field == 'last_seen':
+                data['last_seen'] = row.last_seen.isoformat() + 'Z'
+            elif field == 'post_count':
+                data['post_count'] = post_counts.get(row.id, 0)
+            elif field == '_links':
+                data['_links'] = {
+                    'self': self_url.format(row.id),
+                    'followers': followers_url.format(row.id),
+                    'followed': followed_url.format(row.id),
+                    'avatar': avatar_url(row.avatar_hash, 128)
+                }
+            else:
+                data[field] = getattr(row, field)
+        if embedded:
+            data['_embedded'] = {
+                name: found.get(row.id, [])
+                for name, found in embedded.items()
+            }
+        items.append(data)
+    return items
+
+
+def user_rows(query, fields=USER_FIELDS):
+    return query.with_entities(*_columns(fields))
+
+
+def user_collection(query, page, per_page, endpoint, fields=USER_FIELDS,
+                    expand=(), **kwargs):
+    '''
+    Same result as User.to_collection_dict() by default, in three queries
+    plus one per expanded collection.
+    '''
+    rows = user_rows(query, fields).limit(per_page).offset(
+        (page - 1) * per_page).all()
+    resources = Pagination(None, page, per_page,
+                           query.order_by(None).count(), rows)
+    return {
+        'items': user_dicts(rows, fields, expand),
+        '_meta': {
+            'page': page,
+            'per_page': per_page,
+            'total_pages': resources.pages,
+            'total_items': resources.total
+        },
+        '_links': {
+            'self':
+            url_for(endpoint, page=page, per_page=per_page, **kwargs),
+            'next':
+            url_for(endpoint, page=page + 1, per_page=per_page, **kwargs)
+            if resources.has_next else None,
+            'prev':
+            url_for(endpoint, page=page - 1, per_page=per_page, **kwargs)
+            if resources.has_prev else None
+        }
+    }
+
+
+def json_response(data, status=200):
+    '''jsonify() with orjson doing the encoding.'''
+    return current_app.response_class(orjson.dumps(data),
+                                      status=status,
+                                      mimetype='application/json')
+
+
+def post_dicts(rows):
+    '''Rows with the Post columns (or Post objects) to API dicts.'''
+    return [{
+        'id': row.id,
+        'body': row.body,
+        'timestamp': row.timestamp.isoformat() + 'Z',
+        'language': row.language,
+        'user_id': row.user_id
+    } for row in rows]
+
+
+# Rows fetched and serialized at a time by the exports.
+EXPORT_CHUNK = 1000
+
+
+def ndjson_export(query, key, serialize):
+    '''
+    Stream a whole collection as newline delimited JSON, one object per
+    line, in key order. There is no OFFSET or COUNT: the rows come from a
+    single query read through a server side cursor (where the driver has
+    one, like psycopg2) EXPORT_CHUNK rows at a time, so memory stays flat
+    however big the collection is.
+
+    A dropped export resumes with ?since_id=<last id received>.
+    serialize turns a list of rows into a list of dicts, so per chunk
+    lookups like post counts stay one query per chunk.
+    '''
+    since_id = request.args.get('since_id', 0, type=int)
+    rows = query.filter(key > since_id).order_by(key).execution_options(
+        stream_results=True).yield_per(EXPORT_CHUNK)
+
+    def generate():
+        iterator = iter(rows)
+        while True:
+            chunk = list(islice(iterator, EXPORT_CHUNK))
+            if not chunk:
+                return
+            yield b''.join(
+                orjson.dumps(item) + b'\n' for item in serialize(chunk))
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype='application/x-ndjson')
@@ -1,27 +1,65 @@
 from app.api import bp
-from flask import jsonify, g, abort
-from app.models import User
+from flask import jsonify, g, abort, request, url_for, current_app
+from sqlalchemy.exc import IntegrityError
+from app.models import User, followers
 from app import db
 from app.api.errors import bad_request
 from app.api.auth import token_auth
+from app.api.serializers import user_collection, user_dicts, user_rows, \
+    json_response, options, ndjson_export
+
+# Most ids, follows or posts a single batch request can carry.
+MAX_BATCH = 500
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
     '''Retrieve a single user.'''
-    return jsonify(User.query.get_or_404(id).to_dict())
+    fields, expand = options()
+    row = user_rows(User.query.filter_by(id=id), fields).first_or_404()
+    return json_response(user_dicts([row], fields, expand)[0])
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    '''Get a collection of all users.'''
+    '''Get a collection of all users, or ?ids=1,2,3 for specific ones.'''
+    if 'ids' in request.args:
+        return get_users_by_id()
     page = request.args.get('page', 1, type=int)
     # Control the max access for performance reasons.
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    fields, expand = options()
+    data = user_collection(User.query,
+                           page,
+                           per_page,
+                           'api.get_users',
+                           fields=fields,
+                           expand=expand)
+    return json_response(data)
+
+
+def get_users_by_id():
+    '''
+    Lots of users by id in one IN query, for clients syncing users they
+    already know about. Ids that don't exist are listed under _meta.
+    '''
+    try:
+        ids = [int(i) for i in request.args['ids'].split(',') if i]
+    except ValueError:
+        return bad_request('ids must be a comma separated list of integers')
+    if len(ids) > MAX_BATCH:
+        return bad_request(f'at most {MAX_BATCH} ids per request')
+    fields, expand = options()
+    rows = user_rows(User.query.filter(User.id.in_(ids)), fields).all()
+    by_id = {item['id']: item for item in user_dicts(rows, fields, expand)}
+    return json_response({
+        'items': [by_id[i] for i in dict.fromkeys(ids) if i in by_id],
+        '_meta': {
+            'missing': [i for i in dict.fromkeys(ids) if i not in by_id]
+        }
+    })
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
@@ -32,12 +70,15 @@ def get_followers(id):
     page = request.args.get('page', 1, type=int)
     # Control the max access for performance reasons.
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers,
-                                   page,
-                                   per_page,
-                                   'api.get_followers',
-                                   id=id)
-    return jsonify(data)
+    fields, expand = options()
+    data = user_collection(user.followers,
+                           page,
+                           per_page,
+                           'api.get_followers',
+                           fields=fields,
+                           expand=expand,
+                           id=id)
+    return json_response(data)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
@@ -48,12 +89,121 @@ def get_followed(id):
     page = request.args.get('page', 1, type=int)
     # Control the max access for performance reasons.
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed,
-                                   page,
-                                   per_page,
-                                   'api.get_followed',
-                                   id=id)
-    return jsonify(data)
+    fields, expand = options()
+    data = user_collection(user.followed,
+                           page,
+                           per_page,
+                           'api.get_followed',
+                           fields=fields,
+                           expand=expand,
+                           id=id)
+    return json_response(data)
+
+
+# Exports stream a whole collection as NDJSON. See ndjson_export() for
+# how since_id resumes one.
+@bp.route('/users/export', methods=['GET'])
+@token_auth.login_required
+def export_users():
+    fields, expand = options()
+    return ndjson_export(user_rows(User.query, fields), User.id,
+                         lambda rows: user_dicts(rows, fields, expand))
+
+
+@bp.route('/users/<int:id>/followers/export', methods=['GET'])
+@token_auth.login_required
+def export_followers(id):
+    user = User.query.get_or_404(id)
+    fields, expand = options()
+    return ndjson_export(user_rows(user.followers, fields),
+                         followers.c.follower_id,
+                         lambda rows: user_dicts(rows, fields, expand))
+
+
+@bp.route('/users/<int:id>/followed/export', methods=['GET'])
+@token_auth.login_required
+def export_followed(id):
+    user = User.query.get_or_404(id)
+    fields, expand = options()
+    return ndjson_export(user_rows(user.followed, fields),
+                         followers.c.followed_id,
+                         lambda rows: user_dicts(rows, fields, expand))
+
+
+@bp.route('/users/<int:id>/followed', methods=['POST'])
+@token_auth.login_required
+def update_followed(id):
+    '''
+    Follow and unfollow many users at once, in one transaction.
+    Ex: {"follow": [2, 3], "unfollow": [4]}
+    Every id gets its own status in the response, so one bad id doesn't
+    fail the rest.
+    '''
+    if g.current_user.id != id:
+        abort(403)
+    data = request.get_json() or {}
+    follow, unfollow = data.get('follow', []), data.get('unfollow', [])
+    if not isinstance(follow, list) or not isinstance(unfollow, list) or \
+            not all(isinstance(i, int) for i in follow + unfollow):
+        return bad_request('follow and unfollow must be lists of user ids')
+    if len(follow) + len(unfollow) > MAX_BATCH:
+        return bad_request(f'at most {MAX_BATCH} ids per request')
+    user = g.current_user
+    ids = set(follow + unfollow)
+    # Two queries no matter how many ids: who exists, and who we follow.
+    found = {u.id: u for u in User.query.filter(User.id.in_(ids))}
+    following = {
+        row.followed_id
+        for row in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == user.id,
+            followers.c.followed_id.in_(ids))
+    }
+    results = []
+    for action, targets in [('follow', follow), ('unfollow', unfollow)]:
+        for target in targets:
+            if target not in found:
+                status = 'not_found'
+            elif target == user.id or (target in follow
+                                       and target in unfollow):
+                status = 'invalid'
+            elif action == 'follow':
+                status = 'already_following' if target in following \
+                    else 'followed'
+                if status == 'followed':
+                    user.followed.append(found[target])
+                    following.add(target)
+            else:
+                status = 'unfollowed' if target in following \
+                    else 'not_following'
+                if status == 'unfollowed':
+                    user.followed.remove(found[target])
+                    following.discard(target)
+            results.append({'id': target, 'status': status})
+    db.session.commit()
+    return json_response({'items': results})
+
+
+@bp.route('/users/complete', methods=['GET'])
+@token_auth.login_required
+def complete_usernames():
+    '''
+    Usernames starting with ?prefix=, for @-mention autocomplete, and
+    whether the prefix itself is free to register. Served from memory,
+    see app/usernames.py.
+    '''
+    prefix = request.args.get('prefix', '')
+    if not prefix:
+        return bad_request('must include a prefix')
+    limit = min(request.args.get('limit', 10, type=int),
+                current_app.config['USERNAME_COMPLETIONS'])
+    items = [{
+        'id': id,
+        'username': username
+    } for id, username in current_app.usernames.complete(prefix, limit)]
+    return json_response({
+        'items': items,
+        'available': current_app.usernames.available(prefix)
+    })
 
 
 @bp.route('/users', methods=['POST'])
@@ -63,16 +213,21 @@ def create_user():
     # Verify sign up credentials.
     if 'username' not in data or 'email' not in data or 'password' not in data:
         return bad_request('must include username, email, and password fields')
-    if User.query.filter_by(username=data['username']).first():
+    if not current_app.usernames.available(data['username']):
         return bad_request('please use a different username')
-    if User.query.filter_by(email=data['email']).first():
+    if not current_app.usernames.email_available(data['email']):
         return bad_request('please use a different email address')
 
     # Make the new user and commit to database.
     user = User()
     user.from_dict(data, new_user=True)
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Taken in another process since our index last looked.
+        db.session.rollback()
+        return bad_request('please use a different username or email address')
 
     # Format and return response.
     response = jsonify(user.to_dict())
@@ -98,13 +253,17 @@ def update_user(id):
 
     # Verify user credentials.
     if 'username' in data and data['username'] != user.username and \
-        User.query.filter_by(username=data['username']).first():
+        not current_app.usernames.available(data['username']):
         return bad_request('please use a different username')
     if 'email' in data and data['email'] != user.email and \
-        User.query.filter_by(email=data['email']).first():
+        not current_app.usernames.email_available(data['email']):
         return bad_request('please use a different email address')
 
     # Grab the user data, which has the changed information.
     user.from_dict(data, new_user=False)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return bad_request('please use a different username or email address')
     return jsonify(user.to_dict())
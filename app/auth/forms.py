@@ -1,8 +1,8 @@
+from flask import current_app
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, ValidationError, Email, EqualTo
 from flask_babel import _, lazy_gettext as _l
-from app.models import User
 
 
 class LoginForm(FlaskForm):
@@ -31,16 +31,15 @@ class RegistrationForm(FlaskForm):
     named validate_*. These are invoked in addition to the stock validators above.
     '''
 
-    # Make sure user doesn't already exist.
+    # Make sure user doesn't already exist. Names nobody ever used are
+    # answered from memory, see app/usernames.py.
     def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
+        if not current_app.usernames.available(username.data):
             raise ValidationError(_('Please use a different username.'))
 
     # Make sure email doesn't already exist.
     def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user is not None:
+        if not current_app.usernames.email_available(email.data):
             raise ValidationError(_('Please use a different email address.'))
 
 
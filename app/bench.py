@@ -0,0 +1,658 @@
+'''
+Synthetic data and timings for the hot routes. tests.py only ever sees a
+handful of users, which says nothing about how followed_posts(), explore
+or the API behave once the tables are big. The functions here back the
+'flask bench' commands in cli.py.
+
+Always point DATABASE_URL at a scratch database before seeding, this writes
+a lot of rows.
+'''
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+from sqlalchemy import Table, create_engine, exc
+from werkzeug.security import generate_password_hash
+from app import db, shards
+from app.models import User, Post, Message, Notification, followers, \
+    avatar_digest, avatar_url
+from app import sqlite
+
+# Rows per executemany. Big enough to amortize the round trip, small enough
+# to not build the whole dataset in memory.
+CHUNK = 10000
+
+
+def _power_law(first_id, count, alpha, rng):
+    '''
+    Return a function that picks k user ids where id rank r has weight
+    1 / r^alpha. A few accounts end up with most of the followers, messages
+    and posts, like on the real site.
+    '''
+    ids = list(range(first_id, first_id + count))
+    cum_weights = list(
+        itertools.accumulate(1.0 / (r**alpha) for r in range(1, count + 1)))
+
+    def pick(k):
+        return rng.choices(ids, cum_weights=cum_weights, k=k)
+
+    return pick
+
+
+def _insert(mapper, rows):
+    '''Bulk insert a generator of dicts, CHUNK rows at a time.'''
+    total = 0
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK))
+        if not chunk:
+            return total
+        if isinstance(mapper, Table):
+            db.session.execute(mapper.insert(), chunk)
+        else:
+            db.session.bulk_insert_mappings(mapper, chunk)
+        total += len(chunk)
+
+
+def seed(users, posts, follows, messages, notifications, alpha=1.1,
+         days=365, random_seed=None):
+    '''
+    Fill the database with synthetic data. Returns a dict of how many rows
+    of each kind were written and how long it took.
+    '''
+    if shards.enabled():
+        # Bulk inserts skip the per object routing that puts rows on their
+        # shard.
+        raise RuntimeError('seed without DATABASE_SHARD_URLS, then run '
+                           '"flask shards migrate"')
+    rng = random.Random(random_seed)
+    db.create_all()
+    if db.engine.dialect.name == 'sqlite':
+        # Everything goes in one transaction, so a crash means an empty
+        # scratch database, not a corrupt one. Skip the fsyncs.
+        db.session.execute('PRAGMA synchronous=OFF')
+    start = time.perf_counter()
+    # Assign ids ourselves so follows and posts can reference users without
+    # reading them back.
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    now = datetime.utcnow()
+    # Hashing is the slow part of making a user, and every bench user
+    # can share the same password.
+    password_hash = generate_password_hash('bench')
+    pick = _power_law(first_id, users, alpha, rng)
+    span = days * 24 * 3600
+
+    def random_time():
+        return now - timedelta(seconds=rng.randrange(span))
+
+    counts = {}
+    counts['users'] = _insert(User, ({
+        'id': first_id + i,
+        'username': f'bench{first_id + i}',
+        'email': f'bench{first_id + i}@example.com',
+        # Bulk inserts skip the validator that sets this.
+        'avatar_hash': avatar_digest(f'bench{first_id + i}@example.com'),
+        'password_hash': password_hash,
+        'about_me': 'Synthetic user',
+        'last_seen': random_time()
+    } for i in range(users)))
+
+    # Can't ask for more distinct pairs than exist.
+    follows = min(follows, users * (users - 1))
+
+    def follow_rows():
+        # Followers are uniform, the followed are power law distributed.
+        seen = set()
+        while len(seen) < follows:
+            follower = first_id + rng.randrange(users)
+            for followed in pick(min(CHUNK, follows - len(seen))):
+                pair = (follower, followed)
+                if follower == followed or pair in seen:
+                    continue
+                seen.add(pair)
+                yield {'follower_id': follower, 'followed_id': followed}
+                follower = first_id + rng.randrange(users)
+
+    counts['follows'] = _insert(followers, follow_rows())
+
+    def post_rows():
+        for i in range(posts):
+            author = pick(1)[0]
+            yield {
+                'body': f'Post {i} from bench{author}',
+                'user_id': author,
+                'timestamp': random_time(),
+                'language': 'en'
+            }
+
+    counts['posts'] = _insert(Post, post_rows())
+
+    def message_rows():
+        for i in range(messages):
+            yield {
+                'sender_id': first_id + rng.randrange(users),
+                'recipient_id': pick(1)[0],
+                'body': f'Message {i}',
+                'timestamp': random_time()
+            }
+
+    counts['messages'] = _insert(Message, message_rows())
+
+    def notification_rows():
+        for i in range(notifications):
+            yield {
+                'name': 'unread_message_count',
+                'user_id': first_id + rng.randrange(users),
+                'timestamp': time.time() - rng.randrange(span),
+                'payload_json': json.dumps(rng.randrange(100))
+            }
+
+    counts['notifications'] = _insert(Notification, notification_rows())
+    db.session.commit()
+    counts['seconds'] = round(time.perf_counter() - start, 2)
+    return counts
+
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[int(round(q * (len(ordered) - 1)))]
+
+
+def run(app, repeat=20, username=None):
+    '''
+    Time the hot routes through the test client. Returns a dict keyed by
+    endpoint with p50/p99 latency in milliseconds and the SQL query count.
+    '''
+    # The most followed synthetic user is the worst case for most pages.
+    user = User.query.filter_by(username=username).first() if username \
+        else User.query.order_by(User.id).first()
+    if user is None:
+        raise RuntimeError('no users, run "flask bench seed" first')
+    # Grab plain values now. Each test client request tears down the
+    # session, so ORM objects don't survive past the first request.
+    user_id, name = user.id, user.username
+    token = user.get_token()
+    db.session.commit()
+
+    routes = [
+        ('main.index', '/index'),
+        ('main.explore', '/explore'),
+        ('main.user', f'/user/{name}'),
+        ('main.user_popup', f'/user/{name}/popup'),
+        ('main.messages', '/messages'),
+        ('api.get_users', '/api/users'),
+        ('api.get_user', f'/api/users/{user_id}'),
+        ('api.get_followers', f'/api/users/{user_id}/followers'),
+        ('api.get_followed', f'/api/users/{user_id}/followed'),
+        ('api.get_posts', '/api/posts'),
+        ('api.get_timeline', '/api/timeline'),
+    ]
+    if app.elasticsearch:
+        routes.append(('main.search', '/search?q=post'))
+
+    statements = []
+
+    def count_query(conn, cursor, statement, parameters, context,
+                    executemany):
+        statements.append(statement)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        # Same keys the pinned Flask-Login's login_user() sets.
+        session['user_id'] = str(user_id)
+        session['_fresh'] = True
+    headers = {'Authorization': f'Bearer {token}'}
+
+    results = {}
+    db.event.listen(db.engine, 'before_cursor_execute', count_query)
+    try:
+        for endpoint, url in routes:
+            timings, queries = [], 0
+            # One untimed request to warm up caches and the pool.
+            client.get(url, headers=headers)
+            for _ in range(repeat):
+                del statements[:]
+                start = time.perf_counter()
+                response = client.get(url, headers=headers)
+                timings.append((time.perf_counter() - start) * 1000)
+                queries = max(queries, len(statements))
+            results[endpoint] = {
+                'url': url,
+                'status': response.status_code,
+                'p50_ms': round(_percentile(timings, 0.50), 3),
+                'p99_ms': round(_percentile(timings, 0.99), 3),
+                'queries': queries
+            }
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', count_query)
+    return results
+
+
+def _writer(url, config, seconds, user_ids, results):
+    '''
+    One simulated gunicorn worker: each "request" bumps last_seen and
+    writes a post in its own transaction, as fast as it can.
+    '''
+    engine = create_engine(url)
+    if config is not None:
+        sqlite.apply_profile(engine, config)
+    users, posts = User.__table__, Post.__table__
+    rng = random.Random()
+    commits, locked, latencies = 0, 0, []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        user_id = rng.choice(user_ids)
+        start = time.perf_counter()
+        try:
+            with engine.begin() as conn:
+                conn.execute(users.update().where(users.c.id == user_id),
+                             last_seen=datetime.utcnow())
+                conn.execute(posts.insert(), body='concurrent write',
+                             user_id=user_id, timestamp=datetime.utcnow())
+        except exc.OperationalError:
+            # "database is locked" once the busy timeout runs out.
+            locked += 1
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+        commits += 1
+    results.put((commits, locked, latencies))
+
+
+def sqlite_writers(config, workers=4, seconds=5, users=100):
+    '''
+    Hammer a scratch SQLite file from several processes, with the profile
+    from sqlite.py off and then on. Returns commits per second, "database
+    is locked" errors and commit latency for each.
+    '''
+    report = {}
+    for name, profile in [('off', None), ('on', config)]:
+        tmp = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        try:
+            engine = create_engine(url)
+            db.metadata.create_all(engine, tables=[
+                User.__table__, Post.__table__])
+            engine.execute(User.__table__.insert(), [{
+                'id': i,
+                'username': f'writer{i}',
+                'email': f'writer{i}@example.com'
+            } for i in range(1, users + 1)])
+            engine.dispose()
+            results = multiprocessing.Queue()
+            procs = [
+                multiprocessing.Process(
+                    target=_writer,
+                    args=(url, profile, seconds, range(1, users + 1),
+                          results)) for _ in range(workers)
+            ]
+            for proc in procs:
+                proc.start()
+            # Drain before joining, a child with queued data won't exit.
+            outcomes = [results.get() for _ in procs]
+            for proc in procs:
+                proc.join()
+        finally:
+            shutil.rmtree(tmp)
+        commits = sum(o[0] for o in outcomes)
+        latencies = [ms for o in outcomes for ms in o[2]] or [0]
+        report[name] = {
+            'commits_per_second': round(commits / seconds, 1),
+            'locked_errors': sum(o[1] for o in outcomes),
+            'p50_ms': round(_percentile(latencies, 0.50), 3),
+            'p99_ms': round(_percentile(latencies, 0.99), 3)
+        }
+    return report
+
+
+def serializers(app, per_page=100, repeat=20):
+    '''
+    Items per second for a page of /api/users through the old path
+    (to_collection_dict and jsonify) and the projection path in
+    api/serializers.py.
+    '''
+    from flask import jsonify
+    from app.api.serializers import user_collection, json_response
+
+    def old():
+        return jsonify(
+            User.to_collection_dict(User.query, 1, per_page,
+                                    'api.get_users')).get_data()
+
+    def new():
+        return json_response(
+            user_collection(User.query, 1, per_page,
+                            'api.get_users')).get_data()
+
+    statements = []
+
+    def count_query(conn, cursor, statement, parameters, context,
+                    executemany):
+        statements.append(statement)
+
+    report = {}
+    with app.test_request_context():
+        items = len(User.query.limit(per_page).all())
+        db.event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            for name, serialize in [('to_dict', old), ('projection', new)]:
+                serialize()
+                del statements[:]
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    size = len(serialize())
+                seconds = time.perf_counter() - start
+                report[name] = {
+                    'items_per_second': round(items * repeat / seconds),
+                    'queries': len(statements) // repeat,
+                    'bytes': size
+                }
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_query)
+    return report
+
+
+# What each kind of process imports and runs before it can do any work.
+STARTUP_TARGETS = {
+    # A gunicorn worker loading the app.
+    'web': 'from app import create_app; create_app()',
+    # An rq work horse importing the task module.
+    'tasks': 'import app.tasks',
+    # The flask command, with its plugins, listing commands.
+    'flask': 'import sys; from flask.cli import main; '
+    'sys.argv = ["flask", "--help"]; main()',
+}
+
+
+def avatars(app, per_page=100, repeat=1000):
+    '''
+    Avatar URLs per second for a page of per_page users, hashing the email
+    each time like avatar() used to, and from the stored avatar_hash.
+    '''
+    with app.app_context():
+        rows = db.session.query(User.email, User.avatar_hash).filter(
+            User.email.isnot(None)).order_by(User.id).limit(per_page).all()
+    if not rows:
+        raise RuntimeError('no users, run "flask bench seed" first')
+    ways = [
+        ('email', lambda: [avatar_url(avatar_digest(r.email), 128)
+                           for r in rows]),
+        ('avatar_hash', lambda: [avatar_url(r.avatar_hash, 128)
+                                 for r in rows]),
+    ]
+    report = {}
+    for name, page in ways:
+        page()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            page()
+        seconds = time.perf_counter() - start
+        report[name] = {
+            'urls_per_second': round(len(rows) * repeat / seconds),
+            'page_microseconds': round(seconds / repeat * 1e6, 1)
+        }
+    return report
+
+
+def _python(args, root):
+    return subprocess.run([sys.executable] + args,
+                          cwd=root,
+                          env=dict(os.environ, FLASK_APP='microblog.py'),
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True,
+                          check=True)
+
+
+def import_times(root, target='web', top=25):
+    '''
+    Run a target in a fresh interpreter under python -X importtime and
+    return its slowest imports as (cumulative ms, self ms, module), by
+    cumulative time. Nested imports count towards their parents.
+    '''
+    result = _python(['-X', 'importtime', '-c', STARTUP_TARGETS[target]],
+                     root)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, module = line[len('import time:'):].split('|')
+        rows.append((round(int(cumulative) / 1000, 1),
+                     round(int(own) / 1000, 1), module.rstrip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+def startup(root, repeat=5):
+    '''
+    Wall clock of a fresh process for each target in STARTUP_TARGETS,
+    interpreter start included. Returns min and median in milliseconds.
+    '''
+    report = {}
+    for name, code in STARTUP_TARGETS.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            _python(['-c', code], root)
+            timings.append((time.perf_counter() - start) * 1000)
+        report[name] = {
+            'min_ms': round(min(timings), 1),
+            'median_ms': round(statistics.median(timings), 1)
+        }
+    return report
+
+
+def _children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def _memory(pid):
+    '''
+    Unique and proportional set size of a process in KiB. USS is what only
+    this process uses, PSS also counts a share of the pages it shares.
+    '''
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'uss_kb': fields['Private_Clean'] + fields['Private_Dirty'],
+        'pss_kb': fields['Pss']
+    }
+
+
+def _wait_for(server, url, name):
+    '''Wait until server answers url, for up to a minute.'''
+    deadline = time.time() + 60
+    while True:
+        try:
+            urllib.request.urlopen(url).read()
+            return
+        except OSError:
+            if time.time() > deadline or server.poll() is not None:
+                raise RuntimeError(f'gunicorn ({name}) did not start')
+            time.sleep(0.2)
+
+
+def worker_memory(root, workers=4, requests=200, port=5099):
+    '''
+    Start gunicorn with its defaults (like the old Procfile) and then with
+    gunicorn.conf.py, send each some traffic, and measure the memory of
+    every worker. Linux only, it reads /proc.
+    '''
+    gunicorn = [
+        sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()'
+    ]
+    profiles = {
+        'default': ['-c', os.devnull],
+        'preforked': ['-c', os.path.join(root, 'gunicorn.conf.py')]
+    }
+    report = {}
+    for name, config in profiles.items():
+        server = subprocess.Popen(
+            gunicorn + config + [
+                '--bind', f'127.0.0.1:{port}', '--workers',
+                str(workers), 'microblog:app'
+            ],
+            cwd=root,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        try:
+            url = f'http://127.0.0.1:{port}/auth/login'
+            _wait_for(server, url, name)
+            for _ in range(requests):
+                urllib.request.urlopen(url).read()
+            usage = [_memory(pid) for pid in _children(server.pid)]
+        finally:
+            server.terminate()
+            server.wait()
+        report[name] = {
+            'workers': len(usage),
+            'uss_kb_per_worker': round(
+                statistics.mean(u['uss_kb'] for u in usage)),
+            'pss_kb_per_worker': round(
+                statistics.mean(u['pss_kb'] for u in usage))
+        }
+    return report
+
+
+def _timed(request):
+    '''(status, milliseconds) of a urllib request, errors included.'''
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, (time.perf_counter() - start) * 1000
+
+
+def login_burst(root, username, password='bench', workers=4, logins=64,
+                seconds=10, port=5098):
+    '''
+    Hammer a gunicorn with API sign ins (POST /api/tokens, which checks
+    the password) from logins threads, while timing a cheap page
+    (/auth/login) from another. Once with the hashing limits of
+    app/passwords.py out of the way, once with the configured ones.
+    Returns the page latency and how the sign ins went for each.
+    '''
+    import base64
+    import threading
+    gunicorn = [
+        sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+        '-c', os.path.join(root, 'gunicorn.conf.py')
+    ]
+    profiles = {
+        'unlimited': {
+            'PASSWORD_HASH_CONCURRENCY': str(logins),
+            'PASSWORD_HASH_QUEUE': str(logins),
+            'PASSWORD_HASH_WAIT': '60'
+        },
+        'limited': {}
+    }
+    credentials = base64.b64encode(
+        f'{username}:{password}'.encode('utf-8')).decode('ascii')
+    report = {}
+    for name, env in profiles.items():
+        server = subprocess.Popen(
+            gunicorn + ['--bind', f'127.0.0.1:{port}', '--workers',
+                        str(workers), 'microblog:app'],
+            cwd=root,
+            env=dict(os.environ, **env),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        try:
+            page = f'http://127.0.0.1:{port}/auth/login'
+            _wait_for(server, page, name)
+            deadline = time.time() + seconds
+            statuses, pages = [], []
+
+            def sign_in():
+                while time.time() < deadline:
+                    statuses.append(_timed(urllib.request.Request(
+                        f'http://127.0.0.1:{port}/api/tokens',
+                        method='POST',
+                        headers={'Authorization': f'Basic {credentials}'}))[0])
+
+            def browse():
+                while time.time() < deadline:
+                    pages.append(_timed(page)[1])
+
+            threads = [threading.Thread(target=sign_in)
+                       for _ in range(logins)]
+            threads.append(threading.Thread(target=browse))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.terminate()
+            server.wait()
+        report[name] = {
+            'page_p50_ms': round(_percentile(pages, 0.50), 1),
+            'page_p99_ms': round(_percentile(pages, 0.99), 1),
+            'pages': len(pages),
+            'sign_ins': statuses.count(200),
+            'shed': statuses.count(503),
+            'other': len(statuses) - statuses.count(200) -
+            statuses.count(503)
+        }
+    return report
+
+
+def tiny_job():
+    '''The smallest realistic task: get the app and ask the database.'''
+    from app.tasks import get_app
+    get_app()
+    return db.session.execute('SELECT 1').scalar()
+
+
+def tiny_jobs(app, root, jobs=500, concurrency=2):
+    '''
+    Jobs per second for tiny jobs on the stock forking 'rq worker' and on
+    'flask worker' (app/worker.py). Both run in burst mode on a scratch
+    queue until it is empty. Needs Redis.
+    '''
+    import rq
+    queue = rq.Queue('microblog-bench', connection=app.redis)
+    commands = {
+        'rq worker': [
+            '-c', 'from rq.cli import main; main()', 'worker', '--burst',
+            '--url', app.config['REDIS_URL'], queue.name
+        ],
+        'flask worker': [
+            '-c', 'from flask.cli import main; main()', 'worker', '--burst',
+            '--queue', queue.name, '--concurrency',
+            str(concurrency)
+        ],
+    }
+    report = {}
+    for name, args in commands.items():
+        queue.empty()
+        for _ in range(jobs):
+            queue.enqueue(tiny_job)
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args,
+                       cwd=root,
+                       env=dict(os.environ, FLASK_APP='microblog.py'),
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=True)
+        seconds = time.perf_counter() - start
+        report[name] = {
+            'jobs_per_second': round(jobs / seconds, 1),
+            'seconds': round(seconds, 2)
+        }
+    return report
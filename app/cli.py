@@ -3,7 +3,9 @@ Add custom commands to Flask to run tasks.
 Click is used for command-line operations.
 '''
 import os
+import json
 import click
+from app.queues import QUEUES, pool_queues
 '''
 current_app does not work in this case because these commands are registered at start up, not during the handling of a request, which is the only time when current_app can be used. To remove the reference to app in this module, this trick  moves these custom commands inside a register() function that takes the app instance as an argument.
 '''
@@ -49,4 +51,233 @@ def register(app):
         if os.system('pybabel init -i messages.pot -d app/translations -l ' +
                      lang):
             raise RuntimeError('init command failed')
-        os.remove('messages.pot')
\ No newline at end of file
+        os.remove('messages.pot')
+
+    @app.cli.group()
+    def bench():
+        """Synthetic data and performance benchmarks."""
+        pass
+
+    """flask bench seed"""
+    @bench.command()
+    @click.option('--users', default=10000, help='Users to create.')
+    @click.option('--posts', default=1000000, help='Posts to create.')
+    @click.option('--follows', default=200000, help='Follow pairs to create.')
+    @click.option('--messages', default=50000, help='Messages to create.')
+    @click.option('--notifications', default=10000,
+                  help='Notifications to create.')
+    @click.option('--alpha', default=1.1,
+                  help='Power law exponent for popularity.')
+    @click.option('--seed', 'random_seed', type=int, help='Random seed.')
+    def seed(users, posts, follows, messages, notifications, alpha,
+             random_seed):
+        """Bulk insert a synthetic dataset."""
+        from app.bench import seed as seed_data
+        counts = seed_data(users, posts, follows, messages, notifications,
+                           alpha=alpha, random_seed=random_seed)
+        click.echo(json.dumps(counts))
+
+    """flask bench run"""
+    @bench.command(name='run')
+    @click.option('--repeat', default=20, help='Timed requests per route.')
+    @click.option('--user', 'username', help='User to browse as.')
+    @click.option('--label', default='', help='Tag for the results, like a '
+                  'commit hash.')
+    @click.option('--output', type=click.File('w'), default='-',
+                  help='Where to write the JSON report.')
+    def bench_run(repeat, username, label, output):
+        """Time the hot routes and report p50/p99 and query counts."""
+        from app.bench import run as run_bench
+        results = run_bench(app, repeat=repeat, username=username)
+        json.dump({'label': label, 'repeat': repeat, 'routes': results},
+                  output, indent=4)
+        output.write('\n')
+
+    """flask bench sqlite"""
+    @bench.command()
+    @click.option('--workers', default=4, help='Writer processes.')
+    @click.option('--seconds', default=5, help='How long each run lasts.')
+    def sqlite(workers, seconds):
+        """Concurrent writers on SQLite with SQLITE_PROFILE off and on."""
+        from app.bench import sqlite_writers
+        report = sqlite_writers(app.config, workers=workers, seconds=seconds)
+        click.echo(json.dumps(report, indent=4))
+
+    """flask bench api"""
+    @bench.command()
+    @click.option('--per-page', default=100, help='Users per page.')
+    @click.option('--repeat', default=20, help='Timed pages per path.')
+    def api(per_page, repeat):
+        """Compare to_dict() and projection serialization of /api/users."""
+        from app.bench import serializers
+        click.echo(json.dumps(serializers(app, per_page, repeat), indent=4))
+
+    """flask bench avatars"""
+    @bench.command()
+    @click.option('--per-page', default=100, help='Users per page.')
+    @click.option('--repeat', default=1000, help='Timed pages per way.')
+    def avatars(per_page, repeat):
+        """Avatar URLs per second, hashing emails vs avatar_hash."""
+        from app.bench import avatars as time_avatars
+        click.echo(json.dumps(time_avatars(app, per_page, repeat), indent=4))
+
+    """flask bench importtime"""
+    @bench.command()
+    @click.option('--target', default='web',
+                  type=click.Choice(['web', 'tasks', 'flask']),
+                  help='Which kind of process to profile.')
+    @click.option('--top', default=25, help='How many imports to show.')
+    def importtime(target, top):
+        """Slowest imports of a cold start, like python -X importtime."""
+        from app.bench import import_times
+        click.echo(f'{"cumulative ms":>14} {"self ms":>8}  module')
+        for cumulative, own, module in import_times(
+                os.path.dirname(app.root_path), target, top):
+            click.echo(f'{cumulative:>14} {own:>8} {module}')
+
+    """flask bench startup"""
+    @bench.command()
+    @click.option('--repeat', default=5, help='Cold starts per target.')
+    def startup(repeat):
+        """Time cold starts of a web worker, task worker and flask."""
+        from app.bench import startup as time_startup
+        click.echo(json.dumps(
+            time_startup(os.path.dirname(app.root_path), repeat), indent=4))
+
+    """flask bench memory"""
+    @bench.command()
+    @click.option('--workers', default=4, help='Gunicorn workers.')
+    @click.option('--requests', default=200, help='Requests before measuring.')
+    @click.option('--port', default=5099, help='Port to serve on meanwhile.')
+    def memory(workers, requests, port):
+        """Memory per gunicorn worker, default settings vs preforked."""
+        from app.bench import worker_memory
+        click.echo(json.dumps(
+            worker_memory(os.path.dirname(app.root_path), workers, requests,
+                          port), indent=4))
+
+    """flask bench logins"""
+    @bench.command()
+    @click.option('--user', 'username', default=None,
+                  help='User to sign in as, a seeded one by default.')
+    @click.option('--password', default='bench', help='Their password.')
+    @click.option('--workers', default=4, help='Gunicorn workers.')
+    @click.option('--logins', default=64, help='Concurrent sign ins.')
+    @click.option('--seconds', default=10, help='How long each run lasts.')
+    @click.option('--port', default=5098, help='Port to serve on meanwhile.')
+    def logins(username, password, workers, logins, seconds, port):
+        """Page latency during a sign in burst, hash limits off vs on."""
+        from app.bench import login_burst
+        from app.models import User
+        if username is None:
+            user = User.query.filter(User.username.like('bench%')).first()
+            if user is None:
+                raise click.ClickException(
+                    'no users, run "flask bench seed" first')
+            username = user.username
+        click.echo(json.dumps(
+            login_burst(os.path.dirname(app.root_path), username, password,
+                        workers, logins, seconds, port), indent=4))
+
+    """flask bench jobs"""
+    @bench.command()
+    @click.option('--jobs', default=500, help='Tiny jobs to run.')
+    @click.option('--concurrency', default=2, help='Warm worker processes.')
+    def jobs(jobs, concurrency):
+        """Tiny job throughput, stock rq worker vs flask worker."""
+        from app.bench import tiny_jobs
+        click.echo(json.dumps(
+            tiny_jobs(app, os.path.dirname(app.root_path), jobs,
+                      concurrency), indent=4))
+
+    @app.cli.group()
+    def shards():
+        """Sharded post and message storage."""
+        pass
+
+    """flask shards migrate"""
+    @shards.command()
+    @click.option('--batch', default=5000, help='Rows moved per batch.')
+    def migrate(batch):
+        """Move posts and messages to the shards they belong on."""
+        from app import db
+        from app.models import IdTicket
+        from app.shards import enabled, redistribute
+        if not enabled():
+            raise click.UsageError('DATABASE_SHARD_URLS is not set')
+        highest = redistribute(db, batch_size=batch, log=click.echo)
+        # New rows get ids from the ticket table, which must start after
+        # every id that already exists.
+        IdTicket.reserve(highest)
+        db.session.commit()
+
+    """flask worker"""
+    @app.cli.command()
+    @click.option('--pool', 'pools', multiple=True,
+                  type=click.Choice(QUEUES),
+                  help='Pool to run, can be given more than once. '
+                  'Defaults to every pool in WORKER_POOLS.')
+    @click.option('--queue', 'queues', multiple=True,
+                  help='Run a single pool on these rq queues instead, '
+                  'can be given more than once.')
+    @click.option('--concurrency', type=int,
+                  help='Processes per pool, WORKER_POOLS by default.')
+    @click.option('--burst', is_flag=True,
+                  help='Exit once the queues are empty.')
+    @click.option('--max-jobs', default=1000,
+                  help='Jobs a process runs before it is replaced.')
+    def worker(pools, queues, concurrency, burst, max_jobs):
+        """Run background jobs in warm, preforked rq workers."""
+        from app.worker import run
+        if queues:
+            workers = [(list(queues), concurrency or 1)]
+        else:
+            workers = [(pool_queues(name), concurrency
+                        or app.config['WORKER_POOLS'].get(name, 0))
+                       for name in pools or QUEUES]
+        run(app, workers, burst=burst, max_jobs=max_jobs, log=click.echo)
+
+    """flask queues"""
+    @app.cli.command()
+    @click.option('--sample', default=100,
+                  help='Finished jobs per queue to take wait times from.')
+    def queues(sample):
+        """How long jobs wait on each rq queue."""
+        from app.queues import latency_report
+        click.echo(json.dumps(latency_report(app, sample), indent=4))
+
+    @app.cli.group()
+    def scheduler():
+        """Periodic housekeeping jobs."""
+        pass
+
+    """flask scheduler run"""
+    @scheduler.command(name='run')
+    def scheduler_run():
+        """Queue the housekeeping jobs as they come due, forever."""
+        from app.maintenance import run_scheduler
+        run_scheduler(app, log=click.echo)
+
+    """flask scheduler once"""
+    @scheduler.command()
+    @click.argument('name')
+    def once(name):
+        """Run one housekeeping job right here, without rq."""
+        from app.maintenance import JOBS
+        if name not in JOBS:
+            raise click.UsageError(
+                f'no job {name}, try one of: {", ".join(JOBS)}')
+        click.echo(f'{name}: {JOBS[name][0]()} rows')
+
+    @app.cli.group()
+    def terms():
+        """Hashtag and mention index."""
+        pass
+
+    """flask terms backfill"""
+    @terms.command()
+    @click.option('--batch', default=1000, help='Posts read per batch.')
+    def backfill(batch):
+        """Index the hashtags and mentions of every existing post."""
+        from app.terms import backfill
+        click.echo(f'{backfill(batch_size=batch, log=click.echo)} posts')
@@ -0,0 +1,58 @@
+'''
+Cursor pagination for post timelines. A cursor holds the (timestamp, id)
+of the last post sent, and the next page starts right after it. Unlike
+OFFSET, that costs the same on page 1000 as on page 1, and posts arriving
+in between don't shift the pages around.
+
+Works on anything with filter(), order_by(), limit() and all(): queries,
+shards.Timeline and terms.Tagged. A source can name the columns to
+paginate on in cursor_keys, otherwise it's Post.timestamp and Post.id.
+'''
+import base64
+import binascii
+from datetime import datetime
+import orjson
+from app import db
+from app.models import Post
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode(post):
+    return base64.urlsafe_b64encode(
+        orjson.dumps([post.timestamp.strftime(TIME_FORMAT),
+                      post.id])).decode('ascii')
+
+
+def decode(cursor):
+    '''(timestamp, id) from a cursor, or None if it isn't valid.'''
+    try:
+        timestamp, id = orjson.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.strptime(timestamp, TIME_FORMAT), int(id)
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError):
+        return None
+
+
+def page(source, cursor, limit):
+    '''
+    Up to limit posts from source, newest first, after cursor (None for
+    the first page). Returns the posts and the cursor of the next page, or
+    None if this is the last one. Raises ValueError for a bad cursor.
+    '''
+    timestamp_key, id_key = getattr(source, 'cursor_keys',
+                                    (Post.timestamp, Post.id))
+    source = source.order_by(None).order_by(timestamp_key.desc(),
+                                            id_key.desc())
+    if cursor:
+        after = decode(cursor)
+        if after is None:
+            raise ValueError('invalid cursor')
+        timestamp, id = after
+        source = source.filter(
+            db.or_(timestamp_key < timestamp,
+                   db.and_(timestamp_key == timestamp, id_key < id)))
+    # One extra row tells us if there is a next page without a COUNT.
+    posts = source.limit(limit + 1).all()
+    if len(posts) > limit:
+        return posts[:limit], encode(posts[limit - 1])
+    return posts, None
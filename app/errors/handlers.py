@@ -1,4 +1,4 @@
-from flask import render_template, request
+from flask import render_template, request, current_app
 from app import db
 from app.errors import bp
 from app.api.errors import error_response as api_error_response
@@ -19,6 +19,30 @@ def not_found_error(error):
     return render_template('errors/404.html'), 404
 
 
+# Throttled from app/limits.py and Overloaded from app/passwords.py, or
+# any other 429 or 503. Retry-After tells clients when to come back.
+def retry_later(error, status_code):
+    if wants_json_response():
+        response = api_error_response(status_code, error.description)
+    else:
+        response = current_app.make_response(
+            (render_template('errors/503.html'), status_code))
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+    return retry_later(error, 429)
+
+
+@bp.app_errorhandler(503)
+def unavailable_error(error):
+    return retry_later(error, 503)
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     '''
@@ -0,0 +1,227 @@
+'''
+Load shedding for the expensive routes. Search, translations, exports and
+the API collections can each keep a worker busy for a long time, and
+under load they used to queue up in front of everything else. Now every
+route named in RATE_LIMITS, by endpoint or by blueprint, gets two checks
+before the view runs:
+
+    - A token bucket per user (signed in, or by API token), or per address
+      for everyone else. It holds up to 'burst' requests and refills at
+      'rate' per second. An empty bucket is a 429.
+    - A cap of 'concurrency' requests running at once per endpoint, over
+      all the workers. A full endpoint is a 503.
+
+Both fail right away, with a Retry-After header, instead of waiting. Shed
+requests are counted in microblog_requests_shed_total.
+
+With RATE_LIMIT_STORE=redis (the default) buckets and counts are shared
+by every worker, with a Lua script each so they stay atomic. If Redis
+fails the checks fall back to this process's own counts for
+RATE_LIMIT_FALLBACK seconds, looser but still something. 'memory' always
+uses them, and 'off' skips the checks.
+'''
+import math
+import threading
+import time
+import uuid
+from flask import request, g
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+from app.passwords import Overloaded
+
+# KEYS[1]: the bucket. ARGV: rate, burst, now, ttl. Returns the seconds to
+# wait for a token, 0 if one was taken.
+TAKE = '''
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'time', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return tostring(wait)
+'''
+# KEYS[1]: a sorted set of the requests running, by start time. ARGV: this
+# request, now, seconds after which a request is assumed dead, limit.
+# Returns 1 if admitted.
+ENTER = '''
+local now = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[3]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+'''
+
+
+class Throttled(TooManyRequests):
+    '''A 429 the error handlers send with a Retry-After header.'''
+    def __init__(self, description=None, retry_after=1):
+        super(Throttled, self).__init__(description)
+        self.retry_after = retry_after
+
+
+class MemoryStore(object):
+    '''The same as RedisStore, for this process only.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.running = {}
+
+    def take(self, key, rate, burst, now, ttl):
+        with self.lock:
+            tokens, last = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(0, now - last) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > 10000:
+                # A full bucket is the same as no bucket.
+                for k in [k for k, (_, t) in self.buckets.items()
+                          if t < now - ttl]:
+                    del self.buckets[k]
+            return wait
+
+    def enter(self, key, id, limit, now, stale):
+        with self.lock:
+            running = self.running.setdefault(key, set())
+            if len(running) >= limit:
+                return False
+            running.add(id)
+            return True
+
+    def leave(self, key, id):
+        with self.lock:
+            self.running.get(key, set()).discard(id)
+
+
+class RedisStore(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self._take = redis.register_script(TAKE)
+        self._enter = redis.register_script(ENTER)
+
+    def take(self, key, rate, burst, now, ttl):
+        return float(self._take(keys=['microblog-limit:' + key],
+                                args=[rate, burst, now, ttl]))
+
+    def enter(self, key, id, limit, now, stale):
+        return bool(self._enter(keys=['microblog-running:' + key],
+                                args=[id, now, stale, limit]))
+
+    def leave(self, key, id):
+        self.redis.zrem('microblog-running:' + key, id)
+
+
+class Limits(object):
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self.memory = MemoryStore()
+        self._redis = None
+        self.fallback_until = 0
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def store(self):
+        if self.config['RATE_LIMIT_STORE'] == 'memory' or \
+                time.monotonic() < self.fallback_until:
+            return self.memory
+        if self._redis is None:
+            # Made on first use, app.redis may not be usable before that.
+            self._redis = RedisStore(self.app.redis)
+        return self._redis
+
+    def _call(self, method, *args):
+        '''store().method(*args), on the memory store if Redis fails.'''
+        import redis
+        store = self.store()
+        try:
+            return store, getattr(store, method)(*args)
+        except redis.exceptions.RedisError:
+            self.app.logger.exception('Rate limits fall back to memory')
+            self.fallback_until = time.monotonic() + \
+                self.config['RATE_LIMIT_FALLBACK']
+            return self.memory, getattr(self.memory, method)(*args)
+
+    def rule(self):
+        '''The (name, rule) that applies to this request, or None.'''
+        limits = self.config['RATE_LIMITS']
+        for name in (request.endpoint, request.blueprint):
+            if name in limits:
+                return name, limits[name]
+        return None
+
+    def client(self):
+        '''
+        Who this request's bucket belongs to. Only a verified user gets a
+        bucket of their own. Anything else, like a made up Authorization
+        header, shares the bucket of its address.
+        '''
+        scheme, _, token = request.headers.get('Authorization',
+                                               '').partition(' ')
+        if scheme.lower() == 'bearer' and token:
+            # The same check token_auth does, which leaves the user in g
+            # for the view.
+            from app.api.auth import verify_token
+            if verify_token(token):
+                return f'user:{g.current_user.id}'
+        if current_user.is_authenticated:
+            return f'user:{current_user.id}'
+        return f'ip:{request.remote_addr}'
+
+    def _shed(self, reason):
+        self.app.metrics.requests_shed.labels(request.endpoint,
+                                              reason).inc()
+
+    def admit(self):
+        if self.config['RATE_LIMIT_STORE'] == 'off' or \
+                request.endpoint is None:
+            return
+        found = self.rule()
+        if found is None:
+            return
+        name, rule = found
+        now = time.time()
+        if 'rate' in rule:
+            # Idle buckets refill completely in burst / rate seconds,
+            # there's no point keeping them longer.
+            ttl = math.ceil(rule['burst'] / rule['rate']) + 1
+            _, wait = self._call('take', f'{name}:{self.client()}',
+                                 rule['rate'], rule['burst'], now, ttl)
+            if wait > 0:
+                self._shed('rate')
+                raise Throttled('Slow down a little.', math.ceil(wait))
+        if 'concurrency' in rule:
+            id = uuid.uuid4().hex
+            store, admitted = self._call(
+                'enter', request.endpoint, id, rule['concurrency'], now,
+                self.config['RATE_LIMIT_STALE'])
+            if not admitted:
+                self._shed('concurrency')
+                raise Overloaded('Too busy right now, try again shortly.',
+                                 self.config['RATE_LIMIT_RETRY_AFTER'])
+            g.limit_slot = (store, request.endpoint, id)
+
+    def release(self, exc):
+        import redis
+        slot = g.pop('limit_slot', None)
+        if slot is not None:
+            store, key, id = slot
+            try:
+                store.leave(key, id)
+            except redis.exceptions.RedisError:
+                # It drops out after RATE_LIMIT_STALE seconds anyway.
+                self.app.logger.exception('Could not release a request slot')
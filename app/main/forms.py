@@ -1,9 +1,8 @@
-from flask import request
+from flask import request, current_app
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField
 from wtforms.validators import ValidationError, DataRequired, Length
 from flask_babel import _, lazy_gettext as _l
-from app.models import User
 
 
 # Allows the user to change their name and add an About Me text.
@@ -20,10 +19,9 @@ class EditProfileForm(FlaskForm):
         self.original_username = original_username
 
     def validate_username(self, username):
-        if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()
-            if user is not None:
-                raise ValidationError(_('Please use a different username.'))
+        if username.data != self.original_username and \
+                not current_app.usernames.available(username.data):
+            raise ValidationError(_('Please use a different username.'))
 
 
 # So users can submit new posts.
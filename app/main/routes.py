@@ -1,12 +1,11 @@
 from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
-from app import db
+from app import cursors, db, terms
 from app.main.forms import EditProfileForm, PostForm, SearchForm, MessageForm
-from app.models import User, Post, Message, Notification
+from app.models import User, Post, Notification, Thread
 from app.translate import translate
 from app.main import bp
 
@@ -16,10 +15,11 @@ from app.main import bp
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
+        # An UPDATE by id, current_user is usually a CachedUser (see
+        # app/usercache.py) and setting it would load the whole user.
+        User.query.filter_by(id=current_user.id).update(
+            {User.last_seen: datetime.utcnow()}, synchronize_session=False)
         db.session.commit()
-        # No session.add() here because Flask put the user in the
-        # db session when we reference current_user above.
 
         # A trick to implement Search on every page instead of creating a
         # form object in every route and passing to the template.
@@ -47,14 +47,15 @@ def index():
     form = PostForm()
     if form.validate_on_submit():
         # Use the guess_language package
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
         post = Post(body=form.post.data,
-                    author=current_user,
-                    language=language)
+                    user_id=current_user.id,
+                    language=Post.detect_language(form.post.data))
         db.session.add(post)
+        # Hashtags and mentions need the post's id.
+        db.session.flush()
+        terms.index_posts([post])
         db.session.commit()
+        current_app.trending.add([form.post.data])
         flash(_('Your post is now live!'))
         # This redirect is here avoids resubmitting the form on page
         # refresh. See the wiki on 'Post/Redirect/Get'.
@@ -170,7 +171,7 @@ def unfollow(username):
 @login_required
 def explore():
     page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
+    posts = Post.recent().paginate(
         page, current_app.config['POSTS_PER_PAGE'], False)
     # Ternarys to set next and prev url link, if they exist
     next_url = url_for('main.explore',
@@ -181,10 +182,45 @@ def explore():
     return render_template('index.html',
                            title=_('Explore'),
                            posts=posts.items,
+                           trending=current_app.trending.current(),
                            next_url=next_url,
                            prev_url=prev_url)
 
 
+def _cursor_page(source, title, endpoint, **kwargs):
+    '''Render a timeline with cursor pagination, see app/cursors.py.'''
+    try:
+        posts, next_cursor = cursors.page(
+            source, request.args.get('cursor'),
+            current_app.config['POSTS_PER_PAGE'])
+    except ValueError:
+        abort(404)
+    next_url = url_for(endpoint, cursor=next_cursor, **kwargs) \
+        if next_cursor else None
+    # Cursors only go forward, so there's no previous page link.
+    return render_template('index.html',
+                           title=title,
+                           posts=posts,
+                           next_url=next_url,
+                           prev_url=None)
+
+
+# Posts with a hashtag, straight off the post_tag index.
+@bp.route('/tag/<name>')
+@login_required
+def tag(name):
+    return _cursor_page(terms.tagged(name), f'#{name}', 'main.tag',
+                        name=name)
+
+
+@bp.route('/user/<username>/mentions')
+@login_required
+def mentions(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return _cursor_page(terms.mentioning(user), f'@{username}',
+                        'main.mentions', username=username)
+
+
 # Ajax translations. Also a view function, but returns data instead of html.
 @bp.route('/translate', methods=['POST'])
 @login_required
@@ -239,39 +275,55 @@ def send_message(recipient):
     user = User.query.filter_by(username=recipient).first_or_404()
     form = MessageForm()
     if form.validate_on_submit():
-        msg = Message(author=current_user,
-                      recipient=user,
-                      body=form.message.data)
-        db.session.add(msg)
+        current_user.send_message(user, form.message.data)
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         flash(_('Your message has been sent.'))
-        return redirect(url_for('main.user', username=recipient))
+        return redirect(url_for('main.conversation', username=recipient))
     return render_template('send_message.html',
                            title=_('Send Message'),
                            form=form,
                            recipient=recipient)
 
 
-# Handle viewing private messages. Similar to index and explore pages
+# The inbox: one row per conversation, the most recent first.
 @bp.route('/messages')
 @login_required
 def messages():
-    # Immediately update user last read time.
-    current_user.last_message_read_time = datetime.utcnow()
-    current_user.add_notification('unread_message_count', 0)
-    db.session.commit()
     page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
+    threads = current_user.threads.options(db.joinedload(
+        Thread.peer)).order_by(Thread.last_timestamp.desc()).paginate(
             page, current_app.config['POSTS_PER_PAGE'], False)
     # Ternarys to set next and prev url link, if they exist
     next_url = url_for('main.messages',
-                       page=messages.next_num) if messages.has_next else None
+                       page=threads.next_num) if threads.has_next else None
     prev_url = url_for('main.messages',
-                       page=messages.prev_num) if messages.has_prev else None
-    # Reusing the index template, but no form argument so no post writing.
+                       page=threads.prev_num) if threads.has_prev else None
     return render_template('messages.html',
+                           threads=threads.items,
+                           next_url=next_url,
+                           prev_url=prev_url)
+
+
+# Handle viewing private messages. Similar to index and explore pages
+@bp.route('/messages/<username>')
+@login_required
+def conversation(username):
+    peer = User.query.filter_by(username=username).first_or_404()
+    if current_user.read_thread(peer):
+        current_user.add_notification('unread_message_count',
+                                      current_user.new_messages())
+    db.session.commit()
+    page = request.args.get('page', 1, type=int)
+    messages = current_user.conversation(peer).paginate(
+        page, current_app.config['POSTS_PER_PAGE'], False)
+    next_url = url_for('main.conversation', username=username,
+                       page=messages.next_num) if messages.has_next else None
+    prev_url = url_for('main.conversation', username=username,
+                       page=messages.prev_num) if messages.has_prev else None
+    # Reusing the post template, but no form argument so no post writing.
+    return render_template('conversation.html',
+                           peer=peer,
                            messages=messages.items,
                            next_url=next_url,
                            prev_url=prev_url)
@@ -283,7 +335,10 @@ def messages():
 def notifications():
     # To avoid repeated notifs, only request notifs since a given time.
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
+    # Every open page polls this, so it goes by id and doesn't load the
+    # user behind a CachedUser.
+    notifications = Notification.query.filter(
+        Notification.user_id == current_user.id,
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
     return jsonify([{
         'name': n.name,
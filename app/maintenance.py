@@ -0,0 +1,149 @@
+'''
+Periodic housekeeping, so tables that only ever grew stay flat:
+    - expire_tokens clears API tokens that have expired.
+    - purge_tasks deletes Task rows of finished jobs.
+    - reconcile_tasks finishes Task rows whose rq job is gone, like ones
+      killed along with their worker, so they stop showing as running.
+    - purge_notifications deletes notifications older than
+      NOTIFICATION_RETENTION days.
+    - snapshot_trending refreshes the trending list (app/trending.py).
+
+Every job walks its rows in primary key order, MAINTENANCE_BATCH_SIZE at a
+time, with a commit after each batch. No statement touches more than one
+batch, so locks are short, and a job stops once it has used up
+MAINTENANCE_BUDGET seconds. The next run carries on from there.
+
+'flask scheduler run' is the clock. It puts each job on the maintenance
+queue every so often (see @periodic) and the maintenance pool of
+'flask worker' runs it. The schedule is kept in Redis, so running more
+than one scheduler doesn't run the jobs more often.
+'''
+import time
+from datetime import datetime
+from flask import current_app
+from app import db
+from app.models import User, Task, Notification
+
+# name: (function, seconds between runs)
+JOBS = {}
+
+
+def periodic(every):
+    '''Register a function as a job to run every 'every' seconds.'''
+    def register(f):
+        JOBS[f.__name__] = (f, every)
+        return f
+
+    return register
+
+
+def in_batches(column, criteria, apply):
+    '''
+    Call apply(ids) with batches of ids of rows matching criteria, in
+    column order, committing after each. Returns the number of rows.
+    '''
+    batch_size = current_app.config['MAINTENANCE_BATCH_SIZE']
+    deadline = time.monotonic() + current_app.config['MAINTENANCE_BUDGET']
+    done, last = 0, None
+    while time.monotonic() < deadline:
+        query = db.session.query(column).filter(*criteria)
+        if last is not None:
+            # Walk the key instead of rereading from the start, so rows
+            # apply() leaves alone aren't looked at again.
+            query = query.filter(column > last)
+        ids = [id for id, in query.order_by(column).limit(batch_size)]
+        if not ids:
+            break
+        apply(ids)
+        db.session.commit()
+        done += len(ids)
+        last = ids[-1]
+    return done
+
+
+def _delete(model):
+    def apply(ids):
+        model.query.filter(model.id.in_(ids)).delete(
+            synchronize_session=False)
+
+    return apply
+
+
+@periodic(every=3600)
+def expire_tokens():
+    def apply(ids):
+        User.query.filter(User.id.in_(ids)).update(
+            {
+                User.token: None,
+                User.token_expiration: None
+            },
+            synchronize_session=False)
+
+    return in_batches(User.id, [User.token_expiration < datetime.utcnow()],
+                      apply)
+
+
+@periodic(every=3600)
+def purge_tasks():
+    return in_batches(Task.id, [Task.complete.is_(True)], _delete(Task))
+
+
+@periodic(every=600)
+def reconcile_tasks():
+    from rq.job import Job
+
+    def apply(ids):
+        # Unlike Task.get_rq_job() this lets Redis errors through. No
+        # answer from Redis doesn't mean the job is gone.
+        jobs = Job.fetch_many(ids, connection=current_app.redis)
+        gone = [id for id, job in zip(ids, jobs)
+                if job is None or job.is_failed]
+        if gone:
+            Task.query.filter(Task.id.in_(gone)).update(
+                {Task.complete: True}, synchronize_session=False)
+
+    return in_batches(Task.id, [Task.complete.is_(False)], apply)
+
+
+@periodic(every=3600)
+def purge_notifications():
+    oldest = time.time() - \
+        current_app.config['NOTIFICATION_RETENTION'] * 24 * 3600
+    return in_batches(Notification.id, [Notification.timestamp < oldest],
+                      _delete(Notification))
+
+
+@periodic(every=60)
+def snapshot_trending():
+    '''Not rows, but it keeps the trending list fresh.'''
+    snapshot = current_app.trending.snapshot()
+    return len(snapshot['tags']) + len(snapshot['words'])
+
+
+def run_job(name):
+    '''What the maintenance queue runs. Returns the rows handled.'''
+    from app.tasks import get_app
+    get_app()
+    return JOBS[name][0]()
+
+
+def due(app):
+    '''
+    Names of the jobs to run now. Each job gets a Redis key that expires
+    after its interval, and only whoever manages to set it runs the job.
+    '''
+    for name, (_, every) in JOBS.items():
+        if app.redis.set('microblog-schedule:' + name, int(time.time()),
+                         nx=True, ex=every):
+            yield name
+
+
+def run_scheduler(app, tick=5, log=print):
+    '''Enqueue jobs as they come due, forever.'''
+    queue = app.task_queues['maintenance']
+    while True:
+        for name in due(app):
+            queue.enqueue(run_job, name,
+                          job_timeout=app.config['MAINTENANCE_BUDGET'] * 2)
+            log(f'queued {name}')
+        time.sleep(tick)
@@ -0,0 +1,212 @@
+'''
+Prometheus metrics for capacity planning. Everything we want to graph in
+production is declared here so the rest of the app only has to call
+current_app.metrics.<something>.
+
+Under gunicorn every worker is its own process with its own counters, so
+a scrape would only ever see one worker. prometheus_client solves this with
+its multiprocess mode: set prometheus_multiproc_dir to an empty directory
+before starting the workers and every process writes its values there,
+which /metrics then aggregates.
+
+The pinned prometheus_client (0.7.1) only reads that lowercase name. Newer
+releases read PROMETHEUS_MULTIPROC_DIR, so that is accepted too, and
+copied to the lowercase one below before prometheus_client is imported.
+'''
+import os
+import time
+from datetime import datetime
+from flask import request, g, Response
+from sqlalchemy import event
+
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    # prometheus_client picks how to store values when it's imported.
+    os.environ.setdefault('prometheus_multiproc_dir',
+                          os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, \
+    generate_latest, CONTENT_TYPE_LATEST, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+
+def multiprocess_dir():
+    return os.environ.get('prometheus_multiproc_dir') or \
+        os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def mark_process_dead(pid):
+    '''Called from gunicorn's child_exit hook so a dead worker's live
+    values don't linger in the aggregated output.
+    '''
+    if multiprocess_dir():
+        multiprocess.mark_process_dead(pid, path=multiprocess_dir())
+
+
+class PoolCollector(object):
+    '''Read the SQLAlchemy pool state at scrape time.'''
+    def __init__(self, engine):
+        self.engine = engine
+
+    def collect(self):
+        pool = self.engine.pool
+        # Only QueuePool keeps these numbers. SQLite's default pools don't.
+        for name, doc in [('size', 'Configured pool size.'),
+                          ('checkedout', 'Connections currently in use.'),
+                          ('overflow', 'Connections opened over the size.')]:
+            if hasattr(pool, name):
+                gauge = GaugeMetricFamily(f'microblog_db_pool_{name}', doc)
+                gauge.add_metric([], getattr(pool, name)())
+                yield gauge
+
+
+class QueueCollector(object):
+    '''Read the rq queue depths and waits at scrape time.'''
+    def __init__(self, app):
+        self.app = app
+
+    def collect(self):
+        import redis
+        depth = GaugeMetricFamily('microblog_task_queue_depth',
+                                  'Jobs waiting in the rq queue.',
+                                  labels=['queue'])
+        oldest = GaugeMetricFamily(
+            'microblog_task_queue_oldest_seconds',
+            'How long the next job in the rq queue has been waiting.',
+            labels=['queue'])
+        now = datetime.utcnow()
+        try:
+            for queue in self.app.task_queues.values():
+                depth.add_metric([queue.name], len(queue))
+                jobs = queue.get_jobs(0, 1)
+                oldest.add_metric([queue.name], (
+                    now - jobs[0].enqueued_at).total_seconds() if jobs else 0)
+        except redis.exceptions.RedisError:
+            # No Redis, no number. Don't fail the whole scrape over it.
+            return
+        yield depth
+        yield oldest
+
+
+class Metrics(object):
+    def __init__(self, app, engine):
+        # Each app gets its own registry, so calling create_app() more than
+        # once (like the tests do) doesn't trip over duplicate names.
+        self.registry = CollectorRegistry()
+        self.request_latency = Histogram(
+            'microblog_request_seconds',
+            'Request latency by blueprint endpoint.',
+            ['blueprint', 'endpoint', 'method', 'status'],
+            registry=self.registry)
+        self.pool_checkouts = Counter(
+            'microblog_db_pool_checkouts_total',
+            'Connections handed out by the pool.',
+            registry=self.registry)
+        self.pool_connects = Counter(
+            'microblog_db_pool_connects_total',
+            'New DBAPI connections opened by the pool.',
+            registry=self.registry)
+        # How long getting a connection from the pool takes, including
+        # waiting for one when all are checked out, and opening a new one.
+        self.pool_wait = Histogram(
+            'microblog_db_pool_wait_seconds',
+            'Time spent waiting for a connection from the pool.',
+            registry=self.registry)
+        # How long a request keeps a connection checked out. With a bounded
+        # pool this is what makes the next request wait.
+        self.pool_hold = Histogram(
+            'microblog_db_pool_hold_seconds',
+            'Time a connection stays checked out of the pool.',
+            registry=self.registry)
+        self.task_duration = Histogram(
+            'microblog_task_seconds',
+            'Background job duration by task name and outcome (finished or '
+            'failed).',
+            ['task', 'outcome'],
+            buckets=(.1, .5, 1, 5, 10, 30, 60, 300, 900, float('inf')),
+            registry=self.registry)
+        self.search_latency = Histogram(
+            'microblog_search_seconds',
+            'Elasticsearch round trip by operation.',
+            ['operation'],
+            registry=self.registry)
+        self.requests_shed = Counter(
+            'microblog_requests_shed_total',
+            'Requests turned away by the limits, by reason (rate or '
+            'concurrency).',
+            ['endpoint', 'reason'],
+            registry=self.registry)
+        self.translation_cache = Counter(
+            'microblog_translation_cache_total',
+            'Translation cache lookups by result (hit or miss).',
+            ['result'],
+            registry=self.registry)
+
+        # These are computed on demand instead of being tracked per process.
+        self.collectors = [PoolCollector(engine), QueueCollector(app)]
+        for collector in self.collectors:
+            self.registry.register(collector)
+
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        # Disposing an engine, like reset_connections() does, gives it a
+        # new pool, which needs timing too.
+        self._time_waits(engine)
+        event.listen(engine, 'engine_disposed', self._time_waits)
+        app.before_request(self._start_timer)
+        app.after_request(self._record_request)
+        app.add_url_rule('/metrics', 'metrics', self.export)
+
+    def _time_waits(self, engine):
+        # SQLAlchemy has no event for a checkout starting, only for one
+        # done. So time the pool's own _do_get(), where the waiting happens.
+        pool = engine.pool
+        do_get = pool._do_get
+
+        def timed_get():
+            start = time.perf_counter()
+            try:
+                return do_get()
+            finally:
+                self.pool_wait.observe(time.perf_counter() - start)
+
+        pool._do_get = timed_get
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.pool_connects.inc()
+
+    def _on_checkout(self, dbapi_connection, connection_record,
+                     connection_proxy):
+        self.pool_checkouts.inc()
+        connection_record.info['checkout_time'] = time.perf_counter()
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        start = connection_record.info.pop('checkout_time', None)
+        if start is not None:
+            self.pool_hold.observe(time.perf_counter() - start)
+
+    def _start_timer(self):
+        g.request_start = time.perf_counter()
+
+    def _record_request(self, response):
+        start = g.get('request_start')
+        if start is not None and request.endpoint != 'metrics':
+            self.request_latency.labels(
+                request.blueprint or 'none', request.endpoint or 'none',
+                request.method, response.status_code).observe(
+                    time.perf_counter() - start)
+        return response
+
+    def export(self):
+        '''The /metrics endpoint, in the Prometheus text format.'''
+        if multiprocess_dir():
+            # Build a throwaway registry that merges every worker's files.
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry,
+                                               path=multiprocess_dir())
+            for collector in self.collectors:
+                registry.register(collector)
+        else:
+            registry = self.registry
+        return Response(generate_latest(registry),
+                        mimetype=CONTENT_TYPE_LATEST)
@@ -1,8 +1,6 @@
 from app import db, login
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 from time import time
-import jwt
 import json
 from flask import current_app, url_for
 from hashlib import md5
@@ -10,13 +8,22 @@ from hashlib import md5
 # work as is. Note the Flask-Login ext requires certain properties
 # and methods to be implemented.
 from flask_login import UserMixin
-from app.search import add_to_index, remove_from_index, query_index
-# Background tasking.
-import redis
-import rq
+from app.search import add_to_index, query_index, bulk_update_index
+from app import shards
 # To support API tokens
 import base64
 import os
+from guess_language import guess_language
+
+
+def avatar_digest(email):
+    '''What Gravatar knows an email by. Stored as User.avatar_hash.'''
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+def avatar_url(digest, size):
+    '''Gravatar URL from User.avatar_hash, for when there's no User handy.'''
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
 
 
 class SearchableMixin(object):
@@ -42,6 +49,10 @@ class SearchableMixin(object):
         # database. The CASE part means we get the results in the order the
         # IDs are given. This is different than results from elasticsearch
         # above, which has results sorted from most to least relevant.
+        if shards.enabled() and cls.__tablename__ in shards.SHARDED:
+            # The CASE can't be merged across shards, put them in order here.
+            found = {obj.id: obj for obj in cls.query.filter(cls.id.in_(ids))}
+            return [found[id] for id in ids if id in found], total
         return cls.query.filter(cls.id.in_(ids)).order_by(
             db.case(when, value=cls.id)), total
 
@@ -65,16 +76,17 @@ class SearchableMixin(object):
         Called when the after_commit event is emitted by SQLAlchemy.
         Session was committed, so make similar changes to Elasticsearch to keep them in sync.
         '''
-        # Use the session changes recorded during before_commit()
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+        # Use the session changes recorded during before_commit(). Group
+        # them by index so a commit of many posts is one bulk request.
+        indexes = {}
+        for kind in ['add', 'update', 'delete']:
+            for obj in session._changes[kind]:
+                if isinstance(obj, SearchableMixin):
+                    added, removed = indexes.setdefault(
+                        obj.__tablename__, ([], []))
+                    (removed if kind == 'delete' else added).append(obj)
+        for index, (added, removed) in indexes.items():
+            bulk_update_index(index, added, removed)
         session._changes = None
 
     @classmethod
@@ -113,6 +125,7 @@ class PaginatiedAPIMixin(object):
                 if resources.has_prev else None
             }
         }
+        return data
 
 
 # Bind event handlers to our custom functions.
@@ -135,15 +148,29 @@ foreign keys.
 followers = db.Table(
     'followers', db.Column('follower_id', db.Integer,
                            db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    # One index per direction. "Who do I follow" reads the first, "who
+    # follows me" the second, and both cover the whole row so the table
+    # itself is never touched. The unique one also stops double follows.
+    db.Index('ix_followers_follower_id_followed_id', 'follower_id',
+             'followed_id', unique=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id',
+             'follower_id'))
 
 
 # Classes define the structure (or schema) for this app.
 # Note the addition of th mixin, adding generic code.
 class User(PaginatiedAPIMixin, UserMixin, db.Model):
+    # Every page view bumps last_seen. Nobody needs to read that back
+    # right away, so it doesn't pin the user to the primary database.
+    __lag_tolerant__ = ['last_seen']
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(64), index=True, unique=True)
+    # avatar_digest() of the email, kept up to date by _set_email() below,
+    # so pages with an avatar per post don't redo the MD5 every time.
+    avatar_hash = db.Column(db.String(32))
     password_hash = db.Column(db.String(128))
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
@@ -174,6 +201,10 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
                                         foreign_keys='Message.recipient_id',
                                         backref='recipient',
                                         lazy='dynamic')
+    # The inbox, one row per person messages were exchanged with.
+    threads = db.relationship('Thread',
+                              foreign_keys='Thread.user_id',
+                              lazy='dynamic')
     # Notifications relationship
     notifications = db.relationship('Notification',
                                     backref='user',
@@ -187,17 +218,23 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
 
     # The Werkzeug package comes with Flask and provides some
     # crypto functions, like those used below.
+    # Both hand the work to app/passwords.py, and raise its Overloaded
+    # (a 503) when too many are hashing already.
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.passwords.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return current_app.passwords.verify(self.password_hash, password)
 
     # Gravatar provides an easy API to obtain unique avatars based
     # on the hash of an email.
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return avatar_url(self.avatar_hash, size)
+
+    @db.validates('email')
+    def _set_email(self, key, email):
+        self.avatar_hash = avatar_digest(email) if email else None
+        return email
 
     # For followers. Good to put actions here on the model instead of on the view function
     def follow(self, user):
@@ -209,7 +246,9 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
             self.followed.remove(user)
 
     def is_following(self, user):
-        return self.followed.filter(
+        # Straight off followers, so it works on a CachedUser too.
+        return db.session.query(followers).filter(
+            followers.c.follower_id == self.id,
             followers.c.followed_id == user.id).count() > 0
 
     # A single db query to get all the posts of all followed users and sort it
@@ -217,6 +256,15 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
     # expensive to do on the application. So have the db do it.
     # Details: https://blog.miguelgrinberg.com/post/the-flask-mega-tutorial-part-viii-followers
     def followed_posts(self):
+        if shards.enabled():
+            # Posts are spread over the shards by author, so a join with
+            # followers can't work. Merge each shard's newest instead.
+            followed_ids = [
+                row.followed_id for row in db.session.query(
+                    followers.c.followed_id).filter(
+                        followers.c.follower_id == self.id)
+            ]
+            return shards.Timeline(Post, followed_ids + [self.id])
         followed = Post.query.join(
             followers, (followers.c.followed_id == Post.user_id)).filter(
                 followers.c.follower_id == self.id)
@@ -230,6 +278,7 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
         # arg2 = key to encrypt with
         # arg3 = crytpo algo to use
         # return = a string, more useful than the bytes encode() returns.
+        import jwt
         return jwt.encode(
             {
                 'reset_password': self.id,
@@ -243,6 +292,7 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
     # staticmethods can be invoked directly from class, no instance needed
     @staticmethod
     def verify_reset_password_token(token):
+        import jwt
         try:
             id = jwt.decode(token,
                             current_app.config['SECRET_KEY'],
@@ -253,11 +303,68 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
 
     # Private message stuff
     last_message_read_time = db.Column(db.DateTime)
+    # Sum of Thread.unread over the user's threads, kept up to date by
+    # send_message() and read_thread() so the navbar badge is free.
+    unread_messages = db.Column(db.Integer, nullable=False, default=0,
+                                server_default='0')
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        return self.unread_messages or 0
+
+    def send_message(self, recipient, body):
+        '''
+        Store a message and bring both sides of the conversation up to
+        date. Counters are bumped with UPDATE ... SET x = x + 1 so two
+        messages sent at once both count.
+        '''
+        msg = Message(author=self,
+                      recipient=recipient,
+                      body=body,
+                      timestamp=datetime.utcnow())
+        db.session.add(msg)
+        # For the id.
+        db.session.flush()
+        for owner, peer in [(self, recipient), (recipient, self)]:
+            thread = Thread.between(owner, peer)
+            thread.last_message_id = msg.id
+            thread.last_sender_id = self.id
+            thread.last_body = body
+            thread.last_timestamp = msg.timestamp
+            if owner is recipient and owner is not self:
+                thread.unread = 1 if thread.unread is None else \
+                    Thread.unread + 1
+        if recipient is not self:
+            recipient.unread_messages = User.unread_messages + 1
+        # Turn the expressions back into numbers.
+        db.session.flush()
+        return msg
+
+    def read_thread(self, peer):
+        '''Mark the conversation with peer read. Returns how many were new.'''
+        thread = self.threads.filter_by(
+            peer_id=peer.id).with_for_update().first()
+        if thread is None:
+            return 0
+        thread.last_read_time = datetime.utcnow()
+        unread = thread.unread
+        if unread:
+            thread.unread = 0
+            self.unread_messages = User.unread_messages - unread
+            db.session.flush()
+        return unread
+
+    def conversation(self, peer):
+        '''Messages between this user and peer, newest first.'''
+        between = db.or_(
+            db.and_(Message.sender_id == self.id,
+                    Message.recipient_id == peer.id),
+            db.and_(Message.sender_id == peer.id,
+                    Message.recipient_id == self.id))
+        if shards.enabled():
+            # Either side's shard can hold some of them.
+            return shards.Timeline(Message, [self.id, peer.id], (between, ))
+        return Message.query.filter(between).order_by(
+            Message.timestamp.desc(), Message.id.desc())
 
     # Helper to work with notification objects easier.
     # Actions that change the message count should use this. The unread_message_count
@@ -272,10 +379,15 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
     '''
     Helpers to make access to background jobs easier.
     '''
-    def launch_task(self, name, description, *args, **kwargs):
-        ''' Add task to queue and database. '''
-        rq_job = current_app.task_queue.enqueue('app.tasks.' + name, self.id,
-                                                *args, **kwargs)
+    def launch_task(self, name, description, *args, queue=None, **kwargs):
+        '''
+        Add task to queue and database. The queue is picked by TASK_ROUTES
+        unless one of app.queues.QUEUES is given.
+        '''
+        from app.queues import queue_for
+        queue = current_app.task_queues[queue
+                                        or queue_for(current_app, name)]
+        rq_job = queue.enqueue('app.tasks.' + name, self.id, *args, **kwargs)
         task = Task(id=rq_job.get_id(),
                     name=name,
                     description=description,
@@ -284,10 +396,10 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
         return task
 
     def get_tasks_in_progress(self):
-        return Task.query.filter_by(user=self, complete=False).all()
+        return Task.query.filter_by(user_id=self.id, complete=False).all()
 
     def get_task_in_progress(self, name):
-        return Task.query.filter_by(name=name, user=self,
+        return Task.query.filter_by(name=name, user_id=self.id,
                                     complete=False).first()
 
     # API support. Note of this representation of Users is different
@@ -359,16 +471,21 @@ class User(PaginatiedAPIMixin, UserMixin, db.Model):
 
 '''
 Flask-Login uses a unique ID to track users and their sessions. To help the extension, a user loader func is required that will get User info from the db.
+Mostly it comes from the cache instead, see app/usercache.py.
 '''
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return current_app.user_cache.get(int(id))
 
 
 class Post(SearchableMixin, db.Model):
     # This class attribute helps us abstractify full site searching
     # This attr lists the fields that need to be included in the indexing.
     __searchable__ = ['body']
+    # A user's newest posts, for their profile and timelines, come straight
+    # off this index with no sort.
+    __table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id',
+                               'timestamp'), )
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
@@ -380,12 +497,58 @@ class Post(SearchableMixin, db.Model):
     # when the post is made.
     language = db.Column(db.String(5))
 
+    @staticmethod
+    def detect_language(body):
+        '''Language code for a new post, or '' if we can't tell.'''
+        language = guess_language(body)
+        if language == 'UNKNOWN' or len(language) > 5:
+            return ''
+        return language
+
+    @staticmethod
+    def recent():
+        '''Everyone's posts, newest first. Used by explore.'''
+        if shards.enabled():
+            return shards.Timeline(Post)
+        return Post.query.order_by(Post.timestamp.desc())
+
     def __repr__(self):
         return f'<Post {self.body}>'
 
 
+# Hashtags and @mentions in posts, one row per post and term, written
+# along with the post (see app/terms.py). The rows copy the post's
+# timestamp and author, so a tag or mention timeline is a range scan down
+# one index and we know which shard each post is on. No foreign key to
+# post, posts can live on a shard.
+post_tags = db.Table(
+    'post_tag',
+    db.Column('tag', db.String(64), primary_key=True),
+    db.Column('post_id', db.Integer, primary_key=True),
+    db.Column('author_id', db.Integer, nullable=False),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Index('ix_post_tag_tag_timestamp', 'tag', 'timestamp', 'post_id'))
+
+mentions = db.Table(
+    'mention',
+    # Who was mentioned.
+    db.Column('user_id',
+              db.Integer,
+              db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('post_id', db.Integer, primary_key=True),
+    db.Column('author_id', db.Integer, nullable=False),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Index('ix_mention_user_id_timestamp', 'user_id', 'timestamp',
+             'post_id'))
+
+
 # To represent private messages to other users
 class Message(db.Model):
+    # The inbox and the unread count both look up by recipient and time.
+    __table_args__ = (db.Index('ix_message_recipient_id_timestamp',
+                               'recipient_id', 'timestamp'), )
+
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -396,6 +559,86 @@ class Message(db.Model):
         return f'<Message {self.body}>'
 
 
+class Thread(db.Model):
+    '''
+    One user's side of a private conversation: the newest message between
+    them and peer, when they last read it and how many of peer's messages
+    came in since. User.send_message() keeps both sides up to date, so the
+    inbox only ever reads these rows, however many messages are behind them.
+    '''
+    __table_args__ = (
+        db.Index('ix_thread_user_id_peer_id', 'user_id', 'peer_id',
+                 unique=True),
+        db.Index('ix_thread_user_id_last_timestamp', 'user_id',
+                 'last_timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    peer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # A copy of the newest message. No foreign key, messages can live on a
+    # shard.
+    last_message_id = db.Column(db.Integer)
+    last_sender_id = db.Column(db.Integer)
+    last_body = db.Column(db.String(140))
+    last_timestamp = db.Column(db.DateTime)
+    last_read_time = db.Column(db.DateTime)
+    unread = db.Column(db.Integer, nullable=False, default=0)
+
+    peer = db.relationship('User', foreign_keys=[peer_id])
+
+    @staticmethod
+    def between(user, peer):
+        thread = user.threads.filter_by(peer_id=peer.id).first()
+        if thread is None:
+            thread = Thread(user_id=user.id, peer=peer)
+            db.session.add(thread)
+        return thread
+
+
+class IdTicket(db.Model):
+    '''
+    Hands out ids for posts and messages when they are sharded. Each shard
+    has its own autoincrement, so the ids come from this table on the
+    primary instead, keeping them unique everywhere. Only the latest ticket
+    is kept.
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+
+    @staticmethod
+    def next_id():
+        connection = db.session.connection(mapper=IdTicket.__mapper__)
+        table = IdTicket.__table__
+        new_id = connection.execute(table.insert()).inserted_primary_key[0]
+        connection.execute(table.delete().where(table.c.id < new_id))
+        return new_id
+
+    @staticmethod
+    def reserve(highest):
+        '''Make sure the next id handed out is after highest.'''
+        connection = db.session.connection(mapper=IdTicket.__mapper__)
+        table = IdTicket.__table__
+        current = connection.execute(db.select([db.func.max(
+            table.c.id)])).scalar() or 0
+        if current >= highest:
+            return
+        connection.execute(table.insert().values(id=highest))
+        if connection.dialect.name == 'postgresql':
+            # Explicit ids don't move the sequence along.
+            connection.execute(
+                "SELECT setval(pg_get_serial_sequence('id_ticket', 'id'), %s)",
+                highest)
+
+
+def _assign_global_id(mapper, connection, target):
+    if target.id is None and shards.enabled():
+        target.id = IdTicket.next_id()
+
+
+db.event.listen(Post, 'before_insert', _assign_global_id)
+db.event.listen(Message, 'before_insert', _assign_global_id)
+
+
 # To represent notifications
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -421,6 +664,10 @@ class Task(db.Model):
     complete = db.Column(db.Boolean, default=False)
 
     def get_rq_job(self):
+        # Only the task pages need rq, so it's imported here rather than
+        # slowing down every process that imports the models.
+        import redis
+        import rq
         try:
             rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
         except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
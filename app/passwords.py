@@ -0,0 +1,133 @@
+'''
+Password hashing, kept from eating every web worker. PBKDF2 is slow on
+purpose, so a burst of logins used to tie up all the workers hashing and
+nothing else got served.
+
+    - Hashes run in a small process pool (PASSWORD_HASH_PROCESSES per web
+      process), so they don't hold the GIL of a threaded worker. 0 runs
+      them inline, like before.
+    - At most PASSWORD_HASH_CONCURRENCY hashes run at once, counted over
+      all the gunicorn workers. The counters are made in create_app(),
+      which gunicorn.conf.py runs in the master before forking, so every
+      worker shares them. Without preload_app each worker counts alone.
+    - When PASSWORD_HASH_QUEUE requests are already waiting for a turn, or
+      one waits longer than PASSWORD_HASH_WAIT seconds, the request gets a
+      503 with Retry-After instead of waiting. That caps how many workers
+      logins can hold, and the rest keep serving timelines.
+
+PASSWORD_HASH_METHOD sets the work factor for new hashes. Old hashes keep
+the one they were made with, Werkzeug reads it from the hash.
+
+Each turn, and each place in the queue, records the pid of the worker
+holding it. A worker killed while hashing or waiting (gunicorn's timeout)
+can't give them back, so gunicorn's child_exit hook hands them back for it
+with reclaim(). Waiting is a short sleep and retry rather than blocking
+on a shared condition, which a killed waiter would leave broken.
+'''
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class Overloaded(ServiceUnavailable):
+    '''A 503 the error handlers send with a Retry-After header.'''
+    def __init__(self, description=None, retry_after=1):
+        super(Overloaded, self).__init__(description)
+        self.retry_after = retry_after
+
+
+class Hasher(object):
+    # How often a waiting request looks for a free turn.
+    poll = 0.01
+
+    def __init__(self, app):
+        self.config = app.config
+        # The pid holding each turn and each place in the queue, 0 where
+        # free. They share one lock.
+        self.holders = multiprocessing.Array(
+            'i', self.config['PASSWORD_HASH_CONCURRENCY'])
+        self.waiters = multiprocessing.Array(
+            'i', self.config['PASSWORD_HASH_QUEUE'], lock=False)
+        self.lock = self.holders.get_lock()
+        self._pool = None
+
+    @property
+    def pool(self):
+        # Made on first use, in the worker. A pool made in the gunicorn
+        # master wouldn't survive the fork.
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.config['PASSWORD_HASH_PROCESSES'])
+        return self._pool
+
+    def reset(self):
+        '''Forget the pool of a parent process, see reset_connections().'''
+        self._pool = None
+
+    def _take(self, pids):
+        '''Put our pid in a free entry of pids, returns it or None.'''
+        with self.lock:
+            for i, pid in enumerate(pids):
+                if pid == 0:
+                    pids[i] = os.getpid()
+                    return i
+        return None
+
+    def _free(self, pids, i):
+        with self.lock:
+            pids[i] = 0
+
+    def acquire(self, timeout=None):
+        '''Take a turn, returns its number or None after timeout seconds.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            slot = self._take(self.holders)
+            if slot is not None:
+                return slot
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll)
+
+    def release(self, slot):
+        self._free(self.holders, slot)
+
+    def reclaim(self, pid):
+        '''
+        Free the turns and places in the queue of a dead process. Returns
+        how many it had.
+        '''
+        freed = 0
+        with self.lock:
+            for pids in (self.holders, self.waiters):
+                for i, holder in enumerate(pids):
+                    if holder == pid:
+                        pids[i] = 0
+                        freed += 1
+        return freed
+
+    def _run(self, f, *args):
+        place = self._take(self.waiters)
+        if place is None:
+            raise Overloaded('Too many sign ins, try again shortly.')
+        try:
+            slot = self.acquire(self.config['PASSWORD_HASH_WAIT'])
+        finally:
+            self._free(self.waiters, place)
+        if slot is None:
+            raise Overloaded('Too many sign ins, try again shortly.')
+        try:
+            if not self.config['PASSWORD_HASH_PROCESSES']:
+                return f(*args)
+            return self.pool.submit(f, *args).result()
+        finally:
+            self.release(slot)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password,
+                         self.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
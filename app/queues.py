@@ -0,0 +1,88 @@
+'''
+Background jobs are spread over rq queues by how urgent they are, so a
+burst of big exports can't hold up the small jobs someone is waiting on:
+    - interactive: notifications, indexing and anything else quick. Tasks
+      not listed in TASK_ROUTES go here.
+    - bulk: big jobs like export_posts.
+    - maintenance: periodic cleanup nobody is waiting for.
+
+'flask worker' starts a pool of processes per queue, sized by
+WORKER_POOLS. A pool also takes jobs from the more urgent queues whenever
+they have any, but never from the less urgent ones. So idle bulk workers
+help out with interactive jobs, while bulk jobs can never use more
+processes than the bulk pool has.
+'''
+import statistics
+from datetime import datetime
+
+# Most urgent first. rq workers empty their queues in the order given.
+QUEUES = ('interactive', 'bulk', 'maintenance')
+
+
+def queue_name(name):
+    '''The rq (and Redis) name of one of QUEUES.'''
+    return 'microblog-' + name
+
+
+def create_queues(app):
+    import rq
+    return {
+        name: rq.Queue(queue_name(name), connection=app.redis)
+        for name in QUEUES
+    }
+
+
+def queue_for(app, task):
+    '''Which of QUEUES a task goes to.'''
+    return app.config['TASK_ROUTES'].get(task, QUEUES[0])
+
+
+def pool_queues(name):
+    '''rq queue names a pool works on: its own and the more urgent ones.'''
+    return [queue_name(n) for n in QUEUES[:QUEUES.index(name) + 1]]
+
+
+def _seconds(later, earlier):
+    return round((later - earlier).total_seconds(), 3)
+
+
+def _percentile(values, percent):
+    return round(
+        sorted(values)[min(len(values) - 1,
+                           int(len(values) * percent / 100))], 3)
+
+
+def latency_report(app, sample=100):
+    '''
+    How long jobs wait before a worker picks them up, per queue:
+        - waiting and oldest_wait: jobs in the queue now, and how long the
+          first of them has been there. This is the one to watch, it grows
+          as soon as a pool can't keep up.
+        - running, failed: jobs in rq's started and failed registries.
+        - wait_p50, wait_p95, wait_max: time from enqueue to start over
+          the last 'sample' finished jobs.
+    '''
+    from rq.job import Job
+    now = datetime.utcnow()
+    report = {}
+    for name, queue in app.task_queues.items():
+        oldest = queue.get_jobs(0, 1)
+        waits = [
+            _seconds(job.started_at, job.enqueued_at)
+            for job in Job.fetch_many(
+                queue.finished_job_registry.get_job_ids(-sample, -1),
+                connection=queue.connection)
+            if job is not None and job.started_at and job.enqueued_at
+        ]
+        report[name] = {
+            'waiting': len(queue),
+            'oldest_wait':
+            _seconds(now, oldest[0].enqueued_at) if oldest else 0,
+            'running': queue.started_job_registry.count,
+            'failed': queue.failed_job_registry.count,
+            'finished_sampled': len(waits),
+            'wait_p50': statistics.median(waits) if waits else None,
+            'wait_p95': _percentile(waits, 95) if waits else None,
+            'wait_max': max(waits) if waits else None
+        }
+    return report
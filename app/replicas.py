@@ -0,0 +1,270 @@
+'''
+Read replica and shard support. Pages like explore, user_popup, search and
+the GET API endpoints only read, so they can be served by copies of the
+database while the primary only deals with writes.
+
+The rules for where a query goes:
+    - Writes (flushes, INSERT/UPDATE/DELETE, SELECT ... FOR UPDATE) and
+      anything outside a request (CLI, rq tasks) use the primary.
+    - Plain SELECTs during GET/HEAD/OPTIONS requests use a random replica.
+    - Once a session has written, by flushing, by a bulk query update() or
+      delete(), or by executing an INSERT/UPDATE/DELETE itself, it sticks
+      to the primary until commit.
+    - After a user commits a change, they read from the primary for
+      REPLICA_READ_YOUR_WRITES seconds, so they see their own new post even
+      if the replicas haven't caught up yet. The window is kept by user id
+      on the server (in Redis with REPLICA_WINDOW_STORE=redis), so it works
+      the same for the web pages and for API clients with a token.
+      Anonymous clients don't get one, they have nothing of theirs to see.
+
+Sharded tables (see shards.py) skip all of this and go to their shard.
+'''
+import random
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, inspect, orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import GenerativeSelect
+from app.shards import ShardQuery, shard_for_instance
+
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class MemoryWindows(object):
+    '''Read your writes windows of this process only.'''
+    def __init__(self):
+        self.until = {}
+
+    def active(self, user_id):
+        return self.until.get(user_id, 0) > time.time()
+
+    def start(self, user_id, seconds):
+        now = time.time()
+        self.until[user_id] = now + seconds
+        if len(self.until) > 10000:
+            for k in [k for k, t in self.until.items() if t < now]:
+                del self.until[k]
+
+
+class RedisWindows(object):
+    '''A key per user that expires when their window ends.'''
+    def __init__(self, redis):
+        self.redis = redis
+
+    def active(self, user_id):
+        return bool(self.redis.exists(f'microblog-primary:{user_id}'))
+
+    def start(self, user_id, seconds):
+        self.redis.set(f'microblog-primary:{user_id}', 1, ex=seconds)
+
+
+class Windows(object):
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self._store = None
+        # g outlives the request when something else pushed the app
+        # context, like the tests do.
+        app.before_request(self.forget)
+
+    @property
+    def store(self):
+        # Made on first use, app.redis may not be usable before that.
+        if self._store is None:
+            if self.config['REPLICA_WINDOW_STORE'] == 'memory':
+                self._store = MemoryWindows()
+            else:
+                self._store = RedisWindows(self.app.redis)
+        return self._store
+
+    def forget(self):
+        g.pop('in_window', None)
+
+    def active(self, user_id):
+        import redis
+        try:
+            return self.store.active(user_id)
+        except redis.exceptions.RedisError:
+            # Can't tell, and the primary is never stale.
+            self.app.logger.exception('Could not read a replica window')
+            return True
+
+    def start(self, user_id):
+        import redis
+        try:
+            self.store.start(user_id, self.config['REPLICA_READ_YOUR_WRITES'])
+        except redis.exceptions.RedisError:
+            self.app.logger.exception('Could not start a replica window')
+
+
+def _user_id():
+    '''
+    Who is making this request, without loading the user (that would
+    query, and land back here). API users are in g.current_user, web users
+    are in the Flask-Login session.
+    '''
+    user = g.get('current_user')
+    if user is not None:
+        # Still there after a commit expired the user.
+        identity = inspect(user).identity
+        return str(identity[0]) if identity else None
+    return session.get('user_id')
+
+
+def _in_window():
+    '''If this request's user has a read your writes window open.'''
+    if 'in_window' not in g:
+        user_id = _user_id()
+        g.in_window = user_id is not None and \
+            current_app.extensions['replica_windows'].active(user_id)
+    return g.in_window
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        super(RoutingSession, self).__init__(db, **options)
+        self.db = db
+        self.replicas = self.app.extensions['replicas']
+        self.force_primary = False
+        if self.app.extensions['shards']:
+            # Flushes ask this for a connection per object, which is how new
+            # posts and messages end up on their shard.
+            self.connection_callable = self._connection_for_instance
+
+    def _connection_for_instance(self, mapper, instance):
+        return self.transaction.connection(
+            mapper, shard=shard_for_instance(mapper, instance))
+
+    def get_bind(self, mapper=None, clause=None, shard=None):
+        if shard is not None:
+            return self.db.get_engine(self.app, bind=shard)
+        if self._use_replica(mapper, clause):
+            return self.db.get_engine(self.app,
+                                      bind=random.choice(self.replicas))
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def execute(self, clause, params=None, mapper=None, bind=None, **kw):
+        # Statements run straight through the session skip the flush, so
+        # note their writes here.
+        if isinstance(clause, str):
+            writes = not clause.lstrip().upper().startswith('SELECT')
+        elif isinstance(clause, TextClause):
+            writes = not clause.text.lstrip().upper().startswith('SELECT')
+        else:
+            writes = isinstance(clause, UpdateBase)
+        if writes:
+            self.info['wrote'] = True
+        return super(RoutingSession, self).execute(clause, params, mapper,
+                                                   bind, **kw)
+
+    def _use_replica(self, mapper, clause):
+        if not self.replicas or self.force_primary or self._flushing or \
+                self.info.get('wrote'):
+            return False
+        # Tables with their own bind don't have replicas.
+        if mapper is not None and \
+                mapper.persist_selectable.info.get('bind_key') is not None:
+            return False
+        if not isinstance(clause, GenerativeSelect) or \
+                clause._for_update_arg is not None:
+            return False
+        if not has_request_context() or \
+                request.method not in READ_ONLY_METHODS:
+            return False
+        return not _in_window()
+
+
+def _note_writes(db_session, flush_context, instances):
+    '''
+    Remember if this flush changed anything the client would expect to
+    see right away. Columns listed in a model's __lag_tolerant__ (like
+    last_seen, which every page view updates) don't count.
+    '''
+    if db_session.new or db_session.deleted:
+        db_session.info['wrote'] = True
+        return
+    for obj in db_session.dirty:
+        # committed_state holds the attributes modified since loading.
+        changed = set(inspect(obj).committed_state)
+        if changed - set(getattr(obj, '__lag_tolerant__', ())):
+            db_session.info['wrote'] = True
+            return
+
+
+def _note_bulk_writes(update_context):
+    '''The same for Query.update() and Query.delete().'''
+    db_session = update_context.session
+    values = getattr(update_context, 'values', None)
+    if values is not None and update_context.mapper is not None:
+        keys = values.keys() if hasattr(values, 'keys') else \
+            [k for k, _ in values]
+        names = {getattr(k, 'key', k) for k in keys}
+        if not names - set(getattr(update_context.mapper.class_,
+                                   '__lag_tolerant__', ())):
+            return
+    db_session.info['wrote'] = True
+
+
+def _start_window(db_session):
+    if not db_session.info.pop('wrote', False) or \
+            not db_session.replicas or not has_request_context():
+        return
+    user_id = _user_id()
+    if user_id is not None:
+        current_app.extensions['replica_windows'].start(user_id)
+        g.in_window = True
+
+
+def _forget_writes(db_session):
+    db_session.info.pop('wrote', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''
+    Flask-SQLAlchemy with replica and shard routing. URLs from
+    SQLALCHEMY_REPLICA_URIS and SQLALCHEMY_SHARD_URIS become extra binds
+    named replica0, replica1... and shard0, shard1... so Flask-SQLAlchemy
+    manages their engines like any other.
+    '''
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('query_class', ShardQuery)
+        super(RoutingSQLAlchemy, self).__init__(*args, **kwargs)
+        event.listen(self.session, 'before_flush', _note_writes)
+        event.listen(self.session, 'after_bulk_update', _note_bulk_writes)
+        event.listen(self.session, 'after_bulk_delete', _note_bulk_writes)
+        event.listen(self.session, 'after_commit', _start_window)
+        event.listen(self.session, 'after_rollback', _forget_writes)
+
+    def init_app(self, app):
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for kind in ('replica', 'shard'):
+            uris = app.config.get(f'SQLALCHEMY_{kind.upper()}_URIS') or []
+            app.extensions[f'{kind}s'] = []
+            for i, uri in enumerate(uris):
+                binds[f'{kind}{i}'] = uri
+                app.extensions[f'{kind}s'].append(f'{kind}{i}')
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.extensions['replica_windows'] = Windows(app)
+        super(RoutingSQLAlchemy, self).init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @contextmanager
+    def primary(self):
+        '''For reads that must not see stale data, like a check right
+        before a write:
+
+            with db.primary():
+                user = User.query.get(id)
+        '''
+        db_session = self.session()
+        previous = db_session.force_primary
+        db_session.force_primary = True
+        try:
+            yield
+        finally:
+            db_session.force_primary = previous
@@ -16,14 +16,39 @@ def add_to_index(index, model):
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
     # Conveintely use the id assigned by SQLAlchemy
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    with current_app.metrics.search_latency.labels('index').time():
+        current_app.elasticsearch.index(index=index, id=model.id,
+                                        body=payload)
 
 
 # Remove entries to the full-text index.
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=mode.id)
+    with current_app.metrics.search_latency.labels('delete').time():
+        current_app.elasticsearch.delete(index=index, id=model.id)
+
+
+# Same as the two above, for many objects in one request. Used after
+# commits, which can touch any number of rows.
+def bulk_update_index(index, added, removed=()):
+    if not current_app.elasticsearch or not (added or removed):
+        return
+    from elasticsearch import helpers
+    actions = [{
+        '_op_type': 'index',
+        '_index': index,
+        '_id': model.id,
+        '_source': {field: getattr(model, field)
+                    for field in model.__searchable__}
+    } for model in added]
+    actions.extend({
+        '_op_type': 'delete',
+        '_index': index,
+        '_id': model.id
+    } for model in removed)
+    with current_app.metrics.search_latency.labels('bulk').time():
+        helpers.bulk(current_app.elasticsearch, actions)
 
 
 def query_index(index, query, page, per_page):
@@ -31,18 +56,19 @@ def query_index(index, query, page, per_page):
         return [], 0
     # This search looks at multiple fields, and by using '*', doesn't
     # care what the field names are. This also has pagination options.
-    search = current_app.elasticsearch.search(index=index,
-                                              body={
-                                                  'query': {
-                                                      'multi_match': {
-                                                          'query': query,
-                                                          'fields': ['*']
-                                                      }
-                                                  },
-                                                  'from':
-                                                  (page - 1) * per_page,
-                                                  'size': per_page
-                                              })
+    with current_app.metrics.search_latency.labels('query').time():
+        search = current_app.elasticsearch.search(index=index,
+                                                  body={
+                                                      'query': {
+                                                          'multi_match': {
+                                                              'query': query,
+                                                              'fields': ['*']
+                                                          }
+                                                      },
+                                                      'from':
+                                                      (page - 1) * per_page,
+                                                      'size': per_page
+                                                  })
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     # Return a list of id elements from results and total number of results.
     return ids, search['hits']['total']['value']
\ No newline at end of file
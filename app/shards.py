@@ -0,0 +1,366 @@
+'''
+Optional horizontal sharding of our two biggest tables. When
+SQLALCHEMY_SHARD_URIS lists databases, post rows live on the shard picked
+by their user_id and message rows on the one picked by their recipient_id.
+Everything else stays on the primary database.
+
+Most code doesn't need to know about this:
+    - New posts and messages are written to the right shard by the session
+      (see RoutingSession in replicas.py).
+    - Queries that filter on the shard column, like user.posts or
+      messages_received, are sent to that one shard by ShardQuery.
+    - Other queries against a sharded table run on every shard. If they
+      have an ORDER BY, each shard's rows are merged on it, and LIMIT and
+      OFFSET are applied again to the merged rows. Only ordering by
+      columns of the model can be merged, anything else raises.
+    - Timelines that span users, like followed_posts() and explore, use
+      Timeline, which merges each shard's newest rows on timestamp.
+'''
+import heapq
+from collections import defaultdict
+from functools import cmp_to_key
+from itertools import chain, islice
+from operator import attrgetter
+from flask import current_app
+from flask_sqlalchemy import BaseQuery, Pagination
+from sqlalchemy import Column, Index, MetaData, Table, inspect, select
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BindParameter, UnaryExpression
+
+# Sharded tables and the column that picks the shard.
+SHARDED = {'post': 'user_id', 'message': 'recipient_id'}
+
+
+def shards():
+    '''Bind keys of the configured shards, empty if sharding is off.'''
+    return current_app.extensions['shards']
+
+
+def enabled():
+    return bool(shards())
+
+
+def shard_for(value):
+    if value is None:
+        raise ValueError('Rows without a shard key have no shard')
+    all_shards = shards()
+    return all_shards[value % len(all_shards)]
+
+
+def shard_for_instance(mapper, instance):
+    '''Where a new or loaded object lives, or None if it isn't sharded.'''
+    table = mapper.persist_selectable
+    if table.name not in SHARDED:
+        return None
+    state = inspect(instance)
+    if state.key is not None:
+        # Loaded objects remember their shard in the identity key.
+        return state.key[2]
+    key = SHARDED[table.name]
+    if getattr(instance, key) is None:
+        # Setting only the relationship is fine, the flush copies the id
+        # over before it gets here.
+        raise ValueError(f'{instance!r} needs {table.name}.{key} set to '
+                         'pick its shard')
+    shard = shard_for(getattr(instance, key))
+    state.identity_token = shard
+    return shard
+
+
+def _sharded_table(statement):
+    '''The sharded table a statement reads from, if any.'''
+    found = []
+    visitors.traverse(
+        statement, {}, {
+            'table':
+            lambda table: found.append(table)
+            if table.name in SHARDED else None
+        })
+    return found[0] if found else None
+
+
+def _shard_key_values(statement, table):
+    '''
+    Look for "<shard column> = value" or "<shard column> IN (values)" in
+    the statement. Returns the set of values, or None if there is no such
+    comparison and the statement could match rows on any shard.
+    '''
+    column = table.c[SHARDED[table.name]]
+    values = set()
+
+    def visit_binary(binary):
+        left, right = binary.left, binary.right
+        if isinstance(left, BindParameter):
+            left, right = right, left
+        if not isinstance(left, Column) or left.table is not table or \
+                left.name != column.name:
+            return
+        if binary.operator == operators.eq and \
+                isinstance(right, BindParameter):
+            values.add(right.effective_value)
+        elif binary.operator == operators.in_op:
+            if isinstance(right, BindParameter):
+                values.update(right.effective_value)
+            else:
+                values.update(
+                    b.effective_value for b in visitors.iterate(right, {})
+                    if isinstance(b, BindParameter))
+
+    visitors.traverse(statement, {}, {'binary': visit_binary})
+    return values or None
+
+
+class ShardQuery(BaseQuery):
+    '''A query that knows which shard(s) to run on.'''
+    _shard = None
+
+    def on_shard(self, shard):
+        '''Pin the query to one shard. None leaves the routing automatic.'''
+        query = self._clone()
+        query._shard = shard
+        return query
+
+    def _shards_for(self, statement):
+        if self._shard is not None:
+            return [self._shard]
+        if not enabled():
+            return None
+        table = _sharded_table(statement)
+        if table is None:
+            return None
+        values = _shard_key_values(statement, table)
+        if values is None:
+            return shards()
+        return sorted({shard_for(value) for value in values})
+
+    def _execute_and_instances(self, context):
+        targets = self._shards_for(context.statement)
+        if targets is None:
+            return super(ShardQuery, self)._execute_and_instances(context)
+
+        def run_on(shard):
+            # The identity token keeps equal primary keys from different
+            # shards apart in the session's identity map.
+            context.identity_token = shard
+            result = self._connection_from_session(
+                mapper=self._bind_mapper(),
+                shard=shard).execute(context.statement, self._params)
+            return self.instances(result, context)
+
+        if len(targets) == 1:
+            return run_on(targets[0])
+        rows = []
+        for shard in targets:
+            rows.extend(run_on(shard))
+        return iter(rows)
+
+    def __iter__(self):
+        if self._shard is None and enabled() and \
+                (self._order_by or self._limit is not None or self._offset):
+            targets = self._shards_for(self.statement)
+            if targets is not None and len(targets) > 1:
+                return self._merged(targets)
+        return super(ShardQuery, self).__iter__()
+
+    def _merge_key(self):
+        '''
+        A key for heapq.merge() that sorts rows the way the ORDER BY does,
+        or None if there is no ORDER BY.
+        '''
+        if not self._order_by:
+            return None
+        described = self.column_descriptions
+        if len(described) != 1 or \
+                described[0]['type'] is not described[0]['entity']:
+            raise ValueError('Only queries for a model can be ordered '
+                             'across shards, use on_shard() or Timeline')
+        mapper = inspect(described[0]['entity'])
+        fields = []
+        for clause in self._order_by:
+            descending = False
+            if isinstance(clause, UnaryExpression) and clause.modifier in (
+                    operators.asc_op, operators.desc_op):
+                descending = clause.modifier is operators.desc_op
+                clause = clause.element
+            try:
+                fields.append((mapper.get_property_by_column(clause).key,
+                               descending))
+            except (UnmappedColumnError, KeyError):
+                raise ValueError(f'Can\'t merge shards on {clause}, order by '
+                                 'columns of the model or use Timeline')
+
+        def compare(a, b):
+            for name, descending in fields:
+                x, y = getattr(a, name), getattr(b, name)
+                if x == y:
+                    continue
+                # NULLs first, like SQLite and MySQL.
+                if x is None or (y is not None and x < y):
+                    result = -1
+                else:
+                    result = 1
+                return -result if descending else result
+            return 0
+
+        return cmp_to_key(compare)
+
+    def _merged(self, targets):
+        # Every shard could hold the whole page, so each one returns all
+        # the rows up to its end and the merged rows get sliced here.
+        key = self._merge_key()
+        offset = self._offset or 0
+        stop = None if self._limit is None else offset + self._limit
+        query = self.limit(stop).offset(None)
+        results = [query.on_shard(shard).all() for shard in targets]
+        merged = chain(*results) if key is None else heapq.merge(*results,
+                                                                 key=key)
+        return islice(merged, offset, stop)
+
+    def count(self):
+        # A fan out COUNT returns one row per shard, so add them up here.
+        if self._shard is None and enabled():
+            targets = self._shards_for(self.statement)
+            if targets is not None and len(targets) > 1:
+                return sum(self.on_shard(shard).count() for shard in targets)
+        return super(ShardQuery, self).count()
+
+
+class Timeline(object):
+    '''
+    Rows of a sharded model by a set of users (or everyone), newest first.
+    Quacks enough like a Query for the views and the API: filter(), limit(),
+    paginate() and all(). Timelines are always ordered newest first, with
+    the id breaking ties, so order_by() is accepted and ignored.
+    Each shard returns its own newest rows, then heapq.merge does a k-way
+    merge on (timestamp, id).
+    '''
+    def __init__(self, model, user_ids=None, criteria=(), limit=None):
+        self.model = model
+        self.user_ids = user_ids
+        self.criteria = criteria
+        self._limit = limit
+
+    def filter(self, *criterion):
+        return Timeline(self.model, self.user_ids,
+                        self.criteria + criterion, self._limit)
+
+    def order_by(self, *clauses):
+        return self
+
+    def limit(self, limit):
+        return Timeline(self.model, self.user_ids, self.criteria, limit)
+
+    def _queries(self):
+        column = getattr(self.model, SHARDED[self.model.__tablename__])
+        if self.user_ids is None:
+            targets = {shard: None for shard in shards()}
+        else:
+            targets = defaultdict(list)
+            for user_id in set(self.user_ids):
+                targets[shard_for(user_id)].append(user_id)
+        for shard, ids in targets.items():
+            query = self.model.query.on_shard(shard).filter(*self.criteria)
+            if ids is not None:
+                query = query.filter(column.in_(ids))
+            yield query.order_by(self.model.timestamp.desc(),
+                                 self.model.id.desc())
+
+    def _merge(self, results):
+        return heapq.merge(*results,
+                           key=attrgetter('timestamp', 'id'),
+                           reverse=True)
+
+    def all(self):
+        queries = self._queries()
+        if self._limit is not None:
+            queries = (q.limit(self._limit) for q in queries)
+        return list(islice(self._merge(queries), self._limit))
+
+    def paginate(self, page, per_page, error_out=True):
+        queries = list(self._queries())
+        total = sum(query.order_by(None).count() for query in queries)
+        # A whole page could come from a single shard, so each shard has
+        # to hand over everything up to the end of the requested page.
+        newest = [query.limit(page * per_page).all() for query in queries]
+        items = list(
+            islice(self._merge(newest), (page - 1) * per_page,
+                   page * per_page))
+        return Pagination(None, page, per_page, total, items)
+
+
+def shard_table(table):
+    '''
+    A copy of a sharded table for creating on a shard. Foreign keys point
+    at tables on the primary database, so they are left out.
+    '''
+    copy = Table(
+        table.name, MetaData(), *[
+            Column(c.name, c.type, primary_key=c.primary_key)
+            for c in table.columns
+        ])
+    for index in table.indexes:
+        Index(index.name, *[copy.c[c.name] for c in index.columns],
+              unique=index.unique)
+    return copy
+
+
+def create_tables(db):
+    '''Create the sharded tables on every shard that doesn't have them.'''
+    for shard in shards():
+        for name in SHARDED:
+            shard_table(db.metadata.tables[name]).create(
+                db.get_engine(bind=shard), checkfirst=True)
+
+
+def redistribute(db, batch_size=5000, log=print):
+    '''
+    Move post and message rows to the shard they belong on. Reads the
+    primary and every shard, so it handles both turning sharding on and
+    changing the number of shards. Safe to run again after a crash: rows
+    are deleted from their target before being copied there. Rows with
+    no shard key, like a message without a recipient, stay where they are.
+
+    Returns the highest id seen, so new rows can be numbered after it.
+    '''
+    create_tables(db)
+    highest = 0
+    for name, key in SHARDED.items():
+        table = db.metadata.tables[name]
+        for source in [None] + shards():
+            engine = db.get_engine(bind=source)
+            if not engine.has_table(name):
+                continue
+            moved, stranded, last_id = 0, 0, 0
+            while True:
+                # Walk the primary key instead of using OFFSET, which gets
+                # slower the further in we are.
+                rows = engine.execute(
+                    select([table]).where(table.c.id > last_id).order_by(
+                        table.c.id).limit(batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                highest = max(highest, last_id)
+                targets = defaultdict(list)
+                for row in rows:
+                    if row[key] is None:
+                        # Nowhere to go, leave it where it is.
+                        stranded += 1
+                        continue
+                    target = shard_for(row[key])
+                    if target != source:
+                        targets[target].append(dict(row))
+                for target, moving in targets.items():
+                    ids = [row['id'] for row in moving]
+                    with db.get_engine(bind=target).begin() as conn:
+                        conn.execute(table.delete().where(table.c.id.in_(ids)))
+                        conn.execute(table.insert(), moving)
+                    with engine.begin() as conn:
+                        conn.execute(table.delete().where(table.c.id.in_(ids)))
+                    moved += len(moving)
+            log(f'{name}: moved {moved} rows off {source or "primary"}')
+            if stranded:
+                log(f'{name}: left {stranded} rows without {key} on '
+                    f'{source or "primary"}')
+    return highest
@@ -1,15 +1,51 @@
 import time, sys, json
+from functools import wraps
 from rq import get_current_job
 from app import create_app, db
-from app.models import Task
-from flask import render_template
+from flask import current_app, has_app_context, render_template
 from app.models import User, Post, Task
 from app.email import send_email
 
-# Make app and its db and email sending available to background tasks.
-# Pushing a context makes the application be the "current" application instance.
-app = create_app()
-app.app_context().push()
+_app = None
+
+
+def get_app():
+    '''
+    Make app and its db and email sending available to background tasks.
+    Pushing a context makes the application be the "current" application
+    instance. Done on the first task rather than at import, so importing
+    this module stays cheap.
+    '''
+    global _app
+    if _app is None:
+        if has_app_context():
+            # Already running inside an app, like in app/worker.py.
+            _app = current_app._get_current_object()
+        else:
+            _app = create_app()
+            _app.app_context().push()
+    return _app
+
+
+def timed(f):
+    '''
+    Time every run of a task in microblog_task_seconds, labelled with
+    whether it finished or failed.
+    '''
+    @wraps(f)
+    def run(*args, **kwargs):
+        get_app()
+        outcome = 'failed'
+        start = time.perf_counter()
+        try:
+            result = f(*args, **kwargs)
+            outcome = 'finished'
+            return result
+        finally:
+            current_app.metrics.task_duration.labels(
+                f.__name__, outcome).observe(time.perf_counter() - start)
+
+    return run
 
 
 # So tasks can set its progress
@@ -29,7 +65,9 @@ def _set_task_progress(progress):
 
 
 # Export JSON of all posts by the user, done on a background task.
+@timed
 def export_posts(user_id):
+    app = get_app()
     # RQ is doing task, not Flask, so exceptions not handled gracefully.
     try:
         user = User.query.get(user_id)
@@ -62,4 +100,6 @@ def export_posts(user_id):
     except:
         _set_task_progress(100)
         # Log stacktrace.
-        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
\ No newline at end of file
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        # And let rq (and the metrics) know it failed.
+        raise
\ No newline at end of file
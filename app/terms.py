@@ -0,0 +1,136 @@
+'''
+Hashtags and @mentions. They are pulled out of a post when it's written
+and stored in the post_tag and mention tables (see models.py), so the
+posts about a tag, or the posts mentioning someone, come off an index
+instead of a search round trip to Elasticsearch.
+
+    - index_posts() writes the rows for new posts. Call it after a flush,
+      it needs their ids.
+    - backfill() does the same for posts written before this existed.
+    - tagged() and mentioning() are the timelines, for cursors.page().
+'''
+import re
+from app import db, shards
+from app.models import User, Post, post_tags, mentions
+
+# A # or @ that starts a word, like in "#python" or "hi @susan", but not
+# "foo#bar" or an email address.
+TAG = re.compile(r'(?<![\w#])#(\w{1,64})')
+MENTION = re.compile(r'(?<![\w@])@(\w{1,64})')
+
+
+def extract(body):
+    '''The hashtags (lowercased) and the usernames mentioned in a post.'''
+    return ({tag.lower() for tag in TAG.findall(body)},
+            set(MENTION.findall(body)))
+
+
+def index_posts(posts):
+    '''
+    Write the post_tag and mention rows of posts. Mentions of usernames
+    that don't exist are dropped. One query for the usernames and at most
+    one INSERT per table, however many posts.
+    '''
+    tag_rows, mentioned = [], {}
+    for post in posts:
+        tags, usernames = extract(post.body)
+        tag_rows.extend({
+            'tag': tag,
+            'post_id': post.id,
+            'author_id': post.user_id,
+            'timestamp': post.timestamp
+        } for tag in tags)
+        for username in usernames:
+            mentioned.setdefault(username, []).append(post)
+    mention_rows = []
+    if mentioned:
+        for user_id, username in db.session.query(
+                User.id, User.username).filter(User.username.in_(mentioned)):
+            mention_rows.extend({
+                'user_id': user_id,
+                'post_id': post.id,
+                'author_id': post.user_id,
+                'timestamp': post.timestamp
+            } for post in mentioned[username])
+    if tag_rows:
+        db.session.execute(post_tags.insert(), tag_rows)
+    if mention_rows:
+        db.session.execute(mentions.insert(), mention_rows)
+    return len(tag_rows), len(mention_rows)
+
+
+def backfill(batch_size=1000, log=print):
+    '''
+    Index every post there is. Walks the posts by id, shard by shard if
+    sharded, and replaces the rows of each batch, so it's safe to run
+    again. Returns the number of posts read.
+    '''
+    done = 0
+    for shard in (shards.shards() or [None]):
+        last_id = 0
+        while True:
+            posts = Post.query.on_shard(shard).filter(
+                Post.id > last_id).order_by(Post.id).limit(batch_size).all()
+            if not posts:
+                break
+            ids = [post.id for post in posts]
+            for table in (post_tags, mentions):
+                db.session.execute(
+                    table.delete().where(table.c.post_id.in_(ids)))
+            tags, mentioned = index_posts(posts)
+            db.session.commit()
+            done += len(posts)
+            last_id = ids[-1]
+            log(f'{done} posts, {tags} tags and {mentioned} mentions in '
+                f'the last batch')
+    return done
+
+
+class Tagged(object):
+    '''
+    Posts listed in post_tag or mention, newest first. Quacks enough like
+    a Query for cursors.page(): filter(), order_by() and limit() apply to
+    the index table, then all() loads the posts by id, from the right
+    shards if sharded.
+    '''
+    def __init__(self, table, query):
+        self.table = table
+        self.query = query
+        self.cursor_keys = (table.c.timestamp, table.c.post_id)
+
+    def filter(self, *criterion):
+        return Tagged(self.table, self.query.filter(*criterion))
+
+    def order_by(self, *clauses):
+        return Tagged(self.table, self.query.order_by(*clauses))
+
+    def limit(self, limit):
+        return Tagged(self.table, self.query.limit(limit))
+
+    def all(self):
+        rows = self.query.all()
+        if not rows:
+            return []
+        # The author ids send the query to just their shards.
+        found = {
+            post.id: post
+            for post in Post.query.filter(
+                Post.user_id.in_({row.author_id for row in rows}),
+                Post.id.in_([row.post_id for row in rows]))
+        }
+        return [found[row.post_id] for row in rows if row.post_id in found]
+
+
+def _timeline(table, criterion):
+    return Tagged(
+        table,
+        db.session.query(table.c.post_id,
+                         table.c.author_id).filter(criterion))
+
+
+def tagged(tag):
+    return _timeline(post_tags, post_tags.c.tag == tag.lower())
+
+
+def mentioning(user):
+    return _timeline(mentions, mentions.c.user_id == user.id)
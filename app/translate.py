@@ -2,12 +2,22 @@
 Handle dynamic post translation using a Microsoft API.
 '''
 import json
-import requests
+from collections import OrderedDict
 from flask_babel import _
 from flask import current_app
 
+# The same post gets translated over and over by everyone reading it, so
+# remember recent answers. Least recently used entries fall off the end.
+_cache = OrderedDict()
+
 
 def translate(text, source_language, dest_language):
+    key = (text, source_language, dest_language)
+    if key in _cache:
+        _cache.move_to_end(key)
+        current_app.metrics.translation_cache.labels('hit').inc()
+        return _cache[key]
+    current_app.metrics.translation_cache.labels('miss').inc()
     if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config[
             'MS_TRANSLATOR_KEY']:
         return _('Error: the translation service is not configured.')
@@ -16,6 +26,8 @@ def translate(text, source_language, dest_language):
     }
     # Build text JSON object
     body = [{'Text': text}]
+    # requests is slow to import and only needed here, on a cache miss.
+    import requests
     r = requests.post(
         f'https://api.cognitive.microsofttranslator.com/translate?api-version=3.0&from={source_language}&to={dest_language}',
         headers=auth,
@@ -24,5 +36,10 @@ def translate(text, source_language, dest_language):
         return _('Error: the translation service failed.')
     else:
         print('Success!')
-    return (json.loads(
+    result = (json.loads(
         r.content.decode('utf-8-sig')))[0]['translations'][0]['text']
+    # Only successful translations are cached, errors get retried.
+    _cache[key] = result
+    while len(_cache) > current_app.config['TRANSLATION_CACHE_SIZE']:
+        _cache.popitem(last=False)
+    return result
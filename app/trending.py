@@ -0,0 +1,245 @@
+'''
+What's hot right now, without a GROUP BY over post on every request.
+
+Every new post feeds its hashtags and words into the current time bucket
+(TRENDING_BUCKET seconds long). Each bucket has:
+    - A count-min sketch: TRENDING_DEPTH rows of TRENDING_WIDTH counters.
+      A term bumps one counter per row, picked by a hash, and its count
+      is the smallest of those counters. Collisions can only make that
+      too high, never too low, and the memory is fixed however many
+      different terms there are.
+    - The top TRENDING_CANDIDATES terms by that count, the only ones that
+      can make the list. Anything smaller is dropped, so this is bounded
+      too.
+
+Once a minute the snapshot_trending job (app/maintenance.py) scores the
+candidates of the last TRENDING_WINDOW buckets, newer buckets weighing
+more (TRENDING_DECAY per bucket of age), and stores the top
+TRENDING_SIZE. Pages only ever read that snapshot, one lookup.
+
+With TRENDING_STORE=redis (the default) the buckets and the snapshot
+live in Redis and are shared by every process. 'memory' keeps them in the
+process, for tests and single process setups.
+'''
+import hashlib
+import json
+import re
+import time
+from array import array
+from app import terms
+
+# Words too common to ever be a topic.
+STOPWORDS = frozenset('''
+    about after again also back been before being could does doing down
+    from have having here into just like more most much only other over
+    really same should some such than that their them then there these
+    they this those through very want were what when where which while
+    will with would your yours
+'''.split())
+WORD = re.compile(r'(?<![#@\w])([^\W\d_]{4,32})\b')
+# Hashtags and words are ranked separately.
+KINDS = ('tags', 'words')
+
+
+def topics(body):
+    '''The hashtags and the topic words of a post.'''
+    tags, _ = terms.extract(body)
+    words = {w.lower() for w in WORD.findall(body)} - STOPWORDS
+    return {'tags': tags, 'words': words}
+
+
+def positions(term, width, depth):
+    '''Which counter the term uses in each row of a sketch.'''
+    digest = hashlib.blake2b(term.encode('utf-8'),
+                             digest_size=4 * depth).digest()
+    return [
+        int.from_bytes(digest[4 * row:4 * row + 4], 'little') % width
+        for row in range(depth)
+    ]
+
+
+class CountMinSketch(object):
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', [0]) * width for _ in range(depth)]
+
+    def add(self, term, count=1):
+        '''Count term, and return its new estimate.'''
+        estimate = None
+        for row, col in zip(self.rows,
+                            positions(term, self.width, self.depth)):
+            row[col] += count
+            estimate = row[col] if estimate is None else min(
+                estimate, row[col])
+        return estimate
+
+    def estimate(self, term):
+        return min(row[col] for row, col in zip(
+            self.rows, positions(term, self.width, self.depth)))
+
+
+class MemoryStore(object):
+    '''Buckets in this process: {(kind, bucket): (sketch, candidates)}.'''
+    def __init__(self, config):
+        self.config = config
+        self.buckets = {}
+        self.snapshot = None
+
+    def add(self, bucket, kind, names):
+        sketch, candidates = self.buckets.setdefault(
+            (kind, bucket),
+            (CountMinSketch(self.config['TRENDING_WIDTH'],
+                            self.config['TRENDING_DEPTH']), {}))
+        for name in names:
+            candidates[name] = sketch.add(name)
+        keep = self.config['TRENDING_CANDIDATES']
+        if len(candidates) > keep:
+            for name in sorted(candidates,
+                               key=candidates.get)[:len(candidates) - keep]:
+                del candidates[name]
+        # Forget buckets that fell out of the window.
+        oldest = bucket - self.config['TRENDING_WINDOW']
+        for key in [k for k in self.buckets if k[1] <= oldest]:
+            del self.buckets[key]
+
+    def counts(self, bucket, kind):
+        '''{name: estimate} for the candidates of one bucket.'''
+        sketch, candidates = self.buckets.get((kind, bucket), (None, {}))
+        return {name: sketch.estimate(name) for name in candidates}
+
+    def save(self, snapshot):
+        self.snapshot = snapshot
+
+    def load(self):
+        return self.snapshot
+
+
+class RedisStore(object):
+    '''
+    A sketch is a hash with a field per counter, "row:column". The
+    candidates are a sorted set scored by the estimate.
+    '''
+    def __init__(self, config, redis):
+        self.config = config
+        self.redis = redis
+
+    def _keys(self, bucket, kind):
+        return (f'microblog-trending:{kind}:{bucket}:sketch',
+                f'microblog-trending:{kind}:{bucket}:top')
+
+    def _fields(self, name):
+        return [
+            f'{row}:{col}' for row, col in enumerate(
+                positions(name, self.config['TRENDING_WIDTH'],
+                          self.config['TRENDING_DEPTH']))
+        ]
+
+    def add(self, bucket, kind, names):
+        names = list(names)
+        sketch, top = self._keys(bucket, kind)
+        # Keys live as long as the window, Redis drops them after that.
+        ttl = self.config['TRENDING_BUCKET'] * \
+            (self.config['TRENDING_WINDOW'] + 1)
+        depth = self.config['TRENDING_DEPTH']
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            for field in self._fields(name):
+                pipe.hincrby(sketch, field, 1)
+        pipe.expire(sketch, ttl)
+        counters = pipe.execute()
+        pipe = self.redis.pipeline(transaction=False)
+        for i, name in enumerate(names):
+            pipe.zadd(top, {name: min(counters[i * depth:(i + 1) * depth])})
+        # Keep only the biggest ones.
+        pipe.zremrangebyrank(top, 0,
+                             -self.config['TRENDING_CANDIDATES'] - 1)
+        pipe.expire(top, ttl)
+        pipe.execute()
+
+    def counts(self, bucket, kind):
+        sketch, top = self._keys(bucket, kind)
+        names = [n.decode('utf-8') for n in self.redis.zrange(top, 0, -1)]
+        if not names:
+            return {}
+        depth = self.config['TRENDING_DEPTH']
+        counters = self.redis.hmget(
+            sketch, [f for name in names for f in self._fields(name)])
+        return {
+            name: min(int(c or 0) for c in counters[i * depth:(i + 1) * depth])
+            for i, name in enumerate(names)
+        }
+
+    def save(self, snapshot):
+        self.redis.set('microblog-trending', json.dumps(snapshot))
+
+    def load(self):
+        snapshot = self.redis.get('microblog-trending')
+        return json.loads(snapshot) if snapshot else None
+
+
+class Trending(object):
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self._store = None
+
+    @property
+    def store(self):
+        # Made on first use, app.redis may not be usable before that.
+        if self._store is None:
+            if self.config['TRENDING_STORE'] == 'memory':
+                self._store = MemoryStore(self.config)
+            else:
+                self._store = RedisStore(self.config, self.app.redis)
+        return self._store
+
+    def bucket(self, now=None):
+        if now is None:
+            now = time.time()
+        return int(now // self.config['TRENDING_BUCKET'])
+
+    def add(self, bodies, now=None):
+        '''Count the topics of new posts. Never fails the post over it.'''
+        import redis
+        found = {kind: [] for kind in KINDS}
+        for body in bodies:
+            for kind, names in topics(body).items():
+                found[kind].extend(names)
+        bucket = self.bucket(now)
+        try:
+            for kind, names in found.items():
+                if names:
+                    self.store.add(bucket, kind, names)
+        except redis.exceptions.RedisError:
+            self.app.logger.exception('Could not count trending topics')
+
+    def snapshot(self, now=None):
+        '''Score the candidates of the window and store the top ones.'''
+        current = self.bucket(now)
+        decay = self.config['TRENDING_DECAY']
+        snapshot = {'generated': int(time.time() if now is None else now)}
+        for kind in KINDS:
+            scores = {}
+            for age in range(self.config['TRENDING_WINDOW']):
+                weight = decay**age
+                for name, count in self.store.counts(current - age,
+                                                     kind).items():
+                    scores[name] = scores.get(name, 0) + weight * count
+            best = sorted(scores.items(), key=lambda item: (-item[1],
+                                                            item[0]))
+            snapshot[kind] = [{
+                'name': name,
+                'score': round(score, 2)
+            } for name, score in best[:self.config['TRENDING_SIZE']]]
+        self.store.save(snapshot)
+        return snapshot
+
+    def current(self):
+        '''The last snapshot, or an empty one.'''
+        import redis
+        try:
+            snapshot = self.store.load()
+        except redis.exceptions.RedisError:
+            snapshot = None
+        return snapshot or {'generated': None, 'tags': [], 'words': []}
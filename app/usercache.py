@@ -0,0 +1,198 @@
+'''
+Flask-Login loads the user on every logged in request, before the view
+even runs. Most pages only want a few columns of it, for the navbar and
+the templates, so those are cached as a small record and current_user
+becomes a CachedUser made from it. No query on user at all.
+
+A CachedUser answers the record's fields, and User methods that only need
+those (READ_METHODS). Anything else, like setting an attribute or calling
+follow(), loads the real User from the database first and from then on
+the CachedUser hands everything to it. So views don't need to care.
+
+Every user also has a version number. Committing any change to a user,
+other than __lag_tolerant__ columns like last_seen, bumps it, and records
+built from an older version are ignored. A record is built from the
+version it saw before reading the database, so a change committed while
+it was being built can't sneak a stale record in.
+
+With USER_CACHE=redis (the default) records and versions are shared by
+every process. 'memory' keeps them per process, for tests and single
+process setups, and 'off' goes back to querying every time.
+'''
+from collections import OrderedDict
+import orjson
+from flask import current_app, has_app_context
+from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from app import db
+from app.models import User
+
+# What goes in a record. Bump RECORD_VERSION when changing this, so
+# records of the old shape are never read.
+FIELDS = ('id', 'username', 'email', 'avatar_hash', 'about_me',
+          'unread_messages')
+RECORD_VERSION = 1
+# User methods that work with just the record.
+READ_METHODS = ('avatar', 'new_messages', 'followed_posts', 'is_following',
+                'conversation', 'get_tasks_in_progress',
+                'get_task_in_progress')
+
+
+class CachedUser(UserMixin):
+    '''current_user made from a record, see above.'''
+    def __init__(self, record):
+        self.__dict__['_record'] = record
+        self.__dict__['_user'] = None
+
+    def _load(self):
+        if self._user is None:
+            self.__dict__['_user'] = User.query.get(self._record['id'])
+        return self._user
+
+    def __getattr__(self, name):
+        # Only called for what isn't found the normal way.
+        if self._user is None:
+            if name in self._record:
+                return self._record[name]
+            if name in READ_METHODS:
+                return getattr(User, name).__get__(self)
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return f'<CachedUser {self._record["username"]}>'
+
+
+class MemoryStore(object):
+    def __init__(self, config):
+        self.config = config
+        self.records = OrderedDict()
+        self.versions = {}
+
+    def get(self, id):
+        '''The record of id (or None) and the current version.'''
+        record = self.records.get(id)
+        if record is not None:
+            self.records.move_to_end(id)
+        return record, self.versions.get(id, 0)
+
+    def set(self, id, record):
+        self.records[id] = record
+        while len(self.records) > self.config['USER_CACHE_SIZE']:
+            self.records.popitem(last=False)
+
+    def bump(self, ids):
+        for id in ids:
+            self.versions[id] = self.versions.get(id, 0) + 1
+
+
+class RedisStore(object):
+    def __init__(self, config, redis):
+        self.config = config
+        self.redis = redis
+
+    def _keys(self, id):
+        return (f'microblog-user:{RECORD_VERSION}:{id}',
+                f'microblog-user-version:{id}')
+
+    def get(self, id):
+        record, version = self.redis.mget(self._keys(id))
+        return (orjson.loads(record) if record else None, int(version or 0))
+
+    def set(self, id, record):
+        self.redis.set(self._keys(id)[0], orjson.dumps(record),
+                       ex=self.config['USER_CACHE_TTL'])
+
+    def bump(self, ids):
+        # Versions outlive any record made before the bump. Otherwise an
+        # expired version would read as 0 again and match old records.
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            version = self._keys(id)[1]
+            pipe.incr(version)
+            pipe.expire(version, self.config['USER_CACHE_TTL'] * 2)
+        pipe.execute()
+
+
+class UserCache(object):
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self._store = None
+
+    @property
+    def store(self):
+        # Made on first use, app.redis may not be usable before that.
+        if self._store is None:
+            if self.config['USER_CACHE'] == 'memory':
+                self._store = MemoryStore(self.config)
+            else:
+                self._store = RedisStore(self.config, self.app.redis)
+        return self._store
+
+    def _record(self, id):
+        # From the primary, a replica could hand us a version behind.
+        with db.primary():
+            row = db.session.query(*[getattr(User, f)
+                                     for f in FIELDS]).filter(
+                                         User.id == id).first()
+        return dict(zip(FIELDS, row)) if row is not None else None
+
+    def get(self, id):
+        '''What the user loader returns: a CachedUser, or None.'''
+        import redis
+        if self.config['USER_CACHE'] == 'off':
+            return User.query.get(id)
+        try:
+            record, version = self.store.get(id)
+        except redis.exceptions.RedisError:
+            self.app.logger.exception('Could not read the user cache')
+            return User.query.get(id)
+        if record is None or record['version'] != version:
+            record = self._record(id)
+            if record is None:
+                return None
+            record['version'] = version
+            try:
+                self.store.set(id, record)
+            except redis.exceptions.RedisError:
+                self.app.logger.exception('Could not write the user cache')
+        return CachedUser(record)
+
+    def invalidate(self, ids):
+        import redis
+        if self.config['USER_CACHE'] == 'off' or not ids:
+            return
+        try:
+            self.store.bump(ids)
+        except redis.exceptions.RedisError:
+            # Records can be stale for up to USER_CACHE_TTL now.
+            self.app.logger.exception('Could not invalidate the user cache')
+
+
+def _collect(session, flush_context, instances):
+    '''Note the users this flush changes, to invalidate on commit.'''
+    ids = session.info.setdefault('user_cache_ids', set())
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, User):
+            changed = set(inspect(obj).committed_state)
+            if obj in session.deleted or \
+                    changed - set(User.__lag_tolerant__):
+                ids.add(obj.id)
+
+
+def _invalidate(session):
+    ids = session.info.pop('user_cache_ids', None)
+    if ids and has_app_context():
+        current_app.user_cache.invalidate(ids)
+
+
+def _forget(session):
+    session.info.pop('user_cache_ids', None)
+
+
+event.listen(db.session, 'before_flush', _collect)
+event.listen(db.session, 'after_commit', _invalidate)
+event.listen(db.session, 'after_rollback', _forget)
@@ -0,0 +1,182 @@
+'''
+Usernames kept in memory, for @-mention autocomplete and for checking if
+a username or email is free without asking the database every time.
+
+    - A sorted list of (lowercased username, username, id). The names
+      starting with a prefix sit next to each other, so complete() is a
+      bisect plus a short slice, instead of a LIKE 'prefix%' over user.
+    - A Bloom filter of every username and email. If it says a name was
+      never added, nobody has it, and available() answers without a
+      query. If it says maybe, the database decides, as before. Renames
+      leave the old name in the filter, which only costs that query.
+
+Each process builds the index on first use, from one query over user.
+Users created or renamed by this process are applied on commit. Other
+processes' new users are picked up every USERNAME_INDEX_REFRESH seconds
+with a query for ids above the highest one we have, and everything is
+rebuilt every USERNAME_INDEX_REBUILD seconds to catch their renames.
+Until then another process's brand new username can look free here, so
+the unique indexes on user stay the final word: registering and the API
+answer an IntegrityError like any taken name.
+'''
+import hashlib
+import math
+import threading
+import time
+from bisect import bisect_left
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from app import db
+from app.models import User
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        # The usual sizing: m bits and k hashes for n items at rate p.
+        self.size = max(8, int(-capacity * math.log(error_rate) /
+                               math.log(2)**2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Two hashes make all k of them (Kirsch and Mitzenmacher).
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for bit in self._positions(key):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[bit >> 3] & (1 << (bit & 7))
+                   for bit in self._positions(key))
+
+
+class UsernameIndex(object):
+    def __init__(self, app):
+        self.config = app.config
+        self.lock = threading.Lock()
+        self.entries = None
+        self.bloom = None
+        self.max_id = 0
+        self.refreshed = self.built = 0
+
+    def _build(self):
+        bloom = BloomFilter(self.config['USERNAME_BLOOM_CAPACITY'],
+                            self.config['USERNAME_BLOOM_ERROR_RATE'])
+        entries, max_id = [], 0
+        for id, username, email in db.session.query(User.id, User.username,
+                                                    User.email):
+            entries.append((username.lower(), username, id))
+            bloom.add('username:' + username)
+            if email:
+                bloom.add('email:' + email)
+            max_id = max(max_id, id)
+        entries.sort()
+        self.entries, self.bloom, self.max_id = entries, bloom, max_id
+        self.refreshed = self.built = time.monotonic()
+
+    def _refresh(self):
+        '''Build, or catch up with other processes, when it's time.'''
+        now = time.monotonic()
+        if self.entries is None or \
+                now - self.built > self.config['USERNAME_INDEX_REBUILD']:
+            with self.lock:
+                self._build()
+        elif now - self.refreshed > self.config['USERNAME_INDEX_REFRESH']:
+            with self.lock:
+                for id, username, email in db.session.query(
+                        User.id, User.username,
+                        User.email).filter(User.id > self.max_id):
+                    self._add(id, username, email)
+                self.refreshed = now
+
+    def _add(self, id, username, email):
+        entry = (username.lower(), username, id)
+        i = bisect_left(self.entries, entry)
+        if i == len(self.entries) or self.entries[i] != entry:
+            self.entries.insert(i, entry)
+        self.bloom.add('username:' + username)
+        if email:
+            self.bloom.add('email:' + email)
+        self.max_id = max(self.max_id, id)
+
+    def _remove(self, id, username):
+        entry = (username.lower(), username, id)
+        i = bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def apply(self, changes):
+        '''Changes committed by this process, see _collect() below.'''
+        if self.entries is None:
+            # Not built yet, the build will see them.
+            return
+        with self.lock:
+            for id, old, new, email in changes:
+                if old is not None:
+                    self._remove(id, old)
+                self._add(id, new, email)
+
+    def complete(self, prefix, limit=10):
+        '''Up to limit (id, username) starting with prefix, any case.'''
+        self._refresh()
+        prefix = prefix.lower()
+        entries = self.entries
+        i = bisect_left(entries, (prefix, ))
+        found = []
+        while i < len(entries) and len(found) < limit and \
+                entries[i][0].startswith(prefix):
+            found.append((entries[i][2], entries[i][1]))
+            i += 1
+        return found
+
+    def available(self, username):
+        self._refresh()
+        if 'username:' + username not in self.bloom:
+            return True
+        # Taken if we have it. Not having it could be a false positive of
+        # the filter or a rename, only the database knows.
+        entries = self.entries
+        i = bisect_left(entries, (username.lower(), username))
+        if i < len(entries) and entries[i][1] == username:
+            return False
+        return User.query.filter_by(username=username).first() is None
+
+    def email_available(self, email):
+        self._refresh()
+        if 'email:' + email not in self.bloom:
+            return True
+        return User.query.filter_by(email=email).first() is None
+
+
+def _collect(session, flush_context, instances):
+    '''Note new and renamed users, to apply once they are committed.'''
+    changes = session.info.setdefault('username_changes', [])
+    for obj in session.new:
+        if isinstance(obj, User) and obj.username:
+            changes.append((obj, None))
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            history = inspect(obj).attrs.username.history
+            if history.deleted and history.added:
+                changes.append((obj, history.deleted[0]))
+
+
+def _apply(session):
+    changes = session.info.pop('username_changes', None)
+    if changes and has_app_context():
+        # Read the attributes now, the commit is about to expire them.
+        current_app.usernames.apply([(obj.id, old, obj.username, obj.email)
+                                     for obj, old in changes])
+
+
+def _forget(session):
+    session.info.pop('username_changes', None)
+
+
+event.listen(db.session, 'before_flush', _collect)
+event.listen(db.session, 'after_commit', _apply)
+event.listen(db.session, 'after_rollback', _forget)
@@ -0,0 +1,112 @@
+'''
+A warm rq worker. The stock 'rq worker' forks a fresh work horse for every
+job, and the horse builds the app again before it can start, so a job that
+takes a millisecond still costs the fork, the app setup and new database
+connections.
+
+Here the app is built once, then the children are forked from it, as
+many per pool as asked for (see app/queues.py for the pools). Each child
+runs jobs one after the other in its own process, inside that app,
+reusing its connection pools. Crash isolation stays at the process level:
+    - A job that raises is failed by rq as usual, and the child moves on.
+    - A job that takes the whole process down (segfault, os._exit, the OOM
+      killer) only loses that child. The supervisor forks a replacement,
+      and rq moves the job to the failed registry when its heartbeat
+      expires.
+    - Children are also replaced after max_jobs jobs, so a slow leak in a
+      task can't grow forever.
+
+Run it with 'flask worker'.
+'''
+import gc
+import os
+import signal
+from rq import Queue, SimpleWorker
+from app import db, reset_connections
+
+
+class WarmWorker(SimpleWorker):
+    '''Runs each job in this process, in the already pushed app context.'''
+    def perform_job(self, job, queue, heartbeat_ttl=None):
+        try:
+            return super(WarmWorker, self).perform_job(
+                job, queue, heartbeat_ttl=heartbeat_ttl)
+        finally:
+            # Jobs share the app context, so give each a fresh session. Its
+            # connection goes back to the pool for the next job.
+            db.session.remove()
+
+
+def _work(app, queues, burst, max_jobs):
+    gc.enable()
+    reset_connections(app)
+    app.app_context().push()
+    connection = app.redis._get_current_object()
+    worker = WarmWorker(queues, connection=connection)
+    worker.work(burst=burst, max_jobs=max_jobs)
+
+
+def _pending(app, queues):
+    '''If any of these queues has jobs waiting.'''
+    connection = app.redis._get_current_object()
+    return any(Queue(name, connection=connection).count for name in queues)
+
+
+def run(app, pools, burst=False, max_jobs=1000, log=print):
+    '''
+    pools is a list of (rq queue names, number of workers). Fork the warm
+    workers and keep them all running until SIGTERM or SIGINT. With burst,
+    return once they have emptied their queues.
+    '''
+    # Load the task module now, so every child gets it for free.
+    from app import tasks  # noqa: F401
+    # pid: the queues of that child
+    children = {}
+    stopping = []
+
+    def spawn(queues):
+        # Freeze what we built so far, like gunicorn.conf.py does, so the
+        # children keep sharing those pages.
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                _work(app, queues, burst, max_jobs)
+            except BaseException:
+                app.logger.exception('Worker crashed')
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = queues
+
+    def stop(signum, frame):
+        # rq treats SIGTERM as "finish the current job, then exit".
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    gc.disable()
+    for queues, concurrency in pools:
+        for _ in range(concurrency):
+            spawn(queues)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        queues = children.pop(pid)
+        if stopping:
+            continue
+        clean = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        # A clean exit in burst mode is either an empty queue or max_jobs,
+        # only the second needs a replacement.
+        if burst and clean and not _pending(app, queues):
+            continue
+        if not clean:
+            log(f'worker {pid} died ({status}), starting a new one')
+        spawn(queues)
@@ -22,6 +22,33 @@ class Config(object):
     # Disable feature that signals application every time
     # a change is about to made to db.
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Optional read replicas, comma separated. Reads during GET requests
+    # are spread over these, everything else uses the database above.
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',')
+        if uri
+    ]
+    # Seconds a client keeps reading from the primary after changing
+    # something, so they always see their own writes.
+    REPLICA_READ_YOUR_WRITES = int(
+        os.environ.get('REPLICA_READ_YOUR_WRITES') or 5)
+    # Where those windows are kept, by user id: 'redis' so every worker
+    # sees them, or 'memory' for a single process.
+    REPLICA_WINDOW_STORE = os.environ.get('REPLICA_WINDOW_STORE') or 'redis'
+    # Tune SQLite for several gunicorn workers (WAL and friends, see
+    # app/sqlite.py). Ignored for other databases.
+    SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE') is not None
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 268435456)
+    # Negative means KiB rather than pages, so this is 64MB per connection.
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -64000)
+    # Milliseconds a writer waits for the lock before giving up.
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    # Optional shards for the post and message tables, comma separated.
+    # Run 'flask shards migrate' after changing this.
+    SQLALCHEMY_SHARD_URIS = [
+        uri for uri in (os.environ.get('DATABASE_SHARD_URLS') or '').split(',')
+        if uri
+    ]
 
     # So we can get emails about errors during production
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
@@ -41,6 +68,9 @@ class Config(object):
     # For dynamic translations, Microsoft API is used, which requires
     # Azure account.
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    # How many translations each process remembers.
+    TRANSLATION_CACHE_SIZE = int(
+        os.environ.get('TRANSLATION_CACHE_SIZE') or 1024)
 
     # For sitewide searching of posts, use Elasticsearch from the
     # ELK stack
@@ -50,4 +80,99 @@ class Config(object):
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
 
     # Background task manager. 2nd option assumes running on localhost
-    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # The rq queue of each task, see app/queues.py. Tasks not listed here
+    # go on the interactive queue.
+    TASK_ROUTES = {'export_posts': 'bulk'}
+    # Worker processes 'flask worker' runs per queue, as queue=count pairs.
+    WORKER_POOLS = {
+        name: int(count)
+        for name, count in (pair.split('=') for pair in (
+            os.environ.get('WORKER_POOLS')
+            or 'interactive=2,bulk=1,maintenance=1').split(','))
+    }
+    # Housekeeping jobs, see app/maintenance.py. Each works through rows
+    # this many at a time, one short transaction per batch, and stops after
+    # the budget in seconds so it never holds locks or a worker for long.
+    # Whatever is left is picked up by the next run.
+    MAINTENANCE_BATCH_SIZE = int(
+        os.environ.get('MAINTENANCE_BATCH_SIZE') or 500)
+    MAINTENANCE_BUDGET = int(os.environ.get('MAINTENANCE_BUDGET') or 30)
+    # Days notifications are kept. Clients poll them every few seconds, so
+    # anything older has long been seen.
+    NOTIFICATION_RETENTION = int(
+        os.environ.get('NOTIFICATION_RETENTION') or 7)
+    # Trending topics, see app/trending.py. 'redis' shares the counts
+    # between processes, 'memory' keeps them per process.
+    TRENDING_STORE = os.environ.get('TRENDING_STORE') or 'redis'
+    # Seconds per time bucket, and how many buckets make up the window.
+    TRENDING_BUCKET = int(os.environ.get('TRENDING_BUCKET') or 300)
+    TRENDING_WINDOW = int(os.environ.get('TRENDING_WINDOW') or 12)
+    # Weight of a bucket relative to the next newer one.
+    TRENDING_DECAY = float(os.environ.get('TRENDING_DECAY') or 0.8)
+    # Count-min sketch size per bucket. 4 rows of 2048 counters keep the
+    # overcount tiny for the few thousand terms a bucket sees.
+    TRENDING_WIDTH = 2048
+    TRENDING_DEPTH = 4
+    # Terms tracked per bucket, and how many make the trending list.
+    TRENDING_CANDIDATES = 200
+    TRENDING_SIZE = 10
+    # The in-memory username index (app/usernames.py) looks for users made
+    # by other processes this often, in seconds, and rebuilds from scratch
+    # this often to catch their renames.
+    USERNAME_INDEX_REFRESH = int(os.environ.get('USERNAME_INDEX_REFRESH') or 10)
+    USERNAME_INDEX_REBUILD = int(
+        os.environ.get('USERNAME_INDEX_REBUILD') or 3600)
+    # Sizes the Bloom filter of taken usernames and emails, two per user.
+    # The default is about 1.2MB at 1% false positives. Past capacity it
+    # just gets less sure, and more checks go to the database.
+    USERNAME_BLOOM_CAPACITY = int(
+        os.environ.get('USERNAME_BLOOM_CAPACITY') or 1000000)
+    USERNAME_BLOOM_ERROR_RATE = 0.01
+    # Most names /api/users/complete returns.
+    USERNAME_COMPLETIONS = 10
+    # Where logged in users are cached between requests, see
+    # app/usercache.py: 'redis', 'memory' (per process) or 'off'.
+    USER_CACHE = os.environ.get('USER_CACHE') or 'redis'
+    # Seconds a cached user lives without being read back, and how many a
+    # 'memory' cache holds.
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 3600)
+    USER_CACHE_SIZE = 10000
+    # Password hashing, see app/passwords.py. The method sets the work
+    # factor of new hashes.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+        'pbkdf2:sha256:150000'
+    # Hashing processes per web process, 0 to hash in the request thread.
+    PASSWORD_HASH_PROCESSES = int(
+        os.environ.get('PASSWORD_HASH_PROCESSES') or 1)
+    # Hashes at once over all workers. Keep it below the worker count, so
+    # some are always free for everything else.
+    PASSWORD_HASH_CONCURRENCY = int(
+        os.environ.get('PASSWORD_HASH_CONCURRENCY') or 2)
+    # Requests that may wait for a turn, and for how long in seconds,
+    # before getting a 503. A waiting request holds a whole sync worker,
+    # so keep these small.
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 1)
+    PASSWORD_HASH_WAIT = float(os.environ.get('PASSWORD_HASH_WAIT') or 0.5)
+    # Limits for the expensive routes, see app/limits.py. Keyed by
+    # endpoint, or by blueprint for all of its endpoints, an endpoint's
+    # own entry winning. 'rate' (per second) and 'burst' make a token
+    # bucket per user, 'concurrency' caps the requests an endpoint runs at
+    # once over all workers. Either can be left out.
+    RATE_LIMITS = {
+        'main.search': {'rate': 0.5, 'burst': 10, 'concurrency': 4},
+        'main.translate_text': {'rate': 0.5, 'burst': 10, 'concurrency': 4},
+        'main.export_posts': {'rate': 1 / 60, 'burst': 2},
+        'api.export_posts': {'rate': 1 / 60, 'burst': 2, 'concurrency': 2},
+        'api': {'rate': 10, 'burst': 50, 'concurrency': 8},
+    }
+    # 'redis' shares the limits between workers, 'memory' counts per
+    # process, 'off' disables them.
+    RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE') or 'redis'
+    # Seconds to count in memory after Redis fails, before trying again.
+    RATE_LIMIT_FALLBACK = 30
+    # A request still counted as running after this many seconds is
+    # assumed to have died with its worker.
+    RATE_LIMIT_STALE = 120
+    # Retry-After of a 503 for a full endpoint.
+    RATE_LIMIT_RETRY_AFTER = 5
@@ -0,0 +1,54 @@
+'''
+Gunicorn settings for serving microblog. Gunicorn reads this file from the
+directory it starts in, the Procfile names it to be explicit.
+
+The app is built once in the master (preload_app) and the workers are
+forked from it, so they all start out sharing the master's memory pages.
+Pages only get copied when a worker writes to them, and CPython writes
+to an object's header whenever the garbage collector scans it. Freezing
+the collector right before forking moves everything the master made out
+of its reach, so the shared pages stay shared.
+
+Every setting can be overridden on the gunicorn command line.
+'''
+import gc
+import multiprocessing
+import os
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '5000')
+# Heroku and others set WEB_CONCURRENCY to what fits the dyno.
+workers = int(
+    os.environ.get('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+preload_app = True
+# Recycle workers now and then so slow leaks can't grow forever. The
+# jitter keeps them from all restarting at once.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS') or 10000)
+max_requests_jitter = max_requests // 10
+
+# No collections while the master imports and builds the app. Each one
+# would only promote objects to older generations for nothing, since
+# everything gets frozen before the fork anyway.
+gc.disable()
+
+
+def pre_fork(server, worker):
+    # Runs in the master before every fork, including the ones replacing
+    # recycled workers.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+    # Connections opened in the master would be shared by every worker,
+    # and two processes talking over one socket corrupts both. Start each
+    # worker with empty pools.
+    from app import reset_connections
+    reset_connections(worker.app.wsgi())
+
+
+def child_exit(server, worker):
+    from app.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+    # A worker killed in the middle of hashing a password still holds its
+    # turn, see app/passwords.py.
+    worker.app.wsgi().passwords.reclaim(worker.pid)
@@ -4,7 +4,7 @@ Python script to define Flask application instance.
         flask run
 '''
 from app import create_app, db, cli
-from app.models import User, Post
+from app.models import User, Post, Message, Notification, Task, Thread
 
 app = create_app()
 cli.register(app)
@@ -24,5 +24,6 @@ def make_shell_context():
         'Post': Post,
         'Message': Message,
         'Notification': Notification,
-        'Task': Task
+        'Task': Task,
+        'Thread': Thread
     }
@@ -1,7 +1,29 @@
 from datetime import datetime, timedelta
+import base64
+import gc
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
 import unittest
-from app import app, db
-from app.models import User, Post
+import redis
+from flask import _app_ctx_stack, current_app
+from rq import Queue
+from rq.job import Job
+from app import create_app, db, limits, maintenance, reset_connections, \
+    shards, tasks, terms, worker
+from app.models import User, Post, Notification, Task, Thread, \
+    IdTicket, followers, post_tags, mentions, avatar_digest, avatar_url
+from app.api.serializers import user_collection
+from app.passwords import Overloaded
+from app.queues import pool_queues, queue_for
+from app.trending import CountMinSketch
 from config import Config
 
 
@@ -9,6 +31,37 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    TRENDING_STORE = 'memory'
+    USER_CACHE = 'memory'
+    # Hash in the test process, and quickly.
+    PASSWORD_HASH_PROCESSES = 0
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    RATE_LIMIT_STORE = 'memory'
+    REPLICA_WINDOW_STORE = 'memory'
+
+
+class AppCase(unittest.TestCase):
+    '''A fresh app with empty tables and its context pushed, per test.'''
+    Config = TestConfig
+
+    def setUp(self):
+        self.app = create_app(self.Config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def client_for(self, user_id):
+        '''A test client signed in as user_id, like login_user() does.'''
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(user_id)
+            session['_fresh'] = True
+        return client
 
 
 class UserModelCase(unittest.TestCase):
@@ -38,6 +91,10 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+        # The digest follows the email, and ignores its case.
+        u.email = 'Susan@Example.com'
+        self.assertEqual(u.avatar_hash, avatar_digest('susan@example.com'))
+        self.assertEqual(u.avatar(36), avatar_url(u.avatar_hash, 36))
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -62,6 +119,29 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_threads(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u2.send_message(u1, 'hi')
+        u2.send_message(u1, 'there')
+        u3.send_message(u1, 'hello')
+        u1.send_message(u2, 'hey')
+        db.session.commit()
+        self.assertEqual(u1.new_messages(), 3)
+        self.assertEqual(u2.new_messages(), 1)
+        inbox = u1.threads.order_by(Thread.last_timestamp.desc()).all()
+        self.assertEqual([(t.peer, t.last_body, t.unread) for t in inbox],
+                         [(u2, 'hey', 2), (u3, 'hello', 1)])
+        self.assertEqual([m.body for m in u1.conversation(u2)],
+                         ['hey', 'there', 'hi'])
+        self.assertEqual(u1.read_thread(u2), 2)
+        db.session.commit()
+        self.assertEqual(u1.new_messages(), 1)
+        self.assertEqual(u1.read_thread(u2), 0)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -105,5 +185,1124 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class MetricsCase(unittest.TestCase):
+    def test_uppercase_multiproc_dir(self):
+        # The pinned prometheus_client only reads prometheus_multiproc_dir,
+        # app/metrics.py has to make the uppercase name work. Needs a fresh
+        # interpreter, prometheus_client looks at it on import.
+        tmp = tempfile.mkdtemp()
+        try:
+            env = {k: v for k, v in os.environ.items()
+                   if k.lower() != 'prometheus_multiproc_dir'}
+            env['PROMETHEUS_MULTIPROC_DIR'] = tmp
+            script = (
+                'from tests import TestConfig\n'
+                'from app import create_app\n'
+                'client = create_app(TestConfig).test_client()\n'
+                'client.get("/auth/login")\n'
+                'response = client.get("/metrics")\n'
+                'assert response.status_code == 200, response.status_code\n'
+                'assert b"microblog_request_seconds" in response.data\n')
+            subprocess.run([sys.executable, '-c', script], env=env,
+                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                           check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            self.assertTrue(os.listdir(tmp))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_pool_wait(self):
+        app = create_app(TestConfig)
+        waits = {}
+
+        def count():
+            waits[len(waits)] = app.metrics.registry.get_sample_value(
+                'microblog_db_pool_wait_seconds_count')
+
+        with app.app_context():
+            db.session.execute('SELECT 1')
+            db.session.remove()
+            count()
+            # A new pool after dispose() is timed as well.
+            reset_connections(app)
+            db.session.execute('SELECT 1')
+            db.session.remove()
+            count()
+        self.assertGreaterEqual(waits[0], 1)
+        self.assertGreater(waits[1], waits[0])
+
+    def test_task_duration(self):
+        app = create_app(TestConfig)
+
+        def broken():
+            raise ValueError('broken')
+
+        with app.app_context():
+            with self.assertRaises(ValueError):
+                tasks.timed(broken)()
+            self.assertEqual(tasks.timed(lambda: 42)(), 42)
+        self.assertEqual(app.metrics.registry.get_sample_value(
+            'microblog_task_seconds_count',
+            {'task': 'broken', 'outcome': 'failed'}), 1)
+        self.assertEqual(app.metrics.registry.get_sample_value(
+            'microblog_task_seconds_count',
+            {'task': '<lambda>', 'outcome': 'finished'}), 1)
+
+
+class QueryRecorder(object):
+    '''
+    Capture every SQL statement sent to the database while active, along
+    with where in our code it came from. Use it as a context manager:
+
+        with QueryRecorder(db.engine) as queries:
+            client.get('/index')
+        print(len(queries.statements))
+    '''
+    # Only show our own frames in the call stacks, not Flask's or SQLAlchemy's.
+    app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        db.event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *args):
+        db.event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        stack = [
+            frame for frame in traceback.extract_stack()[:-1]
+            if frame.filename.startswith(self.app_dir)
+        ]
+        self.statements.append((statement, stack))
+
+    def report(self):
+        '''Every statement followed by the app code that issued it.'''
+        lines = []
+        for i, (statement, stack) in enumerate(self.statements, 1):
+            lines.append(f'{i}. {" ".join(statement.split())}')
+            lines.extend('      ' + line.rstrip()
+                         for line in traceback.format_list(stack))
+        return '\n'.join(lines)
+
+
+class QueryBudgetCase(AppCase):
+    '''
+    Every hot page gets a fixed number of SQL queries it may issue. The
+    fixtures below make sure a per-row query (the classic N+1) would blow
+    through the budget, since every page has more rows than its budget.
+    If a change makes a page cheaper, lower its budget here. Raising one
+    should be a deliberate decision, not a way to make the test pass.
+    '''
+    budgets = {
+        'main.index': 11,
+        'main.explore': 10,
+        'main.user': 8,
+        'main.user_popup': 4,
+        'main.messages': 4,
+        'main.conversation': 13,
+        'api.get_user': 3,
+        'api.get_users': 4,
+        'api.get_followers': 5,
+        'api.get_followed': 5,
+        'api.get_posts': 3,
+        'api.get_user_posts': 4,
+        'api.get_timeline': 3,
+        'api.get_tagged_posts': 4,
+        'api.get_mentions': 5,
+    }
+
+    def setUp(self):
+        # A copy, so a test can adjust a budget without leaking it.
+        self.budgets = dict(self.budgets)
+        super(QueryBudgetCase, self).setUp()
+        now = datetime.utcnow()
+        users = [
+            User(username=f'user{i}', email=f'user{i}@example.com')
+            for i in range(12)
+        ]
+        db.session.add_all(users)
+        for i, user in enumerate(users):
+            db.session.add_all([
+                Post(body=f'post {j} from {user.username}',
+                     author=user,
+                     timestamp=now - timedelta(minutes=i * 10 + j))
+                for j in range(3)
+            ])
+        db.session.commit()
+        for user in users:
+            user.send_message(users[0], f'hi from {user.username}')
+        db.session.commit()
+        for user in users[1:]:
+            users[0].follow(user)
+            user.follow(users[0])
+        db.session.commit()
+        self.user_id = users[0].id
+        self.username = users[0].username
+        self.token = users[0].get_token()
+        db.session.commit()
+        self.client = self.client_for(self.user_id)
+
+    def assertQueryBudget(self, endpoint, url):
+        '''Request url and fail if it runs more queries than allowed.'''
+        budget = self.budgets[endpoint]
+        with QueryRecorder(db.engine) as queries:
+            response = self.client.get(
+                url, headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.status_code, 200)
+        if len(queries.statements) > budget:
+            self.fail(f'{endpoint} ran {len(queries.statements)} queries, '
+                      f'budget is {budget}:\n{queries.report()}')
+        return response
+
+    def test_main_budgets(self):
+        self.assertQueryBudget('main.index', '/index')
+        self.assertQueryBudget('main.explore', '/explore')
+        self.assertQueryBudget('main.user', f'/user/{self.username}')
+        self.assertQueryBudget('main.user_popup',
+                               f'/user/{self.username}/popup')
+        self.assertQueryBudget('main.messages', '/messages')
+        self.assertQueryBudget('main.conversation', '/messages/user1')
+
+    def test_api_budgets(self):
+        self.assertQueryBudget('api.get_user', f'/api/users/{self.user_id}')
+        self.assertQueryBudget('api.get_users', '/api/users')
+        self.assertQueryBudget('api.get_followers',
+                               f'/api/users/{self.user_id}/followers')
+        self.assertQueryBudget('api.get_followed',
+                               f'/api/users/{self.user_id}/followed')
+
+    def test_projection_matches_to_dict(self):
+        user = User.query.get(self.user_id)
+        for endpoint, query, kwargs in [
+            ('api.get_users', User.query, {}),
+            ('api.get_followers', user.followers, {'id': self.user_id}),
+            ('api.get_followed', user.followed, {'id': self.user_id}),
+        ]:
+            with self.app.test_request_context():
+                self.assertEqual(
+                    user_collection(query, 2, 5, endpoint, **kwargs),
+                    User.to_collection_dict(query, 2, 5, endpoint,
+                                            **kwargs))
+
+    def test_sparse_fields(self):
+        self.budgets['api.get_users'] = 3
+        response = self.assertQueryBudget('api.get_users',
+                                          '/api/users?fields=username,id')
+        self.assertEqual(list(response.get_json()['items'][0]),
+                         ['id', 'username'])
+        response = self.client.get(
+            '/api/users?fields=id,password_hash',
+            headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_expand(self):
+        # One more query per embedded collection, however many users.
+        self.budgets['api.get_followers'] += 2
+        response = self.assertQueryBudget(
+            'api.get_followers',
+            f'/api/users/{self.user_id}/followers?expand=posts,followed')
+        for item in response.get_json()['items']:
+            embedded = item['_embedded']
+            self.assertEqual(len(embedded['posts']), 3)
+            self.assertEqual(embedded['followed'], [{
+                'id': self.user_id,
+                'username': self.username
+            }])
+        self.assertEqual(
+            [p['body'] for p in embedded['posts']],
+            [f'post {j} from {item["username"]}' for j in range(3)])
+
+    def test_users_by_id(self):
+        self.budgets['api.get_users'] = 3
+        response = self.assertQueryBudget(
+            'api.get_users', f'/api/users?ids=3,{self.user_id},999,3'
+            '&fields=id')
+        self.assertEqual(response.get_json(), {
+            'items': [{'id': 3}, {'id': self.user_id}],
+            '_meta': {'missing': [999]}
+        })
+
+    def test_bulk_follow(self):
+        response = self.client.post(
+            f'/api/users/{self.user_id}/followed',
+            json={'follow': [2, 999], 'unfollow': [3, self.user_id]},
+            headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.get_json()['items'], [
+            {'id': 2, 'status': 'already_following'},
+            {'id': 999, 'status': 'not_found'},
+            {'id': 3, 'status': 'unfollowed'},
+            {'id': self.user_id, 'status': 'invalid'},
+        ])
+        user = User.query.get(self.user_id)
+        self.assertFalse(user.is_following(User.query.get(3)))
+        self.assertEqual(user.followed.count(), 10)
+
+    def test_bulk_posts(self):
+        with QueryRecorder(db.engine) as queries:
+            response = self.client.post(
+                '/api/posts/bulk',
+                json={'posts': [{'body': 'one'}, {}, {'body': 'two'}]},
+                headers={'Authorization': f'Bearer {self.token}'})
+        items = response.get_json()['items']
+        self.assertEqual([i['status'] for i in items], [201, 400, 201])
+        self.assertEqual(Post.query.get(items[2]['id']).body, 'two')
+        # Token check and two inserts, nothing reloaded after the commit.
+        self.assertEqual(len(queries.statements), 3, queries.report())
+        # Rejected posts don't count as trending, whatever their body is.
+        response = self.client.post(
+            '/api/posts/bulk',
+            json={'posts': [{'body': 123}, {'body': '#toolong ' * 20},
+                            {'body': '#kept'}]},
+            headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual([i['status'] for i in response.get_json()['items']],
+                         [400, 400, 201])
+        tags = self.app.trending.store.counts(self.app.trending.bucket(),
+                                              'tags')
+        self.assertIn('kept', tags)
+        self.assertNotIn('toolong', tags)
+
+    def test_tags_and_mentions(self):
+        headers = {'Authorization': f'Bearer {self.token}'}
+        bodies = [f'#Python {i}' for i in range(5)] + \
+            ['hi @user1 #flask', 'mail me@user1.com @nobody']
+        ids = [item['id'] for item in self.client.post(
+            '/api/posts/bulk', json={'posts': [{'body': b} for b in bodies]},
+            headers=headers).get_json()['items']]
+        seen, url = [], '/api/tags/python/posts?limit=2'
+        while url:
+            data = self.assertQueryBudget('api.get_tagged_posts',
+                                          url).get_json()
+            seen.extend(item['id'] for item in data['items'])
+            url = data['_links']['next']
+        self.assertEqual(seen, ids[4::-1])
+        data = self.assertQueryBudget('api.get_mentions',
+                                      '/api/users/2/mentions').get_json()
+        self.assertEqual([item['id'] for item in data['items']], [ids[5]])
+        response = self.client.get('/tag/flask')
+        self.assertIn(b'hi @user1 #flask', response.data)
+        # The backfill rebuilds the same rows.
+        count = lambda table: db.session.query(table).count()
+        before = count(post_tags), count(mentions)
+        terms.backfill(batch_size=4, log=lambda message: None)
+        self.assertEqual((count(post_tags), count(mentions)), before)
+        self.assertEqual(before, (6, 1))
+
+    def test_ndjson_export(self):
+        headers = {'Authorization': f'Bearer {self.token}'}
+        response = self.client.get(
+            f'/api/users/{self.user_id}/followers/export?fields=id,username',
+            headers=headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([line['id'] for line in lines], list(range(2, 13)))
+        self.assertEqual(lines[0], {'id': 2, 'username': 'user1'})
+        # Pick up where a dropped export stopped.
+        response = self.client.get(
+            f'/api/users/{self.user_id}/posts/export?since_id=2',
+            headers=headers)
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([line['id'] for line in lines], [3])
+        response = self.client.get('/api/users/export?since_id=10',
+                                   headers=headers)
+        self.assertEqual(len(response.data.splitlines()), 2)
+
+    def test_post_api_budgets(self):
+        self.assertQueryBudget('api.get_posts', '/api/posts')
+        self.assertQueryBudget('api.get_user_posts',
+                               f'/api/users/{self.user_id}/posts')
+        self.assertQueryBudget('api.get_timeline', '/api/timeline')
+
+    def test_timeline_cursor(self):
+        user = User.query.get(self.user_id)
+        expected = [post.id for post in user.followed_posts()]
+        seen, url = [], '/api/timeline?limit=7'
+        while url:
+            data = self.assertQueryBudget('api.get_timeline', url).get_json()
+            seen.extend(item['id'] for item in data['items'])
+            self.assertEqual({a['id'] for a in data['authors']},
+                             {item['user_id'] for item in data['items']})
+            url = data['_links']['next']
+        self.assertEqual(seen, expected)
+        response = self.client.get(
+            '/api/timeline?cursor=nonsense',
+            headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    '''
+    Two SQLite files stand in for a primary and a lagging replica. The
+    replica copy of the user has a different about_me, so the popup shows
+    which database served the read.
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        primary = os.path.join(self.tmp, 'primary.db')
+        replica = os.path.join(self.tmp, 'replica.db')
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + replica]
+            WTF_CSRF_ENABLED = False
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com', about_me='primary')
+        u.set_password('cat')
+        self.token = u.get_token()
+        db.session.add(u)
+        db.session.commit()
+        # The replica starts as a copy, then drifts.
+        shutil.copy(primary, replica)
+        db.get_engine(bind='replica0').execute(
+            "UPDATE user SET about_me = 'replica'")
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(u.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        shutil.rmtree(self.tmp)
+
+    def test_reads_go_to_replica(self):
+        response = self.client.get('/user/john/popup')
+        self.assertIn(b'replica', response.data)
+        # Bumping last_seen on every page view doesn't count as a write.
+        response = self.client.get('/user/john/popup')
+        self.assertIn(b'replica', response.data)
+
+    def test_read_your_writes(self):
+        response = self.client.post('/edit_profile',
+                                    data={'username': 'john',
+                                          'about_me': 'edited'})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get('/user/john/popup')
+        self.assertIn(b'edited', response.data)
+        # Once the window is over, reads go back to the replica.
+        self.app.extensions['replica_windows'].store.until.clear()
+        response = self.client.get('/user/john/popup')
+        self.assertIn(b'replica', response.data)
+
+    def test_read_your_writes_after_login(self):
+        client = self.app.test_client()
+        response = client.post('/auth/login', data={'username': 'john',
+                                                    'password': 'cat'})
+        self.assertEqual(response.status_code, 302)
+        response = client.post('/edit_profile', data={'username': 'john',
+                                                      'about_me': 'edited'})
+        self.assertEqual(response.status_code, 302)
+        response = client.get('/user/john/popup')
+        self.assertIn(b'edited', response.data)
+
+    def test_read_your_writes_with_token(self):
+        # No cookies here, the window is found by the token's user.
+        client = self.app.test_client(use_cookies=False)
+        headers = {'Authorization': f'Bearer {self.token}'}
+        response = client.put('/api/users/1', json={'about_me': 'edited'},
+                              headers=headers)
+        self.assertEqual(response.status_code, 200)
+        response = client.get('/api/users/1', headers=headers)
+        self.assertEqual(response.get_json()['about_me'], 'edited')
+        self.app.extensions['replica_windows'].store.until.clear()
+        response = client.get('/api/users/1', headers=headers)
+        self.assertEqual(response.get_json()['about_me'], 'replica')
+
+    def test_bulk_writes(self):
+        with self.app.test_request_context('/'):
+            User.query.update({'last_seen': datetime.utcnow()},
+                              synchronize_session=False)
+            self.assertFalse(db.session.info.get('wrote'))
+            User.query.update({User.about_me: 'bulk'},
+                              synchronize_session=False)
+            self.assertTrue(db.session.info.get('wrote'))
+            db.session.rollback()
+            db.session.execute("UPDATE user SET about_me = 'raw'")
+            self.assertTrue(db.session.info.get('wrote'))
+            db.session.rollback()
+
+
+class QueryPlanCase(AppCase):
+    '''
+    EXPLAIN the queries behind the hot pages and fail if any of them reads
+    a whole table. Runs on SQLite by default. Point TEST_DATABASE_URL at a
+    scratch Postgres database to check its plans too.
+    '''
+    class Config(TestConfig):
+        SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
+            'sqlite://'
+
+    def setUp(self):
+        super(QueryPlanCase, self).setUp()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def full_scans(self, query):
+        '''Tables the database would read from start to end.'''
+        statement = query.statement if hasattr(query, 'statement') else query
+        compiled = statement.compile(db.engine)
+        params = compiled.params
+        if compiled.positional:
+            params = [params[key] for key in compiled.positiontup]
+        tables = set(db.metadata.tables)
+        connection = db.session.connection()
+        if db.engine.dialect.name == 'postgresql':
+            # Tiny test tables are always cheaper to scan. Make the planner
+            # use an index whenever one is usable at all.
+            connection.execute('SET LOCAL enable_seqscan = off')
+            result = connection.execute(
+                f'EXPLAIN (FORMAT JSON) {compiled}', params).scalar()
+            nodes, scans = [result[0]['Plan']], []
+            while nodes:
+                node = nodes.pop()
+                nodes.extend(node.get('Plans', []))
+                if node['Node Type'] == 'Seq Scan' and \
+                        node['Relation Name'] in tables:
+                    scans.append(node['Relation Name'])
+            return scans
+        rows = connection.execute(f'EXPLAIN QUERY PLAN {compiled}', params)
+        # "SCAN post" (or "SCAN TABLE post" on older SQLite) is a full
+        # scan. "SEARCH post USING INDEX" is what we want.
+        return [
+            word for detail in (row[-1] for row in rows)
+            if detail.startswith('SCAN ')
+            for word in detail.split()[1:3] if word in tables
+        ]
+
+    def assertNoFullScan(self, query):
+        self.assertEqual(self.full_scans(query), [])
+
+    def test_followed_posts(self):
+        self.assertNoFullScan(self.user.followed_posts().limit(25))
+        self.assertNoFullScan(self.user.followed.filter(
+            followers.c.followed_id == 2))
+        self.assertNoFullScan(self.user.followers)
+
+    def test_inbox(self):
+        self.assertNoFullScan(
+            self.user.threads.order_by(Thread.last_timestamp.desc()).limit(25))
+        self.assertNoFullScan(self.user.threads.filter_by(peer_id=2))
+
+    def test_user_page(self):
+        self.assertNoFullScan(User.query.filter_by(username='john'))
+        self.assertNoFullScan(
+            self.user.posts.order_by(Post.timestamp.desc()).limit(25))
+
+    def test_messages_page(self):
+        self.assertNoFullScan(self.user.conversation(
+            User(id=2, username='susan')).limit(25))
+
+    def test_tag_pages(self):
+        for timeline in [terms.tagged('python'), terms.mentioning(self.user)]:
+            self.assertNoFullScan(timeline.order_by(
+                *[key.desc() for key in timeline.cursor_keys]).limit(25).query)
+
+    def test_catches_full_scan(self):
+        self.assertEqual(self.full_scans(Post.query.filter(
+            Post.body == 'hello')), ['post'])
+
+
+class SQLiteProfileCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+        class ProfileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmp, 'app.db')
+            SQLITE_PROFILE = True
+
+        self.app = create_app(ProfileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine().dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.tmp)
+
+    def test_pragmas(self):
+        pragma = lambda name: db.engine.execute(f'PRAGMA {name}').scalar()
+        self.assertEqual(pragma('journal_mode'), 'wal')
+        # NORMAL
+        self.assertEqual(pragma('synchronous'), 1)
+        self.assertEqual(pragma('busy_timeout'),
+                         self.app.config['SQLITE_BUSY_TIMEOUT'])
+        self.assertEqual(pragma('cache_size'),
+                         self.app.config['SQLITE_CACHE_SIZE'])
+
+
+class ShardingCase(AppCase):
+    '''Two in-memory databases as shards for posts and messages.'''
+    class Config(TestConfig):
+        SQLALCHEMY_SHARD_URIS = ['sqlite://', 'sqlite://']
+
+    def setUp(self):
+        super(ShardingCase, self).setUp()
+        shards.create_tables(db)
+        self.users = [
+            User(username=f'user{i}', email=f'user{i}@example.com')
+            for i in range(4)
+        ]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def rows_on(self, table, bind=None):
+        return db.get_engine(bind=bind).execute(
+            f'SELECT id FROM {table} ORDER BY id').fetchall()
+
+    def test_posts_routed_by_author(self):
+        now = datetime.utcnow()
+        for i, u in enumerate(self.users):
+            db.session.add(Post(body=f'post {i}', author=u,
+                                timestamp=now + timedelta(seconds=i)))
+        db.session.commit()
+        self.assertEqual(self.rows_on('post'), [])
+        self.assertEqual(len(self.rows_on('post', 'shard0')), 2)
+        self.assertEqual(len(self.rows_on('post', 'shard1')), 2)
+        # Ids are unique across the shards.
+        self.assertEqual(len({p.id for p in Post.query.all()}), 4)
+        u0 = self.users[0]
+        self.assertEqual(u0.posts.count(), 1)
+        self.assertEqual(Post.query.count(), 4)
+
+        for u in self.users[1:]:
+            u0.follow(u)
+        db.session.commit()
+        self.assertEqual([p.body for p in u0.followed_posts().all()],
+                         ['post 3', 'post 2', 'post 1', 'post 0'])
+        self.assertEqual([p.body for p in u0.followed_posts().limit(2).all()],
+                         ['post 3', 'post 2'])
+        page = Post.recent().paginate(2, 3, False)
+        self.assertEqual(page.total, 4)
+        self.assertEqual([p.body for p in page.items], ['post 0'])
+
+    def test_ordered_fan_out(self):
+        now = datetime.utcnow()
+        for i, u in enumerate(self.users):
+            db.session.add(Post(body=f'post {i}', author=u,
+                                timestamp=now + timedelta(seconds=i)))
+        db.session.commit()
+        # No user_id in these, so they run on both shards and get merged.
+        newest = Post.query.order_by(Post.timestamp.desc())
+        self.assertEqual([p.body for p in newest.limit(3).all()],
+                         ['post 3', 'post 2', 'post 1'])
+        self.assertEqual([p.body for p in newest.offset(1).limit(2)],
+                         ['post 2', 'post 1'])
+        self.assertEqual(newest.first().body, 'post 3')
+        page = Post.query.order_by(Post.body).paginate(2, 3, False)
+        self.assertEqual(page.total, 4)
+        self.assertEqual([p.body for p in page.items], ['post 3'])
+        self.assertEqual(len(Post.query.limit(3).all()), 3)
+        with self.assertRaises(ValueError):
+            Post.query.order_by(db.func.length(Post.body)).all()
+
+    def test_tags_across_shards(self):
+        now = datetime.utcnow()
+        posts = [Post(body=f'#news {i}', author=u,
+                      timestamp=now + timedelta(seconds=i))
+                 for i, u in enumerate(self.users)]
+        db.session.add_all(posts)
+        db.session.flush()
+        terms.index_posts(posts)
+        db.session.commit()
+        self.assertEqual([p.body for p in terms.tagged('news').order_by(
+            post_tags.c.timestamp.desc()).limit(3).all()],
+                         ['#news 3', '#news 2', '#news 1'])
+        # Backfilling walks each shard.
+        self.assertEqual(terms.backfill(log=lambda message: None), 4)
+
+    def test_messages_routed_by_recipient(self):
+        u0, u1 = self.users[:2]
+        u0.send_message(u1, 'hi')
+        db.session.commit()
+        self.assertEqual(len(self.rows_on('message', shards.shard_for(
+            u1.id))), 1)
+        self.assertEqual(u1.new_messages(), 1)
+        self.assertEqual(u0.new_messages(), 0)
+
+    def test_redistribute(self):
+        # Rows written before sharding was turned on sit on the primary.
+        for i, u in enumerate(self.users):
+            db.get_engine().execute(
+                "INSERT INTO post (id, body, user_id) VALUES (?, 'old', ?)",
+                i + 10, u.id)
+        self.assertEqual(shards.redistribute(db, batch_size=3,
+                                             log=lambda msg: None), 13)
+        self.assertEqual(self.rows_on('post'), [])
+        self.assertEqual(Post.query.count(), 4)
+        IdTicket.reserve(13)
+        db.session.add(Post(body='new', author=self.users[0]))
+        db.session.commit()
+        self.assertEqual(self.users[0].posts.order_by(Post.id.desc()).first()
+                         .id, 14)
+
+    def test_missing_shard_key(self):
+        db.session.add(Post(body='nobody wrote this'))
+        with self.assertRaisesRegex(ValueError, 'post.user_id'):
+            db.session.commit()
+        db.session.rollback()
+        # Rows like that already on the primary stay there.
+        db.get_engine().execute(
+            "INSERT INTO message (id, body, sender_id) VALUES (1, 'lost', ?)",
+            self.users[0].id)
+        messages = []
+        shards.redistribute(db, log=messages.append)
+        self.assertEqual(len(self.rows_on('message')), 1)
+        self.assertIn('message: left 1 rows without recipient_id on primary',
+                      messages)
+
+
+def warm_job():
+    '''Which process, app and app context ran this job.'''
+    return (os.getpid(), id(current_app._get_current_object()),
+            id(_app_ctx_stack.top))
+
+
+class WarmWorkerCase(unittest.TestCase):
+    '''Runs real jobs, so it needs a Redis server at REDIS_URL.'''
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.redis = self.app.redis._get_current_object()
+        try:
+            self.redis.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('no Redis server')
+        self.queue = Queue(f'microblog-test-{os.getpid()}',
+                           connection=self.redis)
+
+    def tearDown(self):
+        if hasattr(self, 'queue'):
+            self.queue.delete(delete_jobs=True)
+
+    def test_jobs_share_app_and_recycle(self):
+        jobs = [self.queue.enqueue(warm_job) for _ in range(5)]
+        # run() is meant to own the process, put back what it changes.
+        handlers = [signal.getsignal(s) for s in (signal.SIGTERM,
+                                                  signal.SIGINT)]
+        try:
+            worker.run(self.app, [([self.queue.name], 1)], burst=True,
+                       max_jobs=2, log=lambda message: None)
+        finally:
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+            gc.unfreeze()
+            gc.enable()
+        results = [Job.fetch(job.id, connection=self.redis).result
+                   for job in jobs]
+        self.assertNotIn(None, results)
+        # Every job ran in the app built here, none built its own.
+        self.assertEqual({app for _, app, _ in results}, {id(self.app)})
+        by_pid = {}
+        for pid, _, context in results:
+            by_pid.setdefault(pid, set()).add(context)
+        self.assertNotIn(os.getpid(), by_pid)
+        # A new child every two jobs, each keeping one app context.
+        self.assertEqual(len(by_pid), 3)
+        self.assertEqual([len(contexts) for contexts in by_pid.values()],
+                         [1, 1, 1])
+
+
+class QueueRoutingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+
+    def test_routes(self):
+        self.assertEqual(queue_for(self.app, 'export_posts'), 'bulk')
+        self.assertEqual(queue_for(self.app, 'anything_else'), 'interactive')
+        # Nothing talks to Redis until a job is enqueued.
+        self.assertEqual(self.app.task_queues['bulk'].name, 'microblog-bulk')
+        self.assertEqual(self.app.task_queue.name, 'microblog-interactive')
+
+    def test_pools(self):
+        self.assertEqual(pool_queues('interactive'),
+                         ['microblog-interactive'])
+        self.assertEqual(pool_queues('bulk'),
+                         ['microblog-interactive', 'microblog-bulk'])
+
+
+class MaintenanceCase(AppCase):
+    class Config(TestConfig):
+        # Small enough that every job needs several batches.
+        MAINTENANCE_BATCH_SIZE = 2
+
+    def test_expire_tokens(self):
+        now = datetime.utcnow()
+        for i in range(5):
+            u = User(username=f'u{i}', email=f'u{i}@example.com')
+            u.get_token(expires_in=3600 if i == 0 else -60)
+        db.session.commit()
+        self.assertEqual(maintenance.expire_tokens(), 4)
+        self.assertEqual(User.query.filter(User.token.isnot(None)).count(), 1)
+        self.assertGreater(User.query.filter_by(username='u0').one()
+                           .token_expiration, now)
+
+    def test_purges(self):
+        u = User(username='susan', email='susan@example.com')
+        db.session.add(u)
+        for i in range(5):
+            db.session.add(Task(id=str(i), name='export_posts', user=u,
+                                complete=i > 0))
+            db.session.add(Notification(name=f'n{i}', user=u,
+                                        timestamp=time.time() - i * 86400 * 3))
+        db.session.commit()
+        self.assertEqual(maintenance.purge_tasks(), 4)
+        self.assertEqual([t.id for t in Task.query], ['0'])
+        # 0, 3 and 6 days old stay, 9 and 12 go.
+        self.assertEqual(maintenance.purge_notifications(), 2)
+        self.assertEqual(Notification.query.count(), 3)
+
+
+class TrendingCase(unittest.TestCase):
+    def setUp(self):
+        class SmallConfig(TestConfig):
+            # Tiny, so collisions and trimming actually happen.
+            TRENDING_WIDTH = 16
+            TRENDING_CANDIDATES = 5
+
+        self.app = create_app(SmallConfig)
+        self.trending = self.app.trending
+
+    def test_sketch_never_undercounts(self):
+        sketch = CountMinSketch(16, 4)
+        counts = {f'term{i}': i % 7 + 1 for i in range(50)}
+        for name, count in counts.items():
+            sketch.add(name, count)
+        for name, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(name), count)
+
+    def test_snapshot(self):
+        now = 1600000000
+        bucket = self.app.config['TRENDING_BUCKET']
+        # An hour ago #old was everywhere, now it's #new.
+        self.trending.add(['#old story'] * 6, now=now - 11 * bucket)
+        self.trending.add([f'#new story #t{i}' for i in range(4)] + ['#new'],
+                          now=now)
+        snapshot = self.trending.snapshot(now=now)
+        self.assertEqual(snapshot['tags'][0]['name'], 'new')
+        self.assertIn('old', [t['name'] for t in snapshot['tags']])
+        self.assertEqual(snapshot['words'][0]['name'], 'story')
+        self.assertLessEqual(len(snapshot['tags']),
+                             self.app.config['TRENDING_SIZE'])
+        self.assertEqual(self.trending.current(), snapshot)
+        # Once the old bucket leaves the window it's gone.
+        self.trending.add(['#new'], now=now + bucket)
+        self.assertNotIn('old', [
+            t['name'] for t in self.trending.snapshot(now=now + bucket)['tags']
+        ])
+
+    def test_candidates_bounded(self):
+        self.trending.add([f'#tag{i}' for i in range(40)], now=0)
+        self.assertEqual(len(self.trending.store.counts(0, 'tags')), 5)
+
+
+class UsernameIndexCase(AppCase):
+    def setUp(self):
+        super(UsernameIndexCase, self).setUp()
+        for name in ('susan', 'Sam', 'sally', 'john'):
+            db.session.add(User(username=name, email=f'{name}@example.com'))
+        db.session.commit()
+        self.usernames = self.app.usernames
+
+    def test_complete(self):
+        self.assertEqual([u for _, u in self.usernames.complete('s')],
+                         ['sally', 'Sam', 'susan'])
+        self.assertEqual([u for _, u in self.usernames.complete('SA')],
+                         ['sally', 'Sam'])
+        self.assertEqual(self.usernames.complete('s', limit=1)[0][1], 'sally')
+        self.assertEqual(self.usernames.complete('x'), [])
+
+    def test_create_and_rename(self):
+        self.usernames.complete('s')
+        db.session.add(User(username='sarah', email='sarah@example.com'))
+        susan = User.query.filter_by(username='susan').one()
+        susan.username = 'zoe'
+        db.session.commit()
+        self.assertEqual([u for _, u in self.usernames.complete('s')],
+                         ['sally', 'Sam', 'sarah'])
+        self.assertEqual(self.usernames.complete('z'), [(susan.id, 'zoe')])
+        # A rolled back rename never shows.
+        susan.username = 'amy'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.usernames.complete('a'), [])
+
+    def test_available(self):
+        self.usernames.complete('')
+        with QueryRecorder(db.engine) as queries:
+            # Never seen by the Bloom filter, or in the index: no queries.
+            self.assertTrue(self.usernames.available('nobody'))
+            self.assertTrue(
+                self.usernames.email_available('nobody@example.com'))
+            self.assertFalse(self.usernames.available('susan'))
+        self.assertEqual(queries.statements, [])
+        self.assertFalse(self.usernames.email_available('susan@example.com'))
+        # Renamed away: the filter still says maybe, the database says
+        # it's free.
+        User.query.filter_by(username='john').one().username = 'johnny'
+        db.session.commit()
+        with QueryRecorder(db.engine) as queries:
+            self.assertTrue(self.usernames.available('john'))
+        self.assertEqual(len(queries.statements), 1)
+
+    def test_complete_api(self):
+        user = User.query.filter_by(username='john').one()
+        token = user.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+        data = client.get('/api/users/complete?prefix=sa',
+                          headers=headers).get_json()
+        self.assertEqual([u['username'] for u in data['items']],
+                         ['sally', 'Sam'])
+        self.assertTrue(data['available'])
+        data = client.get('/api/users/complete?prefix=sally',
+                          headers=headers).get_json()
+        self.assertFalse(data['available'])
+        response = client.post('/api/users', json={
+            'username': 'sally',
+            'email': 'other@example.com',
+            'password': 'cat'
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            client.get('/api/users/complete',
+                       headers=headers).status_code, 400)
+
+
+class UserCacheCase(AppCase):
+    class Config(TestConfig):
+        WTF_CSRF_ENABLED = False
+
+    def setUp(self):
+        super(UserCacheCase, self).setUp()
+        self.user = User(username='susan', email='susan@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.client_for(self.user.id)
+
+    def user_queries(self, url):
+        with QueryRecorder(db.engine) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return [s for s, _ in queries.statements if 'FROM user' in s]
+
+    def test_no_user_query_once_cached(self):
+        self.assertEqual(len(self.user_queries('/notifications')), 1)
+        self.assertEqual(self.user_queries('/notifications'), [])
+        self.assertEqual(self.user_queries('/index'), [])
+
+    def test_invalidated_on_change(self):
+        cached = self.app.user_cache.get(self.user.id)
+        self.assertEqual(cached.username, 'susan')
+        self.user.about_me = 'hello'
+        db.session.commit()
+        self.assertEqual(self.app.user_cache.get(self.user.id).about_me,
+                         'hello')
+        # last_seen changes all the time and isn't cached.
+        self.user.last_seen = datetime.utcnow()
+        db.session.commit()
+        id = self.user.id
+        with QueryRecorder(db.engine) as queries:
+            self.app.user_cache.get(id)
+        self.assertEqual(queries.statements, [])
+
+    def test_edit_through_cached_user(self):
+        self.client.get('/index')
+        response = self.client.post('/edit_profile', data={
+            'username': 'sue',
+            'about_me': 'renamed'
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.query.get(self.user.id).username, 'sue')
+        self.assertIn(b'Hi,  sue!', self.client.get('/index').data)
+
+
+class PasswordCase(AppCase):
+    class Config(TestConfig):
+        WTF_CSRF_ENABLED = False
+        PASSWORD_HASH_CONCURRENCY = 1
+        PASSWORD_HASH_QUEUE = 1
+        PASSWORD_HASH_WAIT = 0.1
+
+    def setUp(self):
+        super(PasswordCase, self).setUp()
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+
+    def test_pool(self):
+        self.app.config['PASSWORD_HASH_PROCESSES'] = 1
+        try:
+            u = User.query.filter_by(username='susan').one()
+            u.set_password('dog')
+            self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+            self.assertTrue(u.check_password('dog'))
+            self.assertFalse(u.check_password('cat'))
+        finally:
+            self.app.passwords.pool.shutdown()
+
+    def test_shed_when_busy(self):
+        client = self.app.test_client()
+        login = {'username': 'susan', 'password': 'cat'}
+        self.assertEqual(client.post('/auth/login', data=login).status_code,
+                         302)
+        client.get('/auth/logout')
+        # Someone else is hashing, and nobody may wait for long.
+        slot = self.app.passwords.acquire()
+        try:
+            response = client.post('/auth/login', data=login)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            credentials = base64.b64encode(b'susan:cat').decode('ascii')
+            response = client.post(
+                '/api/tokens',
+                headers={'Authorization': f'Basic {credentials}'})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('message', response.get_json())
+        finally:
+            self.app.passwords.release(slot)
+
+    def test_reclaim(self):
+        # A worker that dies holding a turn.
+        child = multiprocessing.Process(target=self.app.passwords.acquire)
+        child.start()
+        child.join()
+        self.assertIsNone(self.app.passwords.acquire(timeout=0))
+        self.assertEqual(self.app.passwords.reclaim(child.pid), 1)
+        slot = self.app.passwords.acquire(timeout=0)
+        self.assertIsNotNone(slot)
+        self.app.passwords.release(slot)
+
+    def test_reclaim_waiter(self):
+        passwords = self.app.passwords
+        slot = passwords.acquire()
+        # A worker killed while it waits for that turn.
+        self.app.config['PASSWORD_HASH_WAIT'] = 30
+        child = multiprocessing.Process(target=passwords.hash, args=('x', ))
+        child.start()
+        self.app.config['PASSWORD_HASH_WAIT'] = 0.1
+        deadline = time.monotonic() + 10
+        while child.pid not in passwords.waiters[:]:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        child.kill()
+        child.join()
+        passwords.release(slot)
+        # Its place in the queue is still taken.
+        with self.assertRaises(Overloaded):
+            passwords.hash('cat')
+        self.assertEqual(passwords.reclaim(child.pid), 1)
+        self.assertTrue(passwords.hash('cat'))
+
+
+class LimitsCase(AppCase):
+    class Config(TestConfig):
+        RATE_LIMITS = {
+            'main.explore': {'rate': 0.01, 'burst': 2},
+            'main': {'concurrency': 1},
+        }
+
+    def setUp(self):
+        super(LimitsCase, self).setUp()
+        self.users = [User(username=f'u{i}', email=f'u{i}@example.com')
+                      for i in range(2)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def shed(self, endpoint, reason):
+        return self.app.metrics.registry.get_sample_value(
+            'microblog_requests_shed_total',
+            {'endpoint': endpoint, 'reason': reason}) or 0
+
+    def test_rate(self):
+        first, second = [self.client_for(u.id) for u in self.users]
+        self.assertEqual(first.get('/explore').status_code, 200)
+        self.assertEqual(first.get('/explore').status_code, 200)
+        response = first.get('/explore')
+        self.assertEqual(response.status_code, 429)
+        # The bucket refills at 0.01 per second.
+        self.assertEqual(response.headers['Retry-After'], '100')
+        self.assertEqual(self.shed('main.explore', 'rate'), 1)
+        # Everyone has their own bucket.
+        self.assertEqual(second.get('/explore').status_code, 200)
+        # API tokens count as their user.
+        token = self.users[0].get_token()
+        db.session.commit()
+        response = self.app.test_client().get(
+            '/explore', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 429)
+
+    def test_bad_credentials(self):
+        # Headers that don't verify can't buy a fresh bucket.
+        client = self.app.test_client()
+        statuses = [
+            client.get('/explore', headers={
+                'Authorization': f'Bearer junk{i}'
+            }).status_code for i in range(3)
+        ]
+        self.assertEqual(statuses[2], 429)
+        response = client.get('/explore', headers={'Authorization': 'junk'})
+        self.assertEqual(response.status_code, 429)
+
+    def test_concurrency(self):
+        client = self.client_for(self.users[0].id)
+        # A slot is given back at the end of every request.
+        self.assertEqual(client.get('/index').status_code, 200)
+        self.assertEqual(client.get('/index').status_code, 200)
+        # Another worker is busy with the only one.
+        self.app.limits.memory.enter('main.index', 'busy', 1, 0, 0)
+        response = client.get('/index', headers={'Accept':
+                                                 'application/json'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(self.shed('main.index', 'concurrency'), 1)
+        # The endpoint's own rule wins over its blueprint's.
+        self.assertEqual(client.get('/explore').status_code, 200)
+        self.app.limits.memory.leave('main.index', 'busy')
+        self.assertEqual(client.get('/index').status_code, 200)
+
+    def test_redis_scripts(self):
+        # The Lua scripts only run on a real Redis.
+        connection = self.app.redis._get_current_object()
+        try:
+            connection.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('no Redis server')
+        store = limits.RedisStore(connection)
+        key = f'test-{os.getpid()}'
+        now = time.time()
+        try:
+            # Two at once, then half a token a second.
+            self.assertEqual(store.take(key, 0.5, 2, now, 10), 0)
+            self.assertEqual(store.take(key, 0.5, 2, now, 10), 0)
+            self.assertEqual(store.take(key, 0.5, 2, now, 10), 2)
+            self.assertEqual(store.take(key, 0.5, 2, now + 2.5, 10), 0)
+            self.assertGreater(store.take(key, 0.5, 2, now + 2.5, 10), 0)
+
+            self.assertTrue(store.enter(key, 'a', 2, now, 60))
+            self.assertTrue(store.enter(key, 'b', 2, now, 60))
+            self.assertFalse(store.enter(key, 'c', 2, now, 60))
+            store.leave(key, 'a')
+            self.assertTrue(store.enter(key, 'c', 2, now, 60))
+            # Requests older than the stale limit are assumed dead.
+            self.assertTrue(store.enter(key, 'd', 2, now + 61, 60))
+            self.assertEqual(
+                connection.zrange('microblog-running:' + key, 0, -1),
+                [b'd'])
+        finally:
+            connection.delete('microblog-limit:' + key,
+                              'microblog-running:' + key)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file